@@ -4,7 +4,6 @@ import requests
 from os.path import basename
 from base.config import config
 from flask import Flask, render_template
-from flask_wtf.csrf import CSRFProtect
 from base.utils.text_utils import render_markdown
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.exceptions import HTTPException
@@ -13,7 +12,11 @@ from base.manage import (initdb,
                          update_strains,
                          update_credentials,
                          decrypt_credentials,
-                         download_db)
+                         download_db,
+                         build_impact_index,
+                         build_genotype_store,
+                         load_gene_variant_summary,
+                         compact_site_stats)
 
 # --------- #
 #  Routing  #
@@ -40,6 +43,7 @@ from base.views.api.api_strain import api_strain_bp
 from base.views.api.api_gene import api_gene_bp
 from base.views.api.api_variant import api_variant_bp
 from base.views.api.api_data import api_data_bp
+from base.views.api.api_popgen import api_popgen_bp
 
 # Auth
 from base.auth import (auth_bp,
@@ -52,6 +56,7 @@ from base.auth import (auth_bp,
 # Extensions
 from base.extensions import (markdown,
                              cache,
+                             csrf,
                              debug_toolbar,
                              sslify,
                              sqlalchemy)
@@ -98,7 +103,11 @@ def register_commands(app):
                     update_strains,
                     update_credentials,
                     decrypt_credentials,
-                    download_db]:
+                    download_db,
+                    build_impact_index,
+                    build_genotype_store,
+                    load_gene_variant_summary,
+                    compact_site_stats]:
         app.cli.add_command(command)
 
 
@@ -109,10 +118,10 @@ def register_template_filters(app):
 
 def register_extensions(app):
     markdown(app)
-    cache.init_app(app, config={'CACHE_TYPE': 'base.utils.cache.datastore_cache'})
+    cache.init_app(app, config={'CACHE_TYPE': 'base.utils.cache.tiered_cache'})
     sqlalchemy(app)
-    CSRFProtect(app)
-    app.config['csrf'] = CSRFProtect(app)
+    csrf.init_app(app)
+    app.config['csrf'] = csrf
 
 
 def register_blueprints(app):
@@ -136,6 +145,7 @@ def register_blueprints(app):
     app.register_blueprint(api_gene_bp, url_prefix='/api')
     app.register_blueprint(api_variant_bp, url_prefix='/api')
     app.register_blueprint(api_data_bp, url_prefix='/api')
+    app.register_blueprint(api_popgen_bp, url_prefix='/api')
 
     # Auth
     app.register_blueprint(auth_bp, url_prefix='')
@@ -9,6 +9,7 @@ from flask import (redirect,
 from functools import wraps
 from base.models import user_ds
 from base.utils.data_utils import unique_id
+from base.utils.site_stats import record_site_stats
 from slugify import slugify
 from logzero import logger
 
@@ -58,7 +59,8 @@ def authorized(blueprint, token):
 
     # Create or get existing user.
     user = user_ds(user_email)
-    if not user._exists:
+    new_user = not user._exists
+    if new_user:
         user.user_email = user_email
         user.user_info = user_info
         user.email_confirmation_code = unique_id()
@@ -67,6 +69,8 @@ def authorized(blueprint, token):
 
     user.last_login = arrow.utcnow().datetime
     user.save()
+    if new_user:
+        record_site_stats(users=1)
 
     session['user'] = user.to_dict()
     logger.debug(session)
@@ -23,6 +23,43 @@ DATASET_RELEASE, WORMBASE_VERSION = RELEASES[0]
 # SQLITE DATABASE
 SQLITE_PATH = f"base/cendr.{DATASET_RELEASE}.{WORMBASE_VERSION}.db"
 
+# DEFAULTS
+# These may be overridden within env_config
+DEFAULT_VARS = {
+    # Idle cyvcf2 readers kept open per release VCF (per worker process)
+    "VCF_READER_POOL_SIZE": 4,
+    # Region query backend for /api/variant: 'native' (cyvcf2), 'bcftools'
+    # or 'store' (genotype store; falls back to 'native' for releases without one)
+    "VARIANT_QUERY_ENGINE": "native",
+    # Threads used to run the regions of /api/variant/batch concurrently
+    "VARIANT_BATCH_WORKERS": 8,
+    # Distinct ANN strings kept parsed in memory (per worker process)
+    "ANN_CACHE_SIZE": 20000,
+    # Impact index of each release (flask build_impact_index); queries
+    # filtered by impact scan the whole region when it is missing
+    "IMPACT_INDEX_PATH": "base/static/data/impact_index.{release}.npz",
+    # Matching records closer than this (bp) are read as one span
+    "IMPACT_INDEX_MAX_GAP": 10000,
+    # Genotype store of each release (flask build_genotype_store), used
+    # when VARIANT_QUERY_ENGINE is 'store'
+    "GENOTYPE_STORE_PATH": "base/genotype_store/{release}",
+    # Remote VCF, index and BED files are read through a local block cache
+    "BLOCK_CACHE_ENABLED": True,
+    "BLOCK_CACHE_PORT": 8911,
+    "BLOCK_CACHE_DIR": "/tmp/cendr_block_cache",
+    "BLOCK_CACHE_MAX_BYTES": 2 * 1024 ** 3,
+    "BLOCK_CACHE_BLOCK_SIZE": 256 * 1024,
+    # Remote hosts read through the block cache; the proxy refuses others
+    "BLOCK_CACHE_ALLOWED_HOSTS": ["storage.googleapis.com"],
+    # Seconds before the ETag of a cached remote file is checked again
+    "BLOCK_CACHE_VALIDATE_SECONDS": 300,
+    # In-process (L1) cache in front of the Datastore cache, per worker
+    # process; entries are kept at most CACHE_L1_TTL seconds so that
+    # workers pick up values written by other workers
+    "CACHE_L1_MAX_BYTES": 64 * 1024 ** 2,
+    "CACHE_L1_TTL": 300
+}
+
 
 def load_yaml(path):
     return yaml.load(open(path), Loader=yaml.SafeLoader)
@@ -35,7 +72,7 @@ def get_config(APP_CONFIG):
 
     (BASE_VARS are the same regardless of whether we are debugging or in production)
     """
-    config = dict()
+    config = dict(DEFAULT_VARS)
     BASE_VARS = load_yaml("env_config/base.yaml")
     APP_CONFIG_VARS = load_yaml(f"env_config/{APP_CONFIG}.yaml")
     config.update(BASE_VARS)
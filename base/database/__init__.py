@@ -9,10 +9,12 @@ from base.utils.data_utils import download
 from base.utils.gcloud import upload_file
 from base.models import (db,
                          Strain,
+                         StrainAlias,
                          Homologs,
                          Metadata,
                          WormbaseGene,
-                         WormbaseGeneSummary)
+                         WormbaseGeneSummary,
+                         GeneVariantSummary)
 from base.config import (CENDR_VERSION,
                          APP_CONFIG,
                          DATASET_RELEASE,
@@ -25,6 +27,7 @@ from base.database.etl_strains import fetch_andersen_strains
 from base.database.etl_wormbase import (fetch_gene_gff_summary,
                                         fetch_gene_gtf,
                                         fetch_orthologs)
+from base.database.etl_gene_variants import fetch_gene_variant_summary
 
 console = Console()
 DOWNLOAD_PATH = ".download"
@@ -79,8 +82,9 @@ def initialize_sqlite_database(sel_wormbase_version,
     app.app_context().push()
 
     if strain_only is True:
-        db.metadata.drop_all(bind=db.engine, checkfirst=True, tables=[Strain.__table__])
-        db.metadata.create_all(bind=db.engine, tables=[Strain.__table__])
+        strain_tables = [Strain.__table__, StrainAlias.__table__]
+        db.metadata.drop_all(bind=db.engine, checkfirst=True, tables=strain_tables)
+        db.metadata.create_all(bind=db.engine, tables=strain_tables)
     else:
         db.create_all(app=app)
     db.session.commit()
@@ -91,10 +95,16 @@ def initialize_sqlite_database(sel_wormbase_version,
     # Load Strains #
     ################
     console.log('Loading strains...')
-    db.session.bulk_insert_mappings(Strain, fetch_andersen_strains())
+    strains = fetch_andersen_strains()
+    db.session.bulk_insert_mappings(Strain, strains)
     db.session.commit()
     console.log(f"Inserted {Strain.query.count()} strains")
 
+    # Current and previous strain names for isotype resolution
+    db.session.bulk_insert_mappings(StrainAlias, list(StrainAlias.from_strains(strains)))
+    db.session.commit()
+    console.log(f"Inserted {StrainAlias.query.count()} strain aliases")
+
     if strain_only is True:
         console.log('Finished loading strains')
         return
@@ -153,6 +163,11 @@ def initialize_sqlite_database(sel_wormbase_version,
     db.session.bulk_insert_mappings(Homologs, fetch_orthologs(ortholog_fname))
     db.session.commit()
 
+    ###########################
+    # Summarize gene variants #
+    ###########################
+    load_gene_variant_summary(DATASET_RELEASE)
+
     #############
     # Upload DB #
     #############
@@ -173,6 +188,31 @@ def initialize_sqlite_database(sel_wormbase_version,
     pickle.dump(gene_dict, open("base/static/data/gene_dict.pkl", 'wb'))
 
 
+def load_gene_variant_summary(release, vcf=None):
+    """
+        Replaces the gene variant summaries of a release
+        in the current database.
+
+        Args:
+            release - the dataset release
+            vcf - path or url of the release VCF (the hard-filtered
+                  release VCF by default)
+    """
+    from base.views.api.api_variant import get_vcf
+    vcf = vcf or get_vcf(release=release, filter_type="hard")
+    console.log(f"Summarizing gene variants of {vcf}")
+    genes = WormbaseGeneSummary.query.with_entities(WormbaseGeneSummary.gene_id,
+                                                    WormbaseGeneSummary.chrom,
+                                                    WormbaseGeneSummary.start,
+                                                    WormbaseGeneSummary.end).all()
+    GeneVariantSummary.__table__.create(bind=db.engine, checkfirst=True)
+    GeneVariantSummary.query.filter(GeneVariantSummary.release == int(release)).delete()
+    db.session.bulk_insert_mappings(GeneVariantSummary, list(fetch_gene_variant_summary(vcf, genes, release)))
+    db.session.commit()
+    n_genes = GeneVariantSummary.query.filter(GeneVariantSummary.release == int(release)).count()
+    console.log(f"Inserted variant summaries of {n_genes} genes")
+
+
 def download_sqlite_database():
     SQLITE_PATH = f"base/cendr.{DATASET_RELEASE}.{WORMBASE_VERSION}.db"
     SQLITE_BASENAME = os.path.basename(SQLITE_PATH)
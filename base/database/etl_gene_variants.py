@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+
+Functions in this script summarize the variants of
+each gene in a release VCF for the gene_variant_summary table.
+
+The VCF is read once; every record is assigned to the genes
+overlapping it using an interval index over the gene summary table.
+
+"""
+import json
+import heapq
+import numpy as np
+from cyvcf2 import VCF
+from logzero import logger
+from base.utils.interval_index import IntervalIndex
+from base.utils.impact_index import IMPACT_FIELD
+
+# ANN fields used in the summary
+ANN_FIELDS = {"effect": 1,
+              "impact": IMPACT_FIELD,
+              "gene_id": 4,
+              "feature_id": 6,
+              "transcript_biotype": 7,
+              "aa_change": 10}
+
+# Impacts from most to least severe
+IMPACT_RANK = {"HIGH": 4, "MODERATE": 3, "LOW": 2, "MODIFIER": 1}
+
+# Number of variants stored per gene
+TOP_N = 10
+
+# Genotype code of the alternative allele (cyvcf2 gts012)
+HOM_ALT = 2
+
+
+def parse_ann(ANN):
+    """
+        Returns the summary fields of each annotation in an ANN string
+    """
+    annotations = []
+    for ANN_rec in (ANN or "").split(","):
+        fields = ANN_rec.split("|")
+        if len(fields) > max(ANN_FIELDS.values()):
+            annotations.append({k: fields[n] for k, n in ANN_FIELDS.items()})
+    return annotations
+
+
+class _GeneSummary(object):
+
+    def __init__(self, n_samples):
+        self.n_samples = n_samples
+        self.n_variants = 0
+        self.impact_counts = {}
+        self.biotype_counts = {}
+        self.alt_isotypes = None
+        self.top = []
+
+    def add(self, record, annotations, n):
+        """
+            Adds a variant and the annotations of the gene.
+            n orders variants of equal impact and AF.
+        """
+        self.n_variants += 1
+        impact = max((x['impact'] for x in annotations),
+                     key=lambda x: IMPACT_RANK.get(x, 0),
+                     default="NONE")
+        self.impact_counts[impact] = self.impact_counts.get(impact, 0) + 1
+        for biotype in {x['transcript_biotype'] for x in annotations if x['transcript_biotype']}:
+            self.biotype_counts[biotype] = self.biotype_counts.get(biotype, 0) + 1
+
+        alt = record.gt_types == HOM_ALT
+        if impact in ("HIGH", "MODERATE"):
+            if self.alt_isotypes is None:
+                self.alt_isotypes = np.zeros(self.n_samples, dtype=bool)
+            self.alt_isotypes |= alt
+
+        AF = record.INFO.get('AF')
+        if isinstance(AF, tuple):
+            AF = AF[0]
+        AF = 0.0 if AF is None else float(AF)
+        # The first annotation of the most severe impact describes the variant
+        ann = next((x for x in annotations if x['impact'] == impact), {})
+        key = (IMPACT_RANK.get(impact, 0), AF, -n)
+        if len(self.top) < TOP_N or key > self.top[0][0]:
+            variant = {"CHROM": record.CHROM,
+                       "POS": record.POS,
+                       "REF": record.REF,
+                       "ALT": record.ALT,
+                       "AF": round(AF, 3),
+                       "impact": impact,
+                       "effect": ann.get("effect"),
+                       "feature_id": ann.get("feature_id"),
+                       "transcript_biotype": ann.get("transcript_biotype"),
+                       "aa_change": ann.get("aa_change"),
+                       "n_alt": int(alt.sum())}
+            if len(self.top) < TOP_N:
+                heapq.heappush(self.top, (key, variant))
+            else:
+                heapq.heapreplace(self.top, (key, variant))
+
+    def record(self, gene_id, release):
+        top = [variant for key, variant in sorted(self.top, key=lambda x: x[0], reverse=True)]
+        return {'gene_id': gene_id,
+                'release': int(release),
+                'n_variants': self.n_variants,
+                'n_isotypes_high_moderate': 0 if self.alt_isotypes is None else int(self.alt_isotypes.sum()),
+                'impact_counts': json.dumps(self.impact_counts),
+                'biotype_counts': json.dumps(self.biotype_counts),
+                'top_variants': json.dumps(top)}
+
+
+def fetch_gene_variant_summary(vcf_path, genes, release):
+    """
+        LOADS gene_variant_summary
+        Summarizes the variants of each gene in a release VCF.
+
+        Args:
+            vcf_path - path or url of the release VCF
+            genes - list of (gene_id, chrom, start, end)
+            release - the dataset release
+
+        Yields a record for every gene with variants:
+            variant counts by impact (most severe annotation of the gene)
+            and by transcript biotype, the number of isotypes carrying
+            the alternative allele at HIGH or MODERATE sites, and the
+            TOP_N variants ranked by impact then allele frequency.
+    """
+    gene_ids = [x[0] for x in genes]
+    index = IntervalIndex([x[1] for x in genes],
+                          [x[2] for x in genes],
+                          [x[3] for x in genes])
+    vcf = VCF(vcf_path, gts012=True)
+    n_samples = len(vcf.samples)
+    summaries = {}
+    for n, record in enumerate(vcf):
+        overlapping = index.overlapping(record.CHROM, record.POS, record.POS + len(record.REF) - 1)
+        if not len(overlapping):
+            continue
+        annotations = parse_ann(record.INFO.get('ANN'))
+        for gene in overlapping.tolist():
+            gene_id = gene_ids[gene]
+            if gene_id not in summaries:
+                summaries[gene_id] = _GeneSummary(n_samples)
+            summaries[gene_id].add(record,
+                                   [x for x in annotations if x['gene_id'] == gene_id],
+                                   n)
+        if n % 1000000 == 0:
+            logger.info(f"Processed {n} records; {record.CHROM}:{record.POS}")
+    vcf.close()
+    for gene_id, summary in summaries.items():
+        yield summary.record(gene_id, release)
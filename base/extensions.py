@@ -5,9 +5,11 @@ from flask_caching import Cache
 from flask_sslify import SSLify
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_sqlalchemy import SQLAlchemy
+from flask_wtf.csrf import CSRFProtect
 
 sqlalchemy = SQLAlchemy
 markdown = Markdown
-cache = Cache(config={'CACHE_TYPE': 'base.utils.cache.datastore_cache'})
+cache = Cache(config={'CACHE_TYPE': 'base.utils.cache.tiered_cache'})
+csrf = CSRFProtect()
 sslify = SSLify
 debug_toolbar = DebugToolbarExtension
@@ -16,7 +16,7 @@ from wtforms.validators import ValidationError
 
 from base.utils.gcloud import query_item
 from base.constants import PRICES
-from base.views.api.api_strain import query_strains
+from base.views.api.api_strain import resolve_isotypes
 from base.utils.data_utils import is_number, list_duplicates
 from slugify import slugify
 from gcloud.exceptions import BadRequest
@@ -135,7 +135,7 @@ class TraitData(HiddenField):
 
         # Resolve isotypes and insert as second column
         try:
-            df = df.assign(ISOTYPE=[query_strains(x, resolve_isotype=True) for x in df.STRAIN])
+            df = df.assign(ISOTYPE=resolve_isotypes(df.STRAIN))
             isotype_col = df.pop("ISOTYPE")
             df.insert(1, "ISOTYPE", isotype_col)
             logger.info(df)
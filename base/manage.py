@@ -15,6 +15,7 @@ from base.utils.data_utils import zipdir
 from base.database import (initialize_sqlite_database,
                            download_sqlite_database)
 from base import constants
+from base.config import DATASET_RELEASE
 from subprocess import Popen, PIPE
 
 # Do not remove gunicorn import
@@ -38,6 +39,69 @@ def download_db():
     download_sqlite_database()
 
 
+@click.command(help="Build the impact index of a release VCF")
+@click.argument("release", default=DATASET_RELEASE)
+@click.option("--vcf", default=None, help="Local copy of the release VCF")
+def build_impact_index(release, vcf):
+    """
+        Writes the impact index used to filter variant queries by impact
+    """
+    from base.config import config
+    from base.utils import impact_index
+    from base.views.api.api_variant import get_vcf
+    vcf = vcf or get_vcf(release=release, filter_type="hard")
+    out_path = config["IMPACT_INDEX_PATH"].format(release=release)
+    click.secho(f"Indexing {vcf}", fg='green')
+    impact_index.build_impact_index(vcf, out_path)
+    click.secho(f"Wrote {out_path}", fg='green')
+
+
+@click.command(help="Build the genotype store of a release VCF")
+@click.argument("release", default=DATASET_RELEASE)
+@click.option("--vcf", default=None, help="Local copy of the release VCF")
+def build_genotype_store(release, vcf):
+    """
+        Writes the memory-mapped genotype store used by the variant
+        and popgen APIs when VARIANT_QUERY_ENGINE is 'store'
+    """
+    from base.config import config
+    from base.utils import genotype_store
+    from base.views.api.api_variant import get_vcf
+    vcf = vcf or get_vcf(release=release, filter_type="hard")
+    out_dir = config["GENOTYPE_STORE_PATH"].format(release=release)
+    click.secho(f"Converting {vcf}", fg='green')
+    genotype_store.build_genotype_store(vcf, out_dir, release)
+    click.secho(f"Wrote {out_dir}", fg='green')
+
+
+@click.command(help="Summarize the variants of each gene in a release VCF")
+@click.argument("release", default=DATASET_RELEASE)
+@click.option("--vcf", default=None, help="Local copy of the release VCF")
+def load_gene_variant_summary(release, vcf):
+    """
+        Replaces the gene_variant_summary rows of a release
+        in the configured database
+    """
+    from base.application import create_app
+    from base.database import load_gene_variant_summary as load_summary
+    app = create_app()
+    app.app_context().push()
+    load_summary(release, vcf)
+
+
+@click.command(help="Rebuild the site statistics summary")
+def compact_site_stats():
+    """
+        Rebuilds the site statistics summary from the
+        trait and user kinds in Google Datastore
+    """
+    from base.application import create_app
+    from base.utils.site_stats import compact_site_stats as compact
+    app = create_app()
+    app.app_context().push()
+    compact()
+
+
 @click.command(help="Update credentials")
 def update_credentials():
     """
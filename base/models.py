@@ -21,6 +21,22 @@ from base.config import DATASET_RELEASE
 
 db = SQLAlchemy()
 
+
+def db_version():
+    """
+        Returns the path, modification time and size of the SQLite
+        database file. These change whenever the database is rebuilt
+        or replaced; used to invalidate in-memory copies of tables.
+    """
+    path = db.engine.url.database
+    if not path or path == ":memory:":
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (path, stat.st_mtime_ns, stat.st_size)
+
 class datastore_model(object):
     """
         Base datastore model
@@ -392,12 +408,8 @@ class Strain(DictSerializable, db.Model):
 
     @classmethod
     def strain_sets(cls):
-        df = pd.read_sql_table(cls.__tablename__, db.engine)
-        result = df[['strain', 'isotype', 'strain_set']].dropna(how='any') \
-                                             .groupby('strain_set') \
-                                             .agg(list) \
-                                             .to_dict()
-        return result['strain']
+        from base.utils.strain_snapshot import get_strain_snapshot
+        return get_strain_snapshot().strain_sets
 
 
     def isotype_bam_url(self):
@@ -424,26 +436,15 @@ class Strain(DictSerializable, db.Model):
             Args:
                 df - the strain dataset
         """
-        df = pd.read_sql_table(cls.__tablename__, db.engine)
-        # Remove strains with issues
-        df = df[df["issues"] == False]
-        cumulative_isotype = df[['isotype', 'sampling_date']].sort_values(['sampling_date'], axis=0) \
-                                                             .drop_duplicates(['isotype']) \
-                                                             .groupby(['sampling_date'], as_index=True) \
-                                                             .count() \
-                                                             .cumsum() \
-                                                             .reset_index()
-        cumulative_isotype = cumulative_isotype.append({'sampling_date': np.datetime64(datetime.datetime.today().strftime("%Y-%m-%d")),
-                                                        'isotype': len(df['isotype'].unique())}, ignore_index=True)
-        cumulative_strain = df[['strain', 'sampling_date']].sort_values(['sampling_date'], axis=0) \
-                                                           .drop_duplicates(['strain']) \
-                                                           .dropna(how='any') \
-                                                           .groupby(['sampling_date']) \
-                                                           .count() \
-                                                           .cumsum() \
-                                                           .reset_index()
-        cumulative_strain = cumulative_strain.append({'sampling_date': np.datetime64(datetime.datetime.today().strftime("%Y-%m-%d")),
-                                                      'strain': len(df['strain'].unique())}, ignore_index=True)
+        from base.utils.strain_snapshot import get_strain_snapshot
+        snapshot = get_strain_snapshot()
+        today = np.datetime64(datetime.datetime.today().strftime("%Y-%m-%d"))
+        cumulative_isotype, n_isotypes = snapshot.cumulative_isotype
+        cumulative_isotype = cumulative_isotype.append({'sampling_date': today,
+                                                        'isotype': n_isotypes}, ignore_index=True)
+        cumulative_strain, n_strains = snapshot.cumulative_strain
+        cumulative_strain = cumulative_strain.append({'sampling_date': today,
+                                                      'strain': n_strains}, ignore_index=True)
         df = cumulative_isotype.set_index('sampling_date') \
                                .join(cumulative_strain.set_index('sampling_date')) \
                                .reset_index()
@@ -458,15 +459,48 @@ class Strain(DictSerializable, db.Model):
             Args:
                 release - the data release
         """
-        counts = {'strain_count': cls.query.filter((cls.release <= release) & (cls.issues == False)).count(),
-                  'strain_count_sequenced': cls.query.filter((cls.release <= release) & (cls.issues == False) & (cls.sequenced == True)).count(),
-                  'isotype_count': cls.query.filter((cls.release <= release) & (cls.issues == False) & (cls.isotype != None)).group_by(cls.isotype).count()}
-        return counts
+        from base.utils.strain_snapshot import get_strain_snapshot
+        return get_strain_snapshot().release_summary(release)
 
     def as_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+class StrainAlias(DictSerializable, db.Model):
+    """
+        Maps every name of a strain (its current name and its
+        previous names) to the strain and its isotype.
+    """
+    __tablename__ = "strain_alias"
+    id = db.Column(db.Integer, primary_key=True)
+    alias = db.Column(db.String(25), index=True, nullable=False)
+    strain = db.Column(db.ForeignKey('strain.strain'), nullable=False, index=True)
+    isotype = db.Column(db.String(25), nullable=True)
+    previous_name = db.Column(db.Boolean(), nullable=False)
+
+    @staticmethod
+    def from_strains(strains):
+        """
+            Returns alias records for strain records (dicts).
+        """
+        for record in strains:
+            yield {'alias': record['strain'],
+                   'strain': record['strain'],
+                   'isotype': record['isotype'],
+                   'previous_name': False}
+            if record.get('previous_names'):
+                for name in set(str(record['previous_names']).split(",")):
+                    name = name.strip()
+                    if name and name != record['strain']:
+                        yield {'alias': name,
+                               'strain': record['strain'],
+                               'isotype': record['isotype'],
+                               'previous_name': True}
+
+    def __repr__(self):
+        return f"{self.alias} -> {self.strain}"
+
+
 class WormbaseGene(DictSerializable, db.Model):
     __tablename__ = 'wormbase_gene'
     id = db.Column(db.Integer, primary_key=True)
@@ -528,6 +562,38 @@ class WormbaseGeneSummary(DictSerializable, db.Model):
             return result.gene_id
 
 
+class GeneVariantSummary(DictSerializable, db.Model):
+    """
+        Precomputed summary of the variants of each gene in a release
+        (see base/database/etl_gene_variants.py). Counts and variants
+        are stored as JSON.
+    """
+    __tablename__ = "gene_variant_summary"
+    __table_args__ = (db.Index('ix_gene_variant_summary_gene_release', 'gene_id', 'release', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    gene_id = db.Column(db.ForeignKey('wormbase_gene_summary.gene_id'), nullable=False)
+    release = db.Column(db.Integer(), nullable=False, index=True)
+    n_variants = db.Column(db.Integer(), nullable=False)
+    n_isotypes_high_moderate = db.Column(db.Integer(), nullable=False)
+    impact_counts = db.Column(db.String(), nullable=False)
+    biotype_counts = db.Column(db.String(), nullable=False)
+    top_variants = db.Column(db.String(), nullable=False)
+
+    def to_json(self):
+        result = self._asdict()
+        for key in ['impact_counts', 'biotype_counts', 'top_variants']:
+            result[key] = json.loads(result[key])
+        del result['id']
+        return result
+
+    @classmethod
+    def get(cls, gene_id, release=DATASET_RELEASE):
+        return cls.query.filter(cls.gene_id == gene_id, cls.release == int(release)).first()
+
+    def __repr__(self):
+        return f"{self.gene_id} [{self.release}]: {self.n_variants} variants"
+
+
 class Homologs(DictSerializable, db.Model):
     """
         The homologs database combines
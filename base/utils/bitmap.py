@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Bitmap indexes for faceted filtering.
+
+Each value of a facet is a bitset over the rows of a table (packed
+eight rows per byte). Filters are answered by OR-ing the bitsets of
+the selected values within a facet and AND-ing across facets; facet
+counts are population counts of the intersections.
+
+"""
+import numpy as np
+
+
+# Number of set bits in each byte value
+_POPCOUNT = np.array([bin(x).count("1") for x in range(256)], dtype=np.uint8)
+
+
+def popcount(bits):
+    """
+        Returns the number of set bits in a packed bitset
+    """
+    return int(_POPCOUNT[bits].sum(dtype=np.int64))
+
+
+class BitmapIndex(object):
+    """
+        Per-value bitsets of the facets of a table.
+
+        Args:
+            n - number of rows
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.facets = {}
+        self.everything = self.pack(np.ones(n, dtype=bool))
+
+    def pack(self, mask):
+        bits = np.packbits(mask)
+        bits.flags.writeable = False
+        return bits
+
+    def add_bitmap(self, facet, value, mask):
+        """
+            Adds the bitset of rows (a boolean mask) having a facet value
+        """
+        self.facets.setdefault(facet, {})[value] = self.pack(mask)
+
+    def add_column(self, facet, column):
+        """
+            Adds bitsets for each distinct value of a column;
+            None values are not indexed.
+        """
+        column = np.asarray(column, dtype=object)
+        for value in sorted({x for x in column if x is not None}):
+            self.add_bitmap(facet, value, column == value)
+
+    def select(self, facet, values):
+        """
+            Returns the rows having any of the values of a facet
+        """
+        bits = np.zeros_like(self.everything)
+        for value in values:
+            value_bits = self.facets[facet].get(value)
+            if value_bits is not None:
+                bits = bits | value_bits
+        return bits
+
+    def query(self, selections, bits=None):
+        """
+            Returns the rows matching all selections.
+
+            Args:
+                selections - dict of facet: list of values
+                bits - optional bitset to intersect with
+        """
+        result = self.everything if bits is None else bits
+        for facet, values in selections.items():
+            result = result & self.select(facet, values)
+        return result
+
+    def counts(self, selections, bits=None):
+        """
+            Returns the number of matching rows for each value of
+            each facet. A facet's own selection is not applied to
+            its counts, so that other values can be added to it.
+        """
+        counts = {}
+        for facet, value_bits in self.facets.items():
+            others = {k: v for k, v in selections.items() if k != facet}
+            base = self.query(others, bits)
+            counts[facet] = {value: popcount(base & x) for value, x in value_bits.items()}
+        return counts
+
+    def rows(self, bits):
+        """
+            Returns the indices of the rows in a bitset
+        """
+        return np.flatnonzero(np.unpackbits(bits)[:self.n])
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+On-disk block cache for remote files.
+
+Release VCFs, tabix indices and BED files are read over HTTP with
+range requests. BlockCache stores the fetched byte ranges as fixed-size
+blocks on local disk, keyed by (url, block offset), and evicts the least
+recently used blocks once the cache exceeds its byte budget. Blocks are
+tied to the ETag of the remote file; when the ETag changes, the cached
+blocks of the file are dropped. When a server ignores range requests,
+the file is downloaded once and all of its blocks are cached.
+
+htslib (cyvcf2, tabix, pytabix) reads remote files itself, so the cache
+is exposed to it through BlockCacheProxy, an HTTP server on localhost
+that answers range requests from the cache. The proxy runs in its own
+process, shared by the workers of a host (see cached_url):
+
+    cached_url("http://storage.googleapis.com/elegansvariation.org/...vcf.gz")
+    --> "http://127.0.0.1:<port>/http/storage.googleapis.com/elegansvariation.org/...vcf.gz"
+
+The proxy only reads files of allowed hosts (BLOCK_CACHE_ALLOWED_HOSTS),
+answers health checks on /_health, and stops when the worker that
+started it exits; the next worker that needs it starts a new one.
+
+Index files are requested by appending to the url (.tbi, .csi), and
+are cached in the same way.
+
+"""
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import socket
+import argparse
+import hashlib
+import threading
+import requests
+import urllib.request
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from subprocess import Popen
+from urllib.parse import urlsplit
+from logzero import logger
+
+
+class BlockCacheError(Exception):
+    """
+        Raised when a remote file cannot be read; status is the
+        HTTP status returned by the remote server.
+    """
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+class BlockCache(object):
+    """
+        An LRU cache of fixed-size blocks of remote files.
+
+        Args:
+            cache_dir - directory holding cached blocks
+            max_bytes - byte budget of the cache
+            block_size - size of cached blocks (bytes)
+            validate_seconds - how long the ETag of a file is trusted
+                               before it is checked again
+            timeout - timeout of requests to the remote server (seconds)
+    """
+
+    def __init__(self, cache_dir, max_bytes, block_size=256 * 1024, validate_seconds=300, timeout=30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.validate_seconds = validate_seconds
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        # url --> {'etag', 'size', 'key', 'checked'}
+        self._files = {}
+        # block filename --> size, least recently used first
+        self._blocks = OrderedDict()
+        self._size = 0
+        self._counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'whole_file_reads': 0}
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """
+            Adds blocks left on disk by earlier processes, oldest first
+        """
+        blocks = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, fname))
+            except FileNotFoundError:
+                continue
+            blocks.append((st.st_mtime, fname, st.st_size))
+        for mtime, fname, size in sorted(blocks):
+            self._blocks[fname] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    def _count(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    @staticmethod
+    def _file_key(url, etag):
+        url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()[0:16]
+        etag_hash = hashlib.sha1(etag.encode('utf-8')).hexdigest()[0:8]
+        return f"{url_hash}-{etag_hash}"
+
+    def stat(self, url):
+        """
+            Returns the ETag and size of a remote file.
+
+            The ETag is checked with a HEAD request at most once every
+            validate_seconds; when it has changed, cached blocks of the
+            file are removed.
+        """
+        now = time.time()
+        with self._lock:
+            info = self._files.get(url)
+        if info and now - info['checked'] < self.validate_seconds:
+            return info['etag'], info['size']
+        try:
+            response = self._session.head(url, timeout=self.timeout, allow_redirects=True)
+        except requests.RequestException as e:
+            raise BlockCacheError(f"{url}: {e}")
+        if response.status_code != 200:
+            raise BlockCacheError(f"{url}: HTTP {response.status_code}", status=response.status_code)
+        size = int(response.headers['Content-Length'])
+        # Fall back to Last-Modified and size for servers that do not set ETags
+        etag = response.headers.get('ETag') or f"{response.headers.get('Last-Modified')}:{size}"
+        key = self._file_key(url, etag)
+        with self._lock:
+            if info and info['key'] != key:
+                self._invalidate(info['key'])
+            self._files[url] = {'etag': etag, 'size': size, 'key': key, 'checked': now}
+        return etag, size
+
+    def _invalidate(self, key):
+        logger.info(f"Block cache: remote file changed; dropping {key}")
+        self._counts['invalidations'] += 1
+        for fname in [x for x in self._blocks if x.startswith(key + ".")]:
+            self._remove(fname)
+
+    def _remove(self, fname):
+        self._size -= self._blocks.pop(fname)
+        try:
+            os.remove(os.path.join(self.cache_dir, fname))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._blocks:
+            fname = next(iter(self._blocks))
+            self._remove(fname)
+            self._counts['evictions'] += 1
+
+    def _fetch(self, url, etag, start, end):
+        """
+            Returns the bytes start..end (inclusive) of a remote file, or
+            the whole file when the server ignores the range, and whether
+            the whole file was returned
+        """
+        headers = {'Range': f"bytes={start}-{end}"}
+        try:
+            response = self._session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise BlockCacheError(f"{url}: {e}")
+        if response.status_code not in (200, 206):
+            raise BlockCacheError(f"{url}: HTTP {response.status_code}", status=response.status_code)
+        response_etag = response.headers.get('ETag')
+        if response_etag and response_etag != etag:
+            # The file changed since it was last validated; the
+            # next stat drops its cached blocks.
+            with self._lock:
+                if url in self._files:
+                    self._files[url]['checked'] = 0
+            raise BlockCacheError(f"{url}: changed while reading", status=409)
+        return response.content, response.status_code == 200
+
+    def block(self, url, n):
+        """
+            Returns block n of a remote file
+        """
+        etag, size = self.stat(url)
+        fname = f"{self._file_key(url, etag)}.{n}"
+        path = os.path.join(self.cache_dir, fname)
+        with self._lock:
+            cached = fname in self._blocks
+            if cached:
+                self._blocks.move_to_end(fname)
+        if cached:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self._count('hits')
+                return data
+            except FileNotFoundError:
+                # Removed by another process sharing the cache directory
+                with self._lock:
+                    if fname in self._blocks:
+                        self._size -= self._blocks.pop(fname)
+        self._count('misses')
+        start = n * self.block_size
+        end = min(start + self.block_size, size) - 1
+        data, whole_file = self._fetch(url, etag, start, end)
+        if whole_file:
+            # The server does not support ranges; every block of the file
+            # is cached from this download rather than downloading the
+            # file again for each block.
+            if len(data) != size:
+                raise BlockCacheError(f"{url}: expected {size} bytes, received {len(data)}")
+            self._count('whole_file_reads')
+            file_key = self._file_key(url, etag)
+            for m in range((size + self.block_size - 1) // self.block_size):
+                if m != n:
+                    self._store(f"{file_key}.{m}", data[m * self.block_size:(m + 1) * self.block_size])
+            data = data[start:end + 1]
+        self._store(fname, data)
+        return data
+
+    def _store(self, fname, data):
+        path = os.path.join(self.cache_dir, fname)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if fname not in self._blocks:
+                self._blocks[fname] = len(data)
+                self._size += len(data)
+            else:
+                self._blocks.move_to_end(fname)
+            self._evict()
+
+    def iter_range(self, url, start, end):
+        """
+            Yields the bytes start..end (inclusive) of a remote file, block by block
+        """
+        for n in range(start // self.block_size, end // self.block_size + 1):
+            data = self.block(url, n)
+            offset = n * self.block_size
+            yield data[max(start - offset, 0):end - offset + 1]
+
+    def read(self, url, start, length):
+        """
+            Returns length bytes of a remote file starting at start
+        """
+        etag, size = self.stat(url)
+        end = min(start + length, size) - 1
+        if end < start:
+            return b''
+        return b''.join(self.iter_range(url, start, end))
+
+    def stats(self):
+        """
+            Returns cache counters and the number of bytes cached
+        """
+        with self._lock:
+            return dict(self._counts,
+                        blocks=len(self._blocks),
+                        bytes=self._size,
+                        max_bytes=self.max_bytes)
+
+
+# Remote hosts the proxy reads from
+ALLOWED_HOSTS = ("storage.googleapis.com",)
+
+# Health check path and the service name it returns
+HEALTH_PATH = "/_health"
+SERVICE_NAME = "cendr-block-cache"
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    """
+        Serves /<scheme>/<host>/<path> from the block cache of the server;
+        only http(s) urls of allowed hosts are read.
+    """
+    range_re = re.compile(r"bytes=(\d*)-(\d*)$")
+
+    def _upstream_url(self):
+        scheme, _, rest = self.path.lstrip("/").partition("/")
+        return f"{scheme}://{rest}"
+
+    def _health(self, send_body):
+        body = json.dumps(dict(self.server.block_cache.stats(), service=SERVICE_NAME)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _byte_range(self, size):
+        """
+            Returns the (start, end, status) of the Range header for a file
+            of size bytes; the status is 416 when the range is unsatisfiable.
+        """
+        byte_range = self.range_re.match(self.headers.get('Range', ''))
+        if not byte_range or not any(byte_range.groups()):
+            return 0, size - 1, 200
+        first, last = byte_range.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix range - the last n bytes
+            start, end = max(size - int(last), 0), size - 1
+        # Covers first > last, ranges starting past the end and empty suffixes
+        if end < start:
+            return start, end, 416
+        return start, end, 206
+
+    def _respond(self, send_body):
+        if self.path == HEALTH_PATH:
+            self._health(send_body)
+            return
+        url = self._upstream_url()
+        if not allowed_url(url, self.server.allowed_hosts):
+            self.send_error(403, "Host not allowed")
+            return
+        try:
+            etag, size = self.server.block_cache.stat(url)
+        except BlockCacheError as e:
+            self.send_error(e.status if e.status == 404 else 502, str(e))
+            return
+        start, end, status = self._byte_range(size)
+        if status == 416:
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{size}")
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if send_body and end >= start:
+            self._send_range(url, start, end)
+
+    def _send_range(self, url, start, end):
+        # Readers often request open-ended ranges and close the connection
+        # once they have what they need; blocks are fetched as they are sent.
+        try:
+            for data in self.server.block_cache.iter_range(url, start, end):
+                self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except BlockCacheError as e:
+            logger.error(e)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def log_message(self, format, *args):
+        logger.debug("Block cache proxy: " + format % args)
+
+
+class BlockCacheProxy(object):
+    """
+        Serves remote files from a BlockCache over HTTP on localhost.
+
+        Args:
+            block_cache - a BlockCache
+            port - port to listen on; 0 picks a free port
+            allowed_hosts - remote hosts that may be read
+    """
+
+    def __init__(self, block_cache, port=0, allowed_hosts=ALLOWED_HOSTS):
+        self.block_cache = block_cache
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _ProxyHandler)
+        self._server.daemon_threads = True
+        self._server.block_cache = block_cache
+        self._server.allowed_hosts = tuple(allowed_hosts)
+
+    def start(self):
+        """
+            Serves requests from a background thread
+        """
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def serve_forever(self, parent_pid=None):
+        """
+            Serves requests; when parent_pid is given, the proxy stops
+            once that process exits.
+        """
+        if parent_pid:
+            def watch_parent():
+                while os.getppid() == parent_pid:
+                    time.sleep(5)
+                logger.info("Block cache proxy: parent process exited; stopping")
+                self._server.shutdown()
+            threading.Thread(target=watch_parent, daemon=True).start()
+        logger.info(f"Block cache proxy listening on port {self.port}")
+        self._server.serve_forever()
+        self._server.server_close()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def url(self, url):
+        """
+            Returns the proxy url of a remote url
+        """
+        return proxy_url(url, self.port)
+
+
+def proxy_url(url, port):
+    parts = urlsplit(url)
+    path = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    return f"http://127.0.0.1:{port}/{parts.scheme}/{parts.netloc}{path}"
+
+
+def allowed_url(url, allowed_hosts):
+    parts = urlsplit(url)
+    return parts.scheme in ("http", "https") and parts.hostname in allowed_hosts
+
+
+def _listening(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def _healthy(port):
+    """
+        Returns True if the block cache proxy is serving on port
+    """
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{HEALTH_PATH}", timeout=1) as response:
+            return json.loads(response.read()).get('service') == SERVICE_NAME
+    except (OSError, ValueError):
+        return False
+
+
+# Seconds a successful health check is trusted
+HEALTH_CHECK_SECONDS = 30
+
+_proxy_lock = threading.Lock()
+_proxy = {'checked': 0}
+
+
+def _start_proxy(port, config):
+    """
+        Starts the proxy as a child process. A thread waits on the child
+        so that it is reaped when it exits; the child stops when this
+        process exits (see serve_forever), and another worker then
+        starts a new one.
+    """
+    logger.info(f"Starting block cache proxy on port {port}")
+    command = [sys.executable, "-m", "base.utils.block_cache",
+               "--port", str(port),
+               "--cache-dir", config["BLOCK_CACHE_DIR"],
+               "--max-bytes", str(config["BLOCK_CACHE_MAX_BYTES"]),
+               "--block-size", str(config["BLOCK_CACHE_BLOCK_SIZE"]),
+               "--validate-seconds", str(config["BLOCK_CACHE_VALIDATE_SECONDS"]),
+               "--parent-pid", str(os.getpid())]
+    for host in config["BLOCK_CACHE_ALLOWED_HOSTS"]:
+        command += ["--allowed-host", host]
+    process = Popen(command)
+    threading.Thread(target=process.wait, daemon=True).start()
+    atexit.register(process.terminate)
+    return process
+
+
+def cached_url(url):
+    """
+        Returns a url reading a remote file through the block cache.
+
+        htslib holds the GIL while it reads, so the proxy runs as a
+        separate process shared by the workers of a host. It is started
+        by the first worker that needs it. Local paths are returned
+        unchanged, as are urls of hosts that are not allowed and urls
+        when the block cache is disabled or cannot be started.
+    """
+    from base.config import config
+    if not config["BLOCK_CACHE_ENABLED"] or not allowed_url(url, config["BLOCK_CACHE_ALLOWED_HOSTS"]):
+        return url
+    port = config["BLOCK_CACHE_PORT"]
+    with _proxy_lock:
+        if time.time() - _proxy['checked'] < HEALTH_CHECK_SECONDS:
+            return proxy_url(url, port)
+        if not _healthy(port):
+            if _listening(port):
+                logger.error(f"Port {port} is not served by the block cache proxy; reading remote files directly")
+                return url
+            _start_proxy(port, config)
+            for attempt in range(50):
+                time.sleep(0.1)
+                # A proxy started by another worker at the same time is used
+                if _healthy(port):
+                    break
+            else:
+                logger.error("Block cache proxy did not start; reading remote files directly")
+                return url
+        _proxy['checked'] = time.time()
+    return proxy_url(url, port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve remote files through an on-disk block cache")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--cache-dir", required=True)
+    parser.add_argument("--max-bytes", type=int, required=True)
+    parser.add_argument("--block-size", type=int, default=256 * 1024)
+    parser.add_argument("--validate-seconds", type=int, default=300)
+    parser.add_argument("--allowed-host", action="append", dest="allowed_hosts")
+    parser.add_argument("--parent-pid", type=int, default=None,
+                        help="Stop when this process exits")
+    args = parser.parse_args()
+    block_cache = BlockCache(args.cache_dir,
+                             args.max_bytes,
+                             block_size=args.block_size,
+                             validate_seconds=args.validate_seconds)
+    try:
+        proxy = BlockCacheProxy(block_cache,
+                                port=args.port,
+                                allowed_hosts=args.allowed_hosts or ALLOWED_HOSTS)
+    except OSError:
+        # Another worker started the proxy first
+        sys.exit(0)
+    proxy.serve_forever(parent_pid=args.parent_pid)
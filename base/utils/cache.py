@@ -3,67 +3,676 @@
 """
 Author: Daniel E. Cook
 
-These functions will concern genetic data.
+Flask-Caching backends.
+
+TieredCache keeps a per-process LRU (L1) in front of the shared
+Google Datastore cache (L2). Reads are served from L1 when possible;
+L2 hits are promoted to L1. Writes go to both tiers.
+
+L1 entries hold pickled values, so callers never share (and mutate)
+a cached object; L2 entries hold zlib-compressed pickles. Multi-key
+operations (get_many, set_many, warm_cache) read and write L2 in
+batches of keys rather than one request per key.
+
+stale_while_revalidate caches expensive functions that should never
+be recomputed by many requests at once (see its docstring).
 
 """
+import zlib
+import uuid
 import pickle
 import base64
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
 from cachelib import BaseCache
-from base.utils.gcloud import get_item, store_item
-from time import time
+from flask import current_app, request, has_request_context
+from logzero import logger
+from base.utils.gcloud import (get_item, get_items, store_item, store_items, delete_key,
+                               acquire_lease, release_lease)
+from time import time, sleep
 from base.config import config
 
 
+class LRUCache(BaseCache):
+    """
+        A size-bounded in-process LRU cache with expiry.
+
+        Args:
+            max_bytes - byte budget of the pickled values
+            max_ttl - entries are kept at most this many seconds
+                      (0 for no limit)
+    """
+
+    def __init__(self, max_bytes=64 * 1024 ** 2, max_ttl=300, default_timeout=500):
+        BaseCache.__init__(self, default_timeout)
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self._lock = threading.Lock()
+        # key --> (payload, expires), least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _expires(self, timeout):
+        """
+            Returns the expiry time of an entry set with timeout;
+            0 never expires.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        if self.max_ttl and (timeout == 0 or timeout > self.max_ttl):
+            timeout = self.max_ttl
+        return time() + timeout if timeout else 0
+
+    def _remove(self, key):
+        payload, expires = self._entries.pop(key)
+        self._size -= len(payload)
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self._counts['evictions'] += 1
+
+    def get_payload(self, key):
+        """
+            Returns the pickled value of a key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] and entry[1] <= time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._counts['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counts['hits'] += 1
+            return entry[0]
+
+    def set_payload(self, key, payload, expires):
+        """
+            Stores a pickled value until expires (0 for no expiry);
+            the expiry is capped at max_ttl.
+        """
+        max_expires = self._expires(0)
+        if max_expires and (expires == 0 or expires > max_expires):
+            expires = max_expires
+        if len(payload) > self.max_bytes:
+            self.delete(key)
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (payload, expires)
+            self._size += len(payload)
+            self._evict()
+        return True
+
+    def get(self, key):
+        payload = self.get_payload(key)
+        if payload is not None:
+            return pickle.loads(payload)
+
+    def set(self, key, value, timeout=None):
+        return self.set_payload(key,
+                                pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                self._expires(timeout))
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def has(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[1] == 0 or entry[1] > time())
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                return True
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        return True
+
+    def stats(self):
+        """
+            Returns hit/miss counters and the number of bytes cached
+        """
+        with self._lock:
+            return dict(self._counts,
+                        entries=len(self._entries),
+                        bytes=self._size,
+                        max_bytes=self.max_bytes)
+
+
 class DatastoreCache(BaseCache):
+    """
+        Cache entries stored in Google Datastore (kind 'cache').
+
+        Values are stored as zlib-compressed pickles; entries written
+        before compression was added (base64 pickles) are still read.
+    """
+    UNINDEXED = ['value', 'encoding', 'expires']
+
     def __init__(self, default_timeout=500):
         BaseCache.__init__(self, default_timeout)
         self.key_prefix = config["CENDR_VERSION"]
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'misses': 0, 'errors': 0}
 
-    def set(self, key, value, timeout=None):
-        expires = time() + timeout
+    def _count(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    def _key(self, key):
+        return self.key_prefix + "/" + key
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time() + timeout if timeout else 0
+
+    @staticmethod
+    def encode(payload):
+        return zlib.compress(payload)
+
+    @staticmethod
+    def decode(item):
+        """
+            Returns the pickled value of a cache entity
+        """
+        value = item.get('value')
+        if item.get('encoding') == 'zlib':
+            return zlib.decompress(value)
+        return base64.b64decode(value)
+
+    def _entry(self, item):
+        """
+            Returns the pickled value and expiry time of a cache entity,
+            or None when it is missing or expired.
+        """
+        if item is None or item.get('value') is None:
+            self._count('misses')
+            return None
+        # Falsy properties are dropped by get_item; expires=0 never expires
+        expires = item.get('expires', 0)
+        if expires and expires <= time():
+            self._count('misses')
+            return None
+        try:
+            payload = self.decode(item)
+        except Exception:
+            self._count('errors')
+            return None
+        self._count('hits')
+        return payload, expires
+
+    def get_payload(self, key):
+        """
+            Returns the pickled value and expiry time of a key,
+            or (None, None) when it is missing or expired.
+        """
         try:
-            value = base64.b64encode(pickle.dumps(value))
-            store_item('cache', self.key_prefix + "/" + key, value=value, expires=expires, exclude_from_indexes=['value', 'expires'])
+            item = get_item('cache', self._key(key))
+        except Exception:
+            self._count('errors')
+            return None, None
+        return self._entry(item) or (None, None)
+
+    def get_payloads(self, keys):
+        """
+            Returns a dict of key: (pickled value, expiry time) of the
+            keys found, fetched with one Datastore request per 1000 keys
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            items = get_items('cache', [self._key(key) for key in keys])
+        except Exception:
+            self._count('errors')
+            return {}
+        entries = {}
+        for key in keys:
+            entry = self._entry(items.get(self._key(key)))
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    def _properties(self, payload, expires):
+        return {'value': self.encode(payload),
+                'encoding': 'zlib',
+                'expires': expires}
+
+    def set_payload(self, key, payload, expires):
+        try:
+            store_item('cache',
+                       self._key(key),
+                       exclude_from_indexes=self.UNINDEXED,
+                       **self._properties(payload, expires))
             return True
-        except:
+        except Exception:
+            self._count('errors')
             return False
 
-    def get(self, key):
+    def set_payloads(self, entries):
+        """
+            Stores a dict of key: (pickled value, expiry time) with one
+            Datastore request per 500 keys
+        """
+        if not entries:
+            return True
         try:
-            item = get_item('cache', self.key_prefix + "/" + key)
-            value = item.get('value')
-            value = pickle.loads(base64.b64decode(value))
-            expires = item.get('expires')
-            if expires == 0 or expires > time():
-                return value
-        except AttributeError:
-            return None
+            store_items('cache',
+                        {self._key(key): self._properties(payload, expires)
+                         for key, (payload, expires) in entries.items()},
+                        exclude_from_indexes=self.UNINDEXED)
+            return True
+        except Exception:
+            self._count('errors')
+            return False
+
+    def set(self, key, value, timeout=None):
+        return self.set_payload(key,
+                                pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                self._expires(timeout))
+
+    def get(self, key):
+        payload, expires = self.get_payload(key)
+        if payload is not None:
+            return pickle.loads(payload)
 
     def get_many(self, *keys):
-        return [self.get(key) for key in keys]
+        entries = self.get_payloads(keys)
+        return [pickle.loads(entries[key][0]) if key in entries else None for key in keys]
 
     def get_dict(self, *keys):
-        results = {}
-        for key in keys:
-            try:
-                results.update({key: get_item('cache', key)})
-            except AttributeError:
-                pass
-        return results
+        return dict(zip(keys, self.get_many(*keys)))
 
     def has(self, key):
+        payload, expires = self.get_payload(key)
+        return payload is not None
+
+    def set_many(self, mapping, timeout=None):
+        expires = self._expires(timeout)
+        return self.set_payloads({k: (pickle.dumps(v, pickle.HIGHEST_PROTOCOL), expires)
+                                  for k, v in mapping.items()})
+
+    def delete(self, key):
         try:
-            item = get_item('cache', key)
-            expires = item.get('expires')
-            if expires == 0 or expires > time():
-                return True
-        except:
+            delete_key('cache', self._key(key))
+            return True
+        except Exception:
+            self._count('errors')
+            return False
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class TieredCache(BaseCache):
+    """
+        An in-process LRU (L1) in front of the Datastore cache (L2).
+
+        Args:
+            l1_max_bytes - byte budget of the L1 cache
+            l1_ttl - entries are kept in L1 at most this many seconds;
+                     other workers may update L2 in the meantime.
+    """
+
+    def __init__(self, default_timeout=500, l1_max_bytes=64 * 1024 ** 2, l1_ttl=300):
+        BaseCache.__init__(self, default_timeout)
+        self.l1 = LRUCache(max_bytes=l1_max_bytes, max_ttl=l1_ttl, default_timeout=default_timeout)
+        self.l2 = DatastoreCache(default_timeout=default_timeout)
+
+    def _expires(self, timeout):
+        return self.l2._expires(timeout)
+
+    def get(self, key):
+        payload = self.l1.get_payload(key)
+        if payload is None:
+            payload, expires = self.l2.get_payload(key)
+            if payload is None:
+                return None
+            # Promote to L1
+            self.l1.set_payload(key, payload, expires)
+        return pickle.loads(payload)
+
+    def get_payloads(self, keys):
+        """
+            Returns a dict of key: pickled value of the keys found.
+            Keys missing from L1 are fetched from L2 with one request
+            and promoted.
+        """
+        payloads = {}
+        for key in keys:
+            payload = self.l1.get_payload(key)
+            if payload is not None:
+                payloads[key] = payload
+        missing = [key for key in keys if key not in payloads]
+        for key, (payload, expires) in self.l2.get_payloads(missing).items():
+            self.l1.set_payload(key, payload, expires)
+            payloads[key] = payload
+        return payloads
+
+    def get_many(self, *keys):
+        payloads = self.get_payloads(keys)
+        return [pickle.loads(payloads[key]) if key in payloads else None for key in keys]
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def set(self, key, value, timeout=None):
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self._expires(timeout)
+        self.l1.set_payload(key, payload, expires)
+        return self.l2.set_payload(key, payload, expires)
+
+    def set_many(self, mapping, timeout=None):
+        expires = self._expires(timeout)
+        entries = {}
+        for key, value in mapping.items():
+            entries[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+            self.l1.set_payload(key, entries[key][0], expires)
+        return self.l2.set_payloads(entries)
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
             return False
+        return self.set(key, value, timeout)
+
+    def has(self, key):
+        return self.l1.has(key) or self.l2.has(key)
+
+    def delete(self, key):
+        self.l1.delete(key)
+        return self.l2.delete(key)
+
+    def delete_many(self, *keys):
+        return all([self.delete(key) for key in keys])
+
+    def clear(self):
+        # Datastore entries are only invalidated by CENDR_VERSION (key prefix)
+        return self.l1.clear()
+
+    def stats(self):
+        """
+            Returns hit/miss counters of each tier for this worker
+        """
+        return {'l1': self.l1.stats(),
+                'l2': self.l2.stats()}
+
+
+def warm_cache(calls):
+    """
+        Returns the results of many cached or memoized function calls
+        using one cache lookup. Results missing from the cache are
+        computed and stored with one write per timeout.
+
+        Args:
+            calls - list of functions decorated with cache.cached,
+                    cache.memoize or stale_while_revalidate, or
+                    (function, args, kwargs) tuples
+
+        Returns:
+            list of results
+    """
+    from base.extensions import cache
+    calls = [x if isinstance(x, tuple) else (x, (), {}) for x in calls]
+    keys = []
+    for f, args, kwargs in calls:
+        if hasattr(f, 'delete_memoized'):
+            keys.append(f.make_cache_key(f.uncached, *args, **kwargs))
+        else:
+            keys.append(f.make_cache_key(*args, **kwargs))
+    results = cache.cache.get_many(*keys)
+    computed = {}
+    for n, (f, args, kwargs) in enumerate(calls):
+        if hasattr(f, 'resolve'):
+            results[n] = f.resolve(keys[n], results[n], args, kwargs)
+        elif results[n] is None:
+            results[n] = f.uncached(*args, **kwargs)
+            computed.setdefault(f.cache_timeout, {})[keys[n]] = results[n]
+    for timeout, mapping in computed.items():
+        cache.cache.set_many(mapping, timeout=timeout)
+    return results
+
+
+class _Flight(object):
+    """
+        A computation of a cache entry in this process
+    """
+    def __init__(self):
+        self.done = threading.Event()
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _run_in_context(fn):
+    """
+        Runs fn in a background thread with a copy of the current
+        request (or application) context; g is not shared.
+    """
+    app = current_app._get_current_object()
+    if has_request_context():
+        ctx = app.test_request_context(request.path,
+                                       base_url=request.host_url,
+                                       query_string=request.query_string)
+    else:
+        ctx = app.app_context()
 
-    def set_many(self, mapping, timeout):
-        for k, v in mapping.items():
-            store_item('cache', k, value=v)
+    def run():
+        with ctx:
+            fn()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def stale_while_revalidate(timeout, stale_timeout=None, lease_timeout=120, wait_timeout=5, key_prefix=None):
+    """
+        Caches the results of an expensive function.
+
+        A result is fresh for timeout seconds and is then served stale
+        for up to stale_timeout seconds while one background thread
+        recomputes it. Concurrent misses are coalesced onto a single
+        computation: within a process by waiting on it, and across
+        instances with a Datastore lease. Callers wait at most
+        wait_timeout seconds for another computation before computing
+        the result themselves; they do not wait when the lease cannot
+        be read.
+
+        Results are shared by all users; decorate data functions rather
+        than views rendering per-session content (e.g. CSRF tokens).
+
+        Args:
+            timeout - seconds a result is fresh
+            stale_timeout - seconds a result is served stale
+                            (defaults to timeout)
+            lease_timeout - seconds a computation may take
+            wait_timeout - seconds a miss waits for another computation
+            key_prefix - cache key; defaults to the function name.
+                         Arguments are hashed into the key.
+    """
+    if stale_timeout is None:
+        stale_timeout = timeout
+
+    def decorator(f):
+        spec = _Revalidated(f,
+                            name=key_prefix or f"{f.__module__}.{f.__qualname__}",
+                            timeout=timeout,
+                            stale_timeout=stale_timeout,
+                            lease_timeout=lease_timeout,
+                            wait_timeout=wait_timeout)
+
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            from base.extensions import cache
+            key = spec.make_cache_key(*args, **kwargs)
+            return _resolve(spec, key, cache.get(key), args, kwargs)
+
+        decorated_function.uncached = f
+        decorated_function.cache_timeout = timeout + stale_timeout
+        decorated_function.make_cache_key = spec.make_cache_key
+        decorated_function.resolve = functools.partial(_resolve, spec)
+        return decorated_function
+    return decorator
+
+
+class _Revalidated(object):
+    """
+        A function decorated with stale_while_revalidate
+    """
+    def __init__(self, f, name, timeout, stale_timeout, lease_timeout, wait_timeout):
+        self.f = f
+        self.name = name
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.lease_timeout = lease_timeout
+        self.wait_timeout = wait_timeout
+
+    def make_cache_key(self, *args, **kwargs):
+        key = "swr/" + self.name
+        if args or kwargs:
+            key += "/" + hashlib.md5(repr((args, sorted(kwargs.items()))).encode()).hexdigest()
+        return key
+
+
+def _resolve(spec, key, entry, args, kwargs):
+    """
+        Returns the value of a cache entry (fresh or stale),
+        computing or refreshing it as needed
+    """
+    if entry is not None and entry['fresh_until'] > time():
+        return entry['value']
+    flight, leader = _take_off(key)
+    if entry is not None:
+        return _resolve_stale(spec, key, entry, args, kwargs, flight, leader)
+    if leader:
+        return _resolve_miss(spec, key, args, kwargs, flight)
+    return _wait_for_flight(spec, key, args, kwargs, flight)
+
+
+def _compute(spec, key, args, kwargs):
+    from base.extensions import cache
+    value = spec.f(*args, **kwargs)
+    cache.set(key,
+              {'value': value, 'fresh_until': time() + spec.timeout},
+              timeout=spec.timeout + spec.stale_timeout)
+    return value
+
+
+def _refresh(spec, key, args, kwargs, flight, owner):
+    try:
+        _compute(spec, key, args, kwargs)
+    except Exception:
+        logger.exception(f"Refreshing {key} failed")
+    finally:
+        release_lease(key, owner)
+        _land(key, flight)
+
+
+def _resolve_stale(spec, key, entry, args, kwargs, flight, leader):
+    """
+        Returns a stale value; the first thread of the process starts
+        a refresh unless another instance holds the lease
+    """
+    if leader:
+        owner = uuid.uuid4().hex
+        if acquire_lease(key, spec.lease_timeout, owner) is False:
+            _land(key, flight)
+        else:
+            _run_in_context(lambda: _refresh(spec, key, args, kwargs, flight, owner))
+    return entry['value']
+
+
+def _resolve_miss(spec, key, args, kwargs, flight):
+    """
+        Computes a missing entry, first waiting briefly for
+        another instance holding the lease
+    """
+    owner = uuid.uuid4().hex
+    try:
+        if acquire_lease(key, spec.lease_timeout, owner) is False:
+            entry = _wait_for_instance(spec, key, owner)
+            if entry is not None:
+                return entry['value']
+        return _compute(spec, key, args, kwargs)
+    finally:
+        release_lease(key, owner)
+        _land(key, flight)
+
+
+def _wait_for_flight(spec, key, args, kwargs, flight):
+    """
+        Waits briefly for the computation of a missing entry
+        by another thread of the process
+    """
+    from base.extensions import cache
+    flight.done.wait(spec.wait_timeout)
+    entry = cache.get(key)
+    if entry is not None:
+        return entry['value']
+    return spec.f(*args, **kwargs)
+
+
+def _wait_for_instance(spec, key, owner):
+    """
+        Waits up to wait_timeout seconds for another instance holding
+        the lease to cache the result. Returns the cache entry, or None
+        when the caller should compute it: the lease was released, could
+        not be read, or the wait timed out.
+    """
+    from base.extensions import cache
+    deadline = time() + spec.wait_timeout
+    while time() < deadline:
+        sleep(min(0.5, max(deadline - time(), 0)))
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+        if acquire_lease(key, spec.lease_timeout, owner) is not False:
+            return None
+    logger.warning(f"Timed out waiting for {key}; computing it")
+    return None
+
+
+def _take_off(key):
+    """
+        Returns the computation of a key in this process and whether
+        the caller started it (and must land it)
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _flights[key] = _Flight()
+        return flight, True
+
+
+def _land(key, flight):
+    with _flights_lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+    flight.done.set()
 
 
 def datastore_cache(app, config, args, kwargs):
     return DatastoreCache(*args, **kwargs)
+
+
+def tiered_cache(app, config, args, kwargs):
+    kwargs.update(l1_max_bytes=config.get('CACHE_L1_MAX_BYTES', 64 * 1024 ** 2),
+                  l1_ttl=config.get('CACHE_L1_TTL', 300))
+    return TieredCache(*args, **kwargs)
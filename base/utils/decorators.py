@@ -18,6 +18,10 @@ def jsonify_request(func):
         if request:
             is_tsv = request.args.get('output') == 'tsv'
             if request.endpoint.endswith(func.__name__) and not is_tsv:
-                return jsonify(func(*args, **kwargs))
+                result = func(*args, **kwargs)
+                if isinstance(result, tuple):
+                    # (result, status_code)
+                    return jsonify(result[0]), result[1]
+                return jsonify(result)
         return func(*args, **kwargs)
     return jsonify_the_request
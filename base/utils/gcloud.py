@@ -1,4 +1,5 @@
 import json
+import time
 from flask import g
 from base.utils.data_utils import dump_json
 from gcloud import datastore, storage
@@ -14,11 +15,10 @@ def google_datastore(open=False):
         Args:
             open - Return the client without storing it in the g object.
     """
-    client = datastore.Client(project='andersen-lab')
     if open:
-        return client
+        return datastore.Client(project='andersen-lab')
     if not hasattr(g, 'ds'):
-        g.ds = client
+        g.ds = datastore.Client(project='andersen-lab')
     return g.ds
 
 
@@ -29,25 +29,54 @@ def delete_item(item):
     batch.commit()
 
 
-def store_item(kind, name, **kwargs):
+def delete_key(kind, name):
+    """
+        Deletes an item by kind and name from google datastore
+    """
     ds = google_datastore()
-    try:
-        exclude = kwargs.pop('exclude_from_indexes')
-    except KeyError:
-        exclude = False
+    ds.delete(ds.key(kind, name))
+    logger.debug(f"delete: {kind} - {name}")
+
+
+def _entity(ds, kind, name, properties, exclude=None):
     if exclude:
         m = datastore.Entity(key=ds.key(kind, name), exclude_from_indexes=exclude)
     else:
         m = datastore.Entity(key=ds.key(kind, name))
-    for key, value in kwargs.items():
+    for key, value in properties.items():
         if isinstance(value, dict):
             m[key] = 'JSON:' + dump_json(value)
         else:
             m[key] = value
+    return m
+
+
+def store_item(kind, name, **kwargs):
+    ds = google_datastore()
+    exclude = kwargs.pop('exclude_from_indexes', False)
+    m = _entity(ds, kind, name, kwargs, exclude)
     logger.debug(f"store: {kind} - {name}")
     ds.put(m)
 
 
+def store_items(kind, items, exclude_from_indexes=None, chunk_size=500):
+    """
+        Stores many items with one request per chunk
+
+        Args:
+            kind - the kind of the items
+            items - dict of name: properties
+            exclude_from_indexes - properties that are not indexed
+            chunk_size - items per request (Datastore allows 500)
+    """
+    ds = google_datastore()
+    entities = [_entity(ds, kind, name, properties, exclude_from_indexes)
+                for name, properties in items.items()]
+    for n in range(0, len(entities), chunk_size):
+        ds.put_multi(entities[n:n + chunk_size])
+    logger.debug(f"store: {kind} - {len(entities)} items")
+
+
 def query_item(kind, filters=None, projection=(), order=None, limit=None):
     """
         Filter items from google datastore using a query
@@ -74,13 +103,84 @@ def query_item(kind, filters=None, projection=(), order=None, limit=None):
         return records
 
 
-def get_item(kind, name):
+def query_item_iter(kind, projection, filters=None, order=None, distinct_on=None, limit=None, page_size=500):
     """
-        returns item by kind and name from google datastore
+        Yields items from google datastore page by page, so that
+        full-kind scans run in bounded memory.
+
+        Args:
+            kind - the kind of the items
+            projection - the properties to fetch, or ['__key__'] for
+                         a keys-only query. Projected properties must
+                         be indexed; projecting several properties
+                         needs a composite index (index.yaml).
+            filters - list of (property, operator, value)
+            order - list of properties (prefix '-' for descending)
+            distinct_on - properties to return distinct values of
+            limit - the maximum number of items
+            page_size - items fetched per request
     """
+    if not projection:
+        raise ValueError("A projection is required; use ['__key__'] for keys only")
     ds = google_datastore()
-    result = ds.get(ds.key(kind, name))
-    logger.debug(f"get: {kind} - {name}")
+    query = ds.query(kind=kind, projection=projection)
+    if order:
+        query.order = order
+    if distinct_on:
+        query.distinct_on = distinct_on
+    if filters:
+        for var, op, val in filters:
+            query.add_filter(var, op, val)
+    cursor = None
+    n_items = 0
+    while limit is None or n_items < limit:
+        n_page = page_size if limit is None else min(page_size, limit - n_items)
+        data, more, cursor = query.fetch(limit=n_page, start_cursor=cursor).next_page()
+        for item in data:
+            yield item
+        n_items += len(data)
+        # Batches can end early (e.g. at 1 MB) with more results after
+        # them; a full page may also have more results, which gcloud
+        # reports as finished (MORE_RESULTS_AFTER_LIMIT).
+        if not cursor or not (more or len(data) == n_page):
+            break
+
+
+def count_items(kind, filters=None):
+    """
+        Counts items with a keys-only query
+    """
+    return sum(1 for x in query_item_iter(kind, ['__key__'], filters=filters))
+
+
+def count_items_by(kind, field, filters=None):
+    """
+        Counts items by the value of an (indexed) property with
+        a projection query; items without the property are not counted.
+
+        Returns:
+            dict of value: count
+    """
+    counts = {}
+    for item in query_item_iter(kind, [field], filters=filters):
+        value = item.get(field)
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def distinct_items(kind, fields, filters=None):
+    """
+        Returns the distinct combinations of (indexed) properties
+        with a projection query.
+
+        Returns:
+            list of dicts of field: value
+    """
+    return [{field: item.get(field) for field in fields}
+            for item in query_item_iter(kind, fields, filters=filters, distinct_on=fields)]
+
+
+def _item_dict(result):
     try:
         result_out = {'_exists': True}
         for k, v in result.items():
@@ -94,6 +194,114 @@ def get_item(kind, name):
         return None
 
 
+def get_item(kind, name):
+    """
+        returns item by kind and name from google datastore
+    """
+    ds = google_datastore()
+    result = ds.get(ds.key(kind, name))
+    logger.debug(f"get: {kind} - {name}")
+    return _item_dict(result)
+
+
+def get_items(kind, names, chunk_size=1000):
+    """
+        returns items by kind and name from google datastore
+        with one request per chunk
+
+        Args:
+            kind - the kind of the items
+            names - list of item names
+            chunk_size - keys per request (Datastore allows 1000)
+
+        Returns:
+            dict of name: item; missing items are left out
+    """
+    ds = google_datastore()
+    names = list(names)
+    results = {}
+    for n in range(0, len(names), chunk_size):
+        keys = [ds.key(kind, name) for name in names[n:n + chunk_size]]
+        for entity in ds.get_multi(keys):
+            results[entity.key.name] = _item_dict(entity)
+    logger.debug(f"get: {kind} - {len(names)} items")
+    return results
+
+
+def increment_item(kind, name, retries=3, **counts):
+    """
+        Adds counts to the (integer) properties of an item in
+        a transaction; the item is created if it does not exist.
+
+        Args:
+            kind - the kind of the item
+            name - the name of the item
+            retries - attempts when concurrent updates conflict
+            counts - property: amount to add
+    """
+    ds = google_datastore()
+    key = ds.key(kind, name)
+    for attempt in range(retries):
+        try:
+            with ds.transaction():
+                item = ds.get(key) or datastore.Entity(key=key)
+                for k, v in counts.items():
+                    item[k] = (item.get(k) or 0) + v
+                ds.put(item)
+            logger.debug(f"increment: {kind} - {name}")
+            return
+        except Exception:
+            if attempt == retries - 1:
+                raise
+
+
+def acquire_lease(name, seconds, owner):
+    """
+        Acquires a lease (kind 'lease') unless another owner holds
+        an unexpired one; used to run a task on one instance at a time.
+
+        Args:
+            name - the name of the lease
+            seconds - the lease expires after this many seconds
+            owner - an id of the holder
+
+        Returns:
+            True if the lease was acquired, False if another owner
+            holds it, and None if the lease could not be read or
+            written (Datastore errors, conflicting transactions)
+    """
+    ds = google_datastore()
+    key = ds.key('lease', name)
+    try:
+        with ds.transaction():
+            lease = ds.get(key)
+            if lease is not None and lease.get('owner') != owner and lease.get('expires', 0) > time.time():
+                return False
+            lease = datastore.Entity(key=key, exclude_from_indexes=['owner', 'expires'])
+            lease.update({'owner': owner, 'expires': time.time() + seconds})
+            ds.put(lease)
+    except Exception as e:
+        # Concurrent transactions on the lease conflict
+        logger.warning(f"lease: {name} - {e}")
+        return None
+    return True
+
+
+def release_lease(name, owner):
+    """
+        Releases a lease held by owner
+    """
+    ds = google_datastore()
+    key = ds.key('lease', name)
+    try:
+        with ds.transaction():
+            lease = ds.get(key)
+            if lease is not None and lease.get('owner') == owner:
+                ds.delete(key)
+    except Exception as e:
+        logger.debug(f"lease: {name} - {e}")
+
+
 def google_storage(open=False):
     """
         Fetch google datastore credentials
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Release genotype store.
+
+A columnar, memory-mapped copy of a release VCF built offline with
+
+    flask build_genotype_store <release>
+
+For each chromosome the store holds:
+
+    <chrom>.pos.npy           sorted positions
+    <chrom>.end.npy           end positions (the last base of REF, or INFO/END)
+    <chrom>.ref.npy/.alt.npy  REF and ALT as codes into alleles.json
+    <chrom>.filter.npy        FILTER as codes into meta.json filter_values
+    <chrom>.af.npy            allele frequency
+    <chrom>.impact.npy        impact bitmask of the ANN field (see impact_index)
+    <chrom>.ann_offsets.npy   offsets of each record's ANN string in <chrom>.ann.bin
+    <chrom>.gt.bin            genotypes (variants x samples), 2 bits per genotype
+    <chrom>.ft.bin            FT (variants x samples) as codes into meta.json ft_values
+    <chrom>.tgt.json          TGT of records that cannot be derived from REF/ALT
+                              (multi-allelic records)
+
+Genotype codes follow cyvcf2 gts012 (HOM_REF=0, HET=1, HOM_ALT=2, UNKNOWN=3).
+Region queries slice the memory-mapped arrays without reading the rest
+of the chromosome. As with a tabix query of the VCF, records overlapping
+the region are returned, including deletions starting before it.
+
+"""
+import os
+import json
+import numpy as np
+from cyvcf2 import VCF
+from logzero import logger
+from base.utils.impact_index import impact_mask
+from base.utils.vcf_region import RegionRecord, sample_index
+
+# Records decoded at a time by GenotypeStore.iter_region
+CHUNK_SIZE = 1024
+
+
+def pack_genotypes(gt_types):
+    """
+        Packs genotype codes (0-3) four to a byte
+    """
+    gt_types = np.asarray(gt_types, dtype=np.uint8)
+    padded = np.zeros(-(-len(gt_types) // 4) * 4, dtype=np.uint8)
+    padded[:len(gt_types)] = gt_types
+    return padded[0::4] | (padded[1::4] << 2) | (padded[2::4] << 4) | (padded[3::4] << 6)
+
+
+def unpack_genotypes(packed, n_samples):
+    """
+        Unpacks a (variants x bytes) array of packed genotypes
+        to a (variants x n_samples) array of genotype codes
+    """
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+    gt_types = (packed[:, :, None] >> shifts) & 3
+    return gt_types.reshape(len(packed), -1)[:, :n_samples]
+
+
+class _Encoder(dict):
+    """
+        Assigns integer codes to values in the order they are seen
+    """
+    def code(self, value):
+        return self.setdefault(value, len(self))
+
+    def value_list(self):
+        return list(self.keys())
+
+
+def build_genotype_store(vcf_path, out_dir, release):
+    """
+        Converts a release VCF to a genotype store.
+
+        Args:
+            vcf_path - path or url of the VCF
+            out_dir - output directory
+            release - the dataset release
+    """
+    vcf = VCF(vcf_path, gts012=True)
+    samples = list(vcf.samples)
+    tmp_dir = out_dir.rstrip("/") + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    encoders = {'alleles': _Encoder(),
+                'filter': _Encoder(),
+                'ft': _Encoder({"PASS": 0})}
+    chroms = {}
+    chrom = None
+    columns = None
+    files = None
+    for record in vcf:
+        if record.CHROM != chrom:
+            if chrom is not None:
+                chroms[chrom] = _write_chrom(tmp_dir, chrom, columns, files)
+            chrom = record.CHROM
+            if chrom in chroms:
+                raise ValueError(f"{vcf_path} is not sorted by chromosome")
+            columns = {k: [] for k in ['pos', 'end', 'ref', 'alt', 'filter', 'af', 'impact']}
+            columns.update(ann_offsets=[0], tgt={})
+            files = {k: open(os.path.join(tmp_dir, f"{chrom}.{k}.bin"), 'wb') for k in ['gt', 'ft', 'ann']}
+        _encode_record(record, columns, files, encoders, len(samples))
+    if chrom is not None:
+        chroms[chrom] = _write_chrom(tmp_dir, chrom, columns, files)
+    vcf.close()
+    with open(os.path.join(tmp_dir, "alleles.json"), 'w') as f:
+        json.dump(encoders['alleles'].value_list(), f)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+        json.dump({"release": str(release),
+                   "samples": samples,
+                   "chroms": chroms,
+                   "filter_values": encoders['filter'].value_list(),
+                   "ft_values": encoders['ft'].value_list()}, f)
+    _replace_dir(tmp_dir, out_dir)
+    logger.info(f"Wrote genotype store for {sum(chroms.values())} records to {out_dir}")
+
+
+def _encode_record(record, columns, files, encoders, n_samples):
+    """
+        Appends a VCF record to the columns and files of its chromosome
+    """
+    columns['pos'].append(record.POS)
+    # record.end is 0-based, exclusive: the last base (1-based) of the record
+    columns['end'].append(record.end)
+    columns['ref'].append(encoders['alleles'].code(record.REF))
+    columns['alt'].append(encoders['alleles'].code(','.join(record.ALT)))
+    columns['filter'].append(encoders['filter'].code(record.FILTER or 'PASS'))
+    AF = record.INFO.get('AF')
+    if isinstance(AF, tuple):
+        AF = AF[0]
+    columns['af'].append(np.nan if AF is None else AF)
+    ANN = record.INFO.get('ANN') or ''
+    columns['impact'].append(impact_mask(ANN))
+    ANN = ANN.encode('utf-8')
+    files['ann'].write(ANN)
+    columns['ann_offsets'].append(columns['ann_offsets'][-1] + len(ANN))
+    files['gt'].write(pack_genotypes(record.gt_types).tobytes())
+    files['ft'].write(_ft_codes(record, encoders['ft'], n_samples).tobytes())
+    if len(encoders['ft']) > 256 or len(encoders['filter']) > 256:
+        raise ValueError("Too many distinct FT or FILTER values for the genotype store")
+    if len(record.ALT) > 1:
+        columns['tgt'][len(columns['pos']) - 1] = record.gt_bases.tolist()
+
+
+def _ft_codes(record, ft_values, n_samples):
+    """
+        Returns the FT of each sample as codes of ft_values
+    """
+    try:
+        FT = record.format("FT").ravel()
+    except KeyError:
+        return np.zeros(n_samples, dtype=np.uint8)
+    values, inverse = np.unique(FT, return_inverse=True)
+    lookup = np.array([ft_values.code(x) for x in values.tolist()], dtype=np.uint8)
+    return lookup[inverse]
+
+
+def _write_chrom(tmp_dir, chrom, columns, files):
+    """
+        Closes the files of a chromosome and writes its columns
+
+        Returns:
+            the number of records
+    """
+    for f in files.values():
+        f.close()
+    for name, dtype in [("pos", np.int32),
+                        ("end", np.int32),
+                        ("ref", np.int32),
+                        ("alt", np.int32),
+                        ("filter", np.uint8),
+                        ("af", np.float32),
+                        ("impact", np.uint8),
+                        ("ann_offsets", np.int64)]:
+        np.save(os.path.join(tmp_dir, f"{chrom}.{name}.npy"), np.array(columns[name], dtype=dtype))
+    with open(os.path.join(tmp_dir, f"{chrom}.tgt.json"), 'w') as f:
+        json.dump(columns['tgt'], f)
+    logger.info(f"{chrom}: {len(columns['pos'])} records")
+    return len(columns['pos'])
+
+
+def _replace_dir(tmp_dir, out_dir):
+    """
+        Replaces an existing store once the new one is complete
+    """
+    if os.path.exists(out_dir):
+        old_dir = out_dir.rstrip("/") + ".old"
+        os.rename(out_dir, old_dir)
+        os.rename(tmp_dir, out_dir)
+        for fname in os.listdir(old_dir):
+            os.remove(os.path.join(old_dir, fname))
+        os.rmdir(old_dir)
+    else:
+        os.rename(tmp_dir, out_dir)
+
+
+class GenotypeStore(object):
+    """
+        Read access to a genotype store.
+
+        Arrays are memory-mapped when a chromosome is first queried and
+        are shared by all threads of the process.
+
+        Args:
+            path - a directory written by build_genotype_store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.release = meta['release']
+        self.samples = meta['samples']
+        self.chroms = meta['chroms']
+        self.filter_values = np.array(meta['filter_values'], dtype=object)
+        self.ft_values = np.array(meta['ft_values'], dtype=object)
+        with open(os.path.join(path, "alleles.json")) as f:
+            self.alleles = np.array(json.load(f), dtype=object)
+        self._arrays = {}
+
+    @classmethod
+    def load(cls, path):
+        """
+            Returns the store at path, or None if it has not been built
+        """
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            return None
+        logger.info(f"Loading genotype store: {path}")
+        return cls(path)
+
+    def _fname(self, chrom, name):
+        return os.path.join(self.path, f"{chrom}.{name}")
+
+    def arrays(self, chrom):
+        """
+            Returns the memory-mapped arrays of a chromosome
+        """
+        if chrom not in self._arrays:
+            n = self.chroms[chrom]
+            arrays = {name: np.load(self._fname(chrom, f"{name}.npy"), mmap_mode='r')
+                      for name in ['pos', 'ref', 'alt', 'filter', 'af', 'impact', 'ann_offsets']}
+            if os.path.exists(self._fname(chrom, "end.npy")):
+                arrays['end'] = np.load(self._fname(chrom, "end.npy"), mmap_mode='r')
+            else:
+                # Stores built before end positions were kept
+                arrays['end'] = arrays['pos']
+            # Records are sorted by position; the running maximum of
+            # their ends finds the first record overlapping a region.
+            arrays['max_end'] = np.maximum.accumulate(arrays['end'])
+            n_bytes = -(-len(self.samples) // 4)
+            # Empty files cannot be memory-mapped
+            if n:
+                arrays['gt'] = np.memmap(self._fname(chrom, "gt.bin"), dtype=np.uint8, mode='r', shape=(n, n_bytes))
+                arrays['ft'] = np.memmap(self._fname(chrom, "ft.bin"), dtype=np.uint8, mode='r',
+                                         shape=(n, len(self.samples)))
+                arrays['ann'] = np.memmap(self._fname(chrom, "ann.bin"), dtype=np.uint8, mode='r')
+            else:
+                arrays['gt'] = np.zeros((0, n_bytes), dtype=np.uint8)
+                arrays['ft'] = np.zeros((0, len(self.samples)), dtype=np.uint8)
+                arrays['ann'] = np.zeros(0, dtype=np.uint8)
+            with open(self._fname(chrom, "tgt.json")) as f:
+                arrays['tgt'] = {int(k): v for k, v in json.load(f).items()}
+            self._arrays[chrom] = arrays
+        return self._arrays[chrom]
+
+    def region(self, chrom, start, end, overlap=False):
+        """
+            Returns the slice of records with start <= POS <= end.
+
+            With overlap, the slice begins at the first record that may
+            overlap start; records within it ending before start must
+            still be skipped (see iter_region).
+        """
+        if chrom not in self.chroms:
+            return slice(0, 0)
+        arrays = self.arrays(chrom)
+        if overlap:
+            first = np.searchsorted(arrays['max_end'], start, side='left')
+        else:
+            first = np.searchsorted(arrays['pos'], start, side='left')
+        return slice(int(first), int(np.searchsorted(arrays['pos'], end, side='right')))
+
+    def sample_index(self, samples):
+        """
+            Returns the columns of samples; None selects all samples
+        """
+        return sample_index(self.samples, samples)
+
+    def genotypes(self, chrom, region, sample_idx=None):
+        """
+            Returns genotype codes (variants x samples) of a slice or an array of records
+        """
+        gt_types = unpack_genotypes(self.arrays(chrom)['gt'][region], len(self.samples))
+        if sample_idx is not None:
+            gt_types = gt_types[:, sample_idx]
+        return gt_types
+
+    def iter_region(self, chrom, start, end, samples=None, impact_mask=None):
+        """
+            Yields RegionRecords overlapping a region.
+
+            Args:
+                chrom, start, end - the region
+                samples - list of samples to return; None returns all samples
+                impact_mask - only return records with a matching impact (see impact_index)
+        """
+        sample_idx = self.sample_index(samples)
+        region = self.region(chrom, start, end, overlap=True)
+        if region.stop <= region.start:
+            return
+        arrays = self.arrays(chrom)
+        for chunk_start in range(region.start, region.stop, CHUNK_SIZE):
+            chunk = slice(chunk_start, min(chunk_start + CHUNK_SIZE, region.stop))
+            keep = np.ones(chunk.stop - chunk.start, dtype=bool)
+            if arrays['pos'][chunk.start] < start:
+                keep &= arrays['end'][chunk] >= start
+            if impact_mask is not None:
+                keep &= (arrays['impact'][chunk] & impact_mask) > 0
+            rows = np.arange(chunk.start, chunk.stop)[keep]
+            if len(rows):
+                yield from self._records(chrom, rows, sample_idx)
+
+    def iter_positions(self, chrom, positions, samples=None):
+        """
+            Yields RegionRecords starting at any of a list of positions.
+
+            Positions are matched within the slice of records
+            covering them; only matching records are decoded.
+
+            Args:
+                chrom - chromosome
+                positions - sorted list of positions
+                samples - list of samples to return; None returns all samples
+        """
+        if not positions:
+            return
+        sample_idx = self.sample_index(samples)
+        region = self.region(chrom, positions[0], positions[-1])
+        if region.stop <= region.start:
+            return
+        pos = self.arrays(chrom)['pos'][region]
+        rows = region.start + np.flatnonzero(np.isin(pos, positions))
+        for chunk_start in range(0, len(rows), CHUNK_SIZE):
+            yield from self._records(chrom, rows[chunk_start:chunk_start + CHUNK_SIZE], sample_idx)
+
+    def _records(self, chrom, rows, sample_idx=None):
+        """
+            Decodes the RegionRecords of sorted record indices
+        """
+        arrays = self.arrays(chrom)
+        gt_chunk = self.genotypes(chrom, rows, sample_idx)
+        ft_chunk = arrays['ft'][rows]
+        if sample_idx is not None:
+            ft_chunk = ft_chunk[:, sample_idx]
+        for i, row in enumerate(rows.tolist()):
+            REF = self.alleles[arrays['ref'][row]]
+            ALT = self.alleles[arrays['alt'][row]].split(",")
+            gt_types = gt_chunk[i]
+            if row in arrays['tgt']:
+                gt_bases = np.array(arrays['tgt'][row], dtype=object)
+                if sample_idx is not None:
+                    gt_bases = gt_bases[sample_idx]
+            else:
+                bases = np.array([f"{REF}/{REF}", f"{REF}/{ALT[0]}", f"{ALT[0]}/{ALT[0]}", "./."], dtype=object)
+                gt_bases = bases[gt_types]
+            ann_start, ann_end = arrays['ann_offsets'][row:row + 2]
+            ANN = arrays['ann'][ann_start:ann_end].tobytes().decode('utf-8') or None
+            yield RegionRecord(CHROM=chrom,
+                               POS=int(arrays['pos'][row]),
+                               REF=REF,
+                               ALT=ALT,
+                               FILTER=self.filter_values[arrays['filter'][row]],
+                               AF=float(arrays['af'][row]),
+                               ANN=ANN,
+                               gt_types=gt_types,
+                               gt_bases=gt_bases,
+                               FT=self.ft_values[ft_chunk[i]])
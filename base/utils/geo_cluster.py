@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Grid clustering of map locations.
+
+Locations are projected to Web Mercator and bucketed, for every zoom
+level, into square grid cells of CELL_SIZE pixels. Each cell is a
+cluster with a count, a centroid and its members, so a map view is
+answered by selecting the cells within its bounding box.
+
+"""
+import numpy as np
+
+
+TILE_SIZE = 256
+
+# Grid cell size (pixels)
+CELL_SIZE = 64
+
+# Clusters are precomputed up to this zoom level; higher zoom
+# levels use the clusters of MAX_ZOOM
+MAX_ZOOM = 16
+
+
+def mercator(latitude, longitude):
+    """
+        Projects locations to Web Mercator coordinates in [0, 1]
+    """
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    x = (longitude + 180) / 360
+    sin_lat = np.clip(np.sin(np.radians(latitude)), -0.9999, 0.9999)
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    return np.clip(x, 0, 1), np.clip(y, 0, 1)
+
+
+def _cell(coordinate, cells):
+    return np.minimum((coordinate * cells).astype(np.int64), cells - 1)
+
+
+class GridClusters(object):
+    """
+        Grid clusters of locations for each zoom level.
+
+        Args:
+            latitude, longitude - arrays of locations
+    """
+
+    def __init__(self, latitude, longitude, max_zoom=MAX_ZOOM, cell_size=CELL_SIZE):
+        self.max_zoom = max_zoom
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        x, y = mercator(self.latitude, self.longitude)
+        self.levels = []
+        for zoom in range(max_zoom + 1):
+            cells = max(TILE_SIZE * 2 ** zoom // cell_size, 1)
+            key = _cell(y, cells) * cells + _cell(x, cells)
+            order = np.argsort(key, kind='stable')
+            keys, start, count = np.unique(key[order], return_index=True, return_counts=True)
+            if len(order):
+                latitude = np.add.reduceat(self.latitude[order], start) / count
+                longitude = np.add.reduceat(self.longitude[order], start) / count
+            else:
+                latitude = longitude = np.zeros(0)
+            self.levels.append({'cells': cells,
+                                'key': keys,
+                                'row': keys // cells,
+                                'col': keys % cells,
+                                'start': start,
+                                'count': count,
+                                'latitude': latitude,
+                                'longitude': longitude,
+                                'order': order})
+
+    def level(self, zoom):
+        return self.levels[min(max(zoom, 0), self.max_zoom)]
+
+    def clusters(self, zoom, bbox=None):
+        """
+            Returns the clusters of a zoom level within a bounding box.
+
+            Args:
+                zoom - map zoom level
+                bbox - (min_lon, min_lat, max_lon, max_lat); boxes crossing
+                       the antimeridian have min_lon > max_lon
+
+            Returns:
+                dict of arrays: key (cell), count, latitude, longitude
+        """
+        level = self.level(zoom)
+        mask = np.ones(len(level['key']), dtype=bool)
+        if bbox:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            cells = level['cells']
+            (min_x, max_x), (max_y, min_y) = mercator([min_lat, max_lat], [min_lon, max_lon])
+            min_col, max_col = _cell(np.array([min_x, max_x]), cells)
+            min_row, max_row = _cell(np.array([min_y, max_y]), cells)
+            mask &= (level['row'] >= min_row) & (level['row'] <= max_row)
+            if min_lon <= max_lon:
+                mask &= (level['col'] >= min_col) & (level['col'] <= max_col)
+            else:
+                mask &= (level['col'] >= min_col) | (level['col'] <= max_col)
+        return {k: level[k][mask] for k in ('key', 'count', 'latitude', 'longitude')}
+
+    def members(self, zoom, key):
+        """
+            Returns the indices of the locations in a cluster
+        """
+        level = self.level(zoom)
+        n = np.searchsorted(level['key'], key)
+        if n == len(level['key']) or level['key'][n] != key:
+            return np.zeros(0, dtype=np.int64)
+        start = level['start'][n]
+        return level['order'][start:start + level['count'][n]]
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Impact index for release VCFs.
+
+A sidecar file built offline from a release VCF that stores, for each
+chromosome, the position and end of every record and a bitmask of the
+impact classes of its annotations. Queries filtered by impact look up the
+positions carrying a matching annotation and only read those parts of
+the VCF.
+
+    flask build_impact_index <release>
+
+"""
+import os
+import numpy as np
+from cyvcf2 import VCF
+from logzero import logger
+
+# ANN field holding the impact class
+IMPACT_FIELD = 2
+
+IMPACT_BITS = {"HIGH": 1,
+               "MODERATE": 2,
+               "LOW": 4,
+               "MODIFIER": 8}
+
+
+def impact_mask(ANN):
+    """
+        Returns the impact bitmask of an ANN string
+    """
+    mask = 0
+    if ANN:
+        for ANN_rec in ANN.split(","):
+            fields = ANN_rec.split("|")
+            if len(fields) > IMPACT_FIELD:
+                mask |= IMPACT_BITS.get(fields[IMPACT_FIELD], 0)
+    return mask
+
+
+def query_mask(variant_impact):
+    """
+        Returns the bitmask of a list of impacts; None when
+        the query is not filtered by impact.
+    """
+    if 'ALL' in variant_impact:
+        return None
+    mask = 0
+    for impact in variant_impact:
+        mask |= IMPACT_BITS.get(impact, 0)
+    return mask
+
+
+def build_impact_index(vcf_path, out_path):
+    """
+        Reads a VCF and writes its impact index.
+
+        Args:
+            vcf_path - path or url of the VCF
+            out_path - output file (.npz)
+    """
+    vcf = VCF(vcf_path, lazy=True)
+    positions = {}
+    ends = {}
+    masks = {}
+    chrom = None
+    for record in vcf:
+        if record.CHROM != chrom:
+            chrom = record.CHROM
+            logger.info(f"Indexing {chrom}")
+            positions.setdefault(chrom, [])
+            ends.setdefault(chrom, [])
+            masks.setdefault(chrom, [])
+        positions[chrom].append(record.POS)
+        # record.end is 0-based, exclusive: the last base (1-based) of the record
+        ends[chrom].append(record.end)
+        masks[chrom].append(impact_mask(record.INFO.get('ANN')))
+    vcf.close()
+    arrays = {}
+    for chrom in positions:
+        arrays[f"{chrom}/pos"] = np.array(positions[chrom], dtype=np.int32)
+        arrays[f"{chrom}/end"] = np.array(ends[chrom], dtype=np.int32)
+        arrays[f"{chrom}/mask"] = np.array(masks[chrom], dtype=np.uint8)
+    out_dir = os.path.dirname(out_path)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    # np.savez appends .npz to paths that lack it; write to an
+    # open file so that the index is only replaced once complete.
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, out_path)
+    logger.info(f"Wrote impact index for {sum(len(x) for x in positions.values())} records to {out_path}")
+
+
+class ImpactIndex(object):
+    """
+        Positions and impact bitmasks of the records of a VCF.
+
+        Args:
+            path - an index written by build_impact_index
+    """
+
+    def __init__(self, path):
+        self.positions = {}
+        self.ends = {}
+        self.masks = {}
+        with np.load(path) as index:
+            for key in index.files:
+                chrom, field = key.rsplit("/", 1)
+                if field == "pos":
+                    self.positions[chrom] = index[key]
+                elif field == "end":
+                    self.ends[chrom] = index[key]
+                else:
+                    self.masks[chrom] = index[key]
+        # Indexes built before ends were stored treat records as SNVs
+        for chrom, positions in self.positions.items():
+            self.ends.setdefault(chrom, positions)
+        # Records are sorted by position; the running maximum of
+        # their ends finds the first record overlapping a region.
+        self.max_ends = {chrom: np.maximum.accumulate(ends) for chrom, ends in self.ends.items()}
+
+    @classmethod
+    def load(cls, path):
+        """
+            Returns the index at path, or None if it has not been built
+        """
+        if not os.path.exists(path):
+            return None
+        logger.info(f"Loading impact index: {path}")
+        return cls(path)
+
+    def spans(self, chrom, start, end, mask, max_gap=10000):
+        """
+            Returns the spans of a region that contain records matching mask.
+
+            Records overlapping the region are matched, including those
+            starting before it; a span starts at the position of its first
+            record, as records starting before a span are not read from it.
+
+            Matching positions separated by at most max_gap are merged
+            into one span so that nearby records are read together.
+
+            Args:
+                chrom, start, end - the region queried
+                mask - bitmask of impacts (see query_mask)
+                max_gap - largest gap (bp) between positions within a span
+
+            Returns:
+                list of (start, end)
+        """
+        if chrom not in self.positions:
+            return []
+        positions = self.positions[chrom]
+        lo = np.searchsorted(self.max_ends[chrom], start, side='left')
+        hi = np.searchsorted(positions, end, side='right')
+        selected = ((self.masks[chrom][lo:hi] & mask) > 0) & (self.ends[chrom][lo:hi] >= start)
+        matched = positions[lo:hi][selected]
+        if len(matched) == 0:
+            return []
+        breaks = np.flatnonzero(np.diff(matched) > max_gap)
+        span_starts = matched[np.concatenate([[0], breaks + 1])]
+        span_ends = matched[np.concatenate([breaks, [len(matched) - 1]])]
+        return list(zip(span_starts.tolist(), span_ends.tolist()))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Interval indexes for overlap queries on gene models.
+
+Intervals of each chromosome are sorted by start; the running
+maximum of their ends lets a binary search find the first interval
+that can overlap a region, and a second binary search on the starts
+finds the last one. Only intervals in between are checked.
+
+"""
+import numpy as np
+
+
+class IntervalIndex(object):
+    """
+        Overlap queries on 1-based, inclusive intervals.
+
+        Args:
+            chrom, start, end - arrays of intervals
+    """
+
+    def __init__(self, chrom, start, end):
+        chrom = np.asarray(chrom, dtype=object)
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+        self.offsets = {}
+        order = []
+        for name in sorted(set(chrom)):
+            rows = np.flatnonzero(chrom == name)
+            rows = rows[np.argsort(start[rows], kind='stable')]
+            self.offsets[name] = (len(order), len(order) + len(rows))
+            order.extend(rows.tolist())
+        self.order = np.array(order, dtype=np.int64)
+        self.start = start[self.order]
+        self.end = end[self.order]
+        self.max_end = np.empty_like(self.end)
+        for lo, hi in self.offsets.values():
+            self.max_end[lo:hi] = np.maximum.accumulate(self.end[lo:hi])
+
+    def __len__(self):
+        return len(self.order)
+
+    def overlapping(self, chrom, start, end):
+        """
+            Returns the indices of the intervals overlapping
+            chrom:start-end, ordered by start.
+        """
+        if chrom not in self.offsets:
+            return np.zeros(0, dtype=np.int64)
+        lo, hi = self.offsets[chrom]
+        first = lo + np.searchsorted(self.max_end[lo:hi], start, side='left')
+        last = lo + np.searchsorted(self.start[lo:hi], end, side='right')
+        if last <= first:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.arange(first, last)
+        return self.order[candidates[self.end[first:last] >= start]]
+
+
+class GeneModels(object):
+    """
+        Genes and transcript models with interval indexes.
+
+        Args:
+            genes - list of gene records (chrom, start, end attributes)
+            transcripts - list of transcript dicts with chrom, start,
+                          end, exons and cds
+    """
+
+    def __init__(self, genes, transcripts):
+        self.genes = genes
+        self.transcripts = transcripts
+        self.gene_index = IntervalIndex([x.chrom for x in genes],
+                                        [x.start for x in genes],
+                                        [x.end for x in genes])
+        self.transcript_index = IntervalIndex([x['chrom'] for x in transcripts],
+                                              [x['start'] for x in transcripts],
+                                              [x['end'] for x in transcripts])
+
+    def region_genes(self, chrom, start, end):
+        return [self.genes[n] for n in self.gene_index.overlapping(chrom, start, end)]
+
+    def region_transcripts(self, chrom, start, end):
+        return [self.transcripts[n] for n in self.transcript_index.overlapping(chrom, start, end)]
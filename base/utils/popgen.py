@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Population genetics tracks and statistics.
+
+"""
+import io
+import numpy as np
+import pandas as pd
+
+
+class TajimaTrack(object):
+    """
+        A genome-wide Tajima's D track held in memory.
+
+        Windows of all chromosomes are stored in sorted arrays; the
+        windows of a chromosome are rows offsets[chrom][0]:offsets[chrom][1].
+        Windows overlapping a region are found by binary search on the
+        window starts and on the running maximum of the window ends
+        (windows may overlap).
+
+        Args:
+            bed - gzipped BED (bytes) of chrom, start, end, ..., Tajima's D (6th column)
+    """
+
+    def __init__(self, bed):
+        df = pd.read_csv(io.BytesIO(bed),
+                         sep="\t",
+                         header=None,
+                         comment="#",
+                         compression="gzip",
+                         usecols=[0, 1, 2, 5],
+                         names=["chrom", "start", "end", "D"],
+                         dtype={"chrom": str})
+        df = df.sort_values(["chrom", "start"], kind="mergesort")
+        self.start = df["start"].values.astype(np.int64)
+        self.end = df["end"].values.astype(np.int64)
+        self.D = df["D"].values.astype(np.float64)
+        self.offsets = {}
+        self.max_end = np.empty_like(self.end)
+        chroms = df["chrom"].values
+        breaks = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        for lo, hi in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(chroms)]])):
+            self.offsets[chroms[lo]] = (int(lo), int(hi))
+            self.max_end[lo:hi] = np.maximum.accumulate(self.end[lo:hi])
+
+    def window(self, chrom, start, end):
+        """
+            Returns the indices of windows overlapping chrom:start-end
+        """
+        if chrom not in self.offsets:
+            return np.zeros(0, dtype=np.int64)
+        lo, hi = self.offsets[chrom]
+        # BED windows are 0-based, half-open; the region is 1-based, inclusive
+        first = lo + np.searchsorted(self.max_end[lo:hi], start, side='left')
+        last = max(first, lo + np.searchsorted(self.start[lo:hi], end, side='left'))
+        # Windows nested in a longer window may end before the region
+        return np.arange(first, last)[self.end[first:last] >= start]
+
+    def query(self, chrom, start, end, points=None):
+        """
+            Returns the positions and Tajima's D of the windows in a region.
+
+            Args:
+                chrom, start, end - the region
+                points - if set, windows are averaged in groups so that
+                         at most this many points are returned
+
+            Returns:
+                (x, y) arrays
+        """
+        region = self.window(chrom, start, end)
+        # Windows are plotted at end + 50 kb
+        x = self.end[region] + 50000
+        y = self.D[region]
+        if points and len(x) > points:
+            groups = np.linspace(0, len(x), points + 1).astype(np.int64)[:-1]
+            counts = np.diff(np.append(groups, len(x)))
+            x = (np.add.reduceat(x, groups) / counts).astype(np.int64)
+            y = np.add.reduceat(y, groups) / counts
+        return x, y
+
+
+# Windowed statistics
+#
+# Isotypes are inbred and are treated as haploid: HOM_REF (0) carries
+# the reference allele, HOM_ALT (2) the alternative allele and
+# heterozygous (1) or missing (3) genotypes are not counted.
+
+def allele_counts(gt_types):
+    """
+        Returns the number of called and alternative alleles of each
+        variant from a (variants x samples) array of genotype codes.
+
+        Returns:
+            (n, k) arrays
+    """
+    n = ((gt_types == 0) | (gt_types == 2)).sum(axis=1)
+    k = (gt_types == 2).sum(axis=1)
+    return n, k
+
+
+def windows(start, end, window, step):
+    """
+        Returns the (1-based, inclusive) start and end of each window
+        tiling start..end
+    """
+    window_start = np.arange(start, end + 1, step, dtype=np.int64)
+    window_end = np.minimum(window_start + window - 1, end)
+    # Drop windows contained in the previous window
+    keep = np.ones(len(window_start), dtype=bool)
+    keep[1:] = window_end[1:] > window_end[:-1]
+    return window_start[keep], window_end[keep]
+
+
+def _window_sums(pos, values, window_start, window_end):
+    """
+        Sums per-variant values within each window using cumulative sums
+    """
+    lo = np.searchsorted(pos, window_start, side='left')
+    hi = np.searchsorted(pos, window_end, side='right')
+    sums = []
+    for value in values:
+        cumsum = np.concatenate([[0], np.cumsum(value, dtype=np.float64)])
+        sums.append(cumsum[hi] - cumsum[lo])
+    return hi - lo, sums
+
+
+def windowed_diversity(pos, n, k, start, end, window, step):
+    """
+        Computes nucleotide diversity (pi), Watterson's theta and
+        Tajima's D in windows.
+
+        pi and theta are per base pair. Tajima's D uses the mean
+        number of called alleles in the window as the sample size.
+
+        Args:
+            pos - sorted variant positions
+            n, k - called and alternative allele counts (see allele_counts)
+            start, end - the region
+            window, step - window size and step (bp)
+
+        Returns:
+            dict of window start, end, n_variants, pi, theta_w, tajima_d
+    """
+    window_start, window_end = windows(start, end, window, step)
+    n = n.astype(np.float64)
+    k = k.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pi_site = np.where(n > 1, 2 * k * (n - k) / (n * (n - 1)), 0)
+    segregating = ((k > 0) & (k < n)).astype(np.float64)
+    n_variants, (pi_sum, S, n_sum) = _window_sums(pos, [pi_site, segregating, n], window_start, window_end)
+    # Mean number of called alleles in each window
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nn = np.where(n_variants > 0, np.round(n_sum / n_variants), 0).astype(np.int64)
+
+    # Watterson's theta and Tajima's D constants for each window's sample size
+    max_n = int(nn.max()) if len(nn) else 0
+    i = np.arange(1, max(max_n, 2), dtype=np.float64)
+    a1_table = np.concatenate([[0, 0], np.cumsum(1 / i)])
+    a2_table = np.concatenate([[0, 0], np.cumsum(1 / i ** 2)])
+    a1 = a1_table[nn]
+    a2 = a2_table[nn]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b1 = (nn + 1) / (3 * (nn - 1))
+        b2 = 2 * (nn ** 2 + nn + 3) / (9 * nn * (nn - 1))
+        c1 = b1 - 1 / a1
+        c2 = b2 - (nn + 2) / (a1 * nn) + a2 / a1 ** 2
+        e1 = c1 / a1
+        e2 = c2 / (a1 ** 2 + a2)
+        theta_w = np.where(a1 > 0, S / a1, 0)
+        tajima_d = (pi_sum - theta_w) / np.sqrt(e1 * S + e2 * S * (S - 1))
+    tajima_d[(S < 3) | (nn < 4)] = np.nan
+
+    length = window_end - window_start + 1
+    return {"start": window_start,
+            "end": window_end,
+            "n_variants": n_variants,
+            "pi": pi_sum / length,
+            "theta_w": theta_w / length,
+            "tajima_d": tajima_d}
+
+
+def windowed_hudson_fst(pos, n1, k1, n2, k2, start, end, window, step):
+    """
+        Computes Hudson's Fst between two groups in windows as
+        the ratio of the summed numerators and denominators
+        (Bhatia et al. 2013).
+
+        Args:
+            pos - sorted variant positions
+            n1, k1, n2, k2 - allele counts of each group (see allele_counts)
+            start, end - the region
+            window, step - window size and step (bp)
+
+        Returns:
+            dict of window start, end, n_variants, fst
+    """
+    window_start, window_end = windows(start, end, window, step)
+    n1, k1, n2, k2 = [x.astype(np.float64) for x in (n1, k1, n2, k2)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p1 = k1 / n1
+        p2 = k2 / n2
+        num = (p1 - p2) ** 2 - p1 * (1 - p1) / (n1 - 1) - p2 * (1 - p2) / (n2 - 1)
+        den = p1 * (1 - p2) + p2 * (1 - p1)
+    # Variants must be called in at least two samples of each group
+    usable = (n1 > 1) & (n2 > 1)
+    num = np.where(usable, num, 0)
+    den = np.where(usable, den, 0)
+    n_variants, (num_sum, den_sum) = _window_sums(pos, [num, den], window_start, window_end)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fst = np.where(den_sum > 0, num_sum / den_sum, np.nan)
+    return {"start": window_start,
+            "end": window_end,
+            "n_variants": n_variants,
+            "fst": fst}
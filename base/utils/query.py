@@ -9,10 +9,11 @@ Site utility functions.
 import arrow
 import pandas as pd
 import datetime
-from base.extensions import cache
+from base.utils.cache import stale_while_revalidate
 from base.utils.gcloud import query_item, google_analytics
+from base.utils.site_stats import get_site_stats
 
-@cache.cached(timeout=60*60*24*7, key_prefix='visits')
+@stale_while_revalidate(timeout=60*60*24*7, key_prefix='visits')
 def get_weekly_visits():
     """
         Get the number of weekly visitors
@@ -46,33 +47,18 @@ def get_weekly_visits():
     return df
 
 
-@cache.cached(timeout=60*60*24, key_prefix='mappings')
 def get_mappings_summary():
     """
-        Generates the cumulative sum of reports and traits mapped.
-
-        Cached daily
+        Returns the cumulative sum of reports and traits mapped.
     """
-    traits = query_item('trait')
-
-    traits = pd.DataFrame.from_dict(traits)
-    traits.created_on = traits.apply(lambda x: arrow.get(str(x['created_on'])[:-6]).date().isoformat(), axis=1)
-
-    trait_df = traits.groupby('created_on').size().reset_index(name='traits')
-    report_df = traits[['report_slug', 'created_on']].drop_duplicates().groupby('created_on').size().reset_index(name='reports')
-    df = pd.merge(report_df, trait_df, how='outer').fillna(0).sort_values('created_on')
-    df.reports = df.reports.cumsum()
-    df.traits = df.traits.cumsum()
-    return df
+    return get_site_stats()['mappings']
 
 
-@cache.cached(timeout=60*60*24*7, key_prefix='n_mapping_users')
 def get_unique_users():
     """
-        Counts the number of unique mapping users
+        Returns the number of unique mapping users
     """
-    users = query_item('user', projection=['user_email'])
-    return len(users)
+    return get_site_stats()['n_users']
 
 
 def get_latest_public_mappings():
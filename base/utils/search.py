@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+In-memory search indices for autocomplete.
+
+Gene, homolog and strain names are case-folded and kept in sorted
+lists; a query is answered by binary search for the exact and prefix
+ranges of the query. Results are ranked:
+
+    exact name > name prefix > exact alias > alias prefix
+
+Indices are built from the database when first used (see LazyIndex).
+
+"""
+import threading
+from bisect import bisect_left
+from types import SimpleNamespace
+
+
+# Sorts after any character that appears in names
+_PREFIX_END = "\U0010ffff"
+
+
+def search_record(**fields):
+    """
+        Returns a plain record with attribute access. Records serialize
+        to JSON through their __dict__ (see json_encoder) like the
+        ORM objects they are built from.
+    """
+    return SimpleNamespace(**fields)
+
+
+class _SortedKeys(object):
+    """
+        Sorted (key, record id) pairs
+    """
+
+    def __init__(self, entries):
+        entries = sorted((key.casefold(), record_id) for key, record_id in entries if key)
+        self.keys = [x[0] for x in entries]
+        self.ids = [x[1] for x in entries]
+
+    def exact(self, query):
+        lo = bisect_left(self.keys, query)
+        hi = bisect_left(self.keys, query + "\0", lo)
+        return self.ids[lo:hi]
+
+    def prefix(self, query):
+        """
+            Yields ids of keys starting with query, in key order
+        """
+        n = bisect_left(self.keys, query)
+        hi = bisect_left(self.keys, query + _PREFIX_END, n)
+        while n < hi:
+            yield self.ids[n]
+            n += 1
+
+
+class PrefixIndex(object):
+    """
+        A ranked prefix index of records.
+
+        Args:
+            records - list of records
+            names - list of (name, record index)
+            aliases - list of (alias, record index)
+    """
+
+    def __init__(self, records, names, aliases=()):
+        self.records = records
+        self._names = _SortedKeys(names)
+        self._aliases = _SortedKeys(aliases)
+
+    def __len__(self):
+        return len(self.records)
+
+    def search(self, query, limit=10, prefix=True, aliases=True):
+        """
+            Returns records matching query, best matches first.
+
+            Args:
+                query - search string (case-insensitive)
+                limit - maximum number of records; None for all
+                prefix - include records with names starting with query
+                aliases - include records matched by alias
+        """
+        query = query.casefold()
+        if not query:
+            return []
+        sources = [self._names.exact(query)]
+        if prefix:
+            sources.append(self._names.prefix(query))
+        if aliases:
+            sources.append(self._aliases.exact(query))
+            if prefix:
+                sources.append(self._aliases.prefix(query))
+        seen = set()
+        results = []
+        for source in sources:
+            for record_id in source:
+                if record_id in seen:
+                    continue
+                seen.add(record_id)
+                results.append(self.records[record_id])
+                if limit is not None and len(results) == limit:
+                    return results
+        return results
+
+    def first(self, query):
+        """
+            Returns the best match for query, or None
+        """
+        results = self.search(query, limit=1)
+        return results[0] if results else None
+
+
+class LazyIndex(object):
+    """
+        Builds an index on first use and shares it between threads.
+
+        Args:
+            build_fn - function returning the index
+            version_fn - optional function returning the version of the
+                         source data; the index is rebuilt when it changes
+    """
+
+    def __init__(self, build_fn, version_fn=None):
+        self.build_fn = build_fn
+        self.version_fn = version_fn
+        self._index = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        version = self.version_fn() if self.version_fn else None
+        index = self._index
+        if index is None or version != self._version:
+            with self._lock:
+                if self._index is None or version != self._version:
+                    self._index = self.build_fn()
+                    self._version = version
+                index = self._index
+        return index
+
+    def reset(self):
+        with self._lock:
+            self._index = None
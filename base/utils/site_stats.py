@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Site statistics kept as counters in Google Datastore (kind 'site_stats').
+
+Mapping submissions and new users increment a counter entity for the
+day (day:YYYY-MM-DD); a report is counted on the day it is first
+submitted. A compaction job (flask compact_site_stats, run daily by
+cron) rebuilds the 'summary' entity from full scans of the trait and
+user kinds; it covers the days before the compaction, and corrects any
+increments that were lost. Statistics are read from the summary and the
+counters of the days since, a handful of entities. Reads never compact;
+until the first compaction only today's counters are returned.
+
+"""
+import arrow
+import pandas as pd
+from logzero import logger
+from base.utils.cache import stale_while_revalidate
+from base.utils.gcloud import (get_item, get_items, store_item, increment_item,
+                               query_item_iter, distinct_items)
+
+STATS_KIND = 'site_stats'
+
+
+def _day_name(day):
+    return f"day:{day.isoformat()}"
+
+
+def record_site_stats(**counts):
+    """
+        Adds counts (traits, reports, users) to the counters of today.
+        Failures are logged; statistics never block a request.
+    """
+    try:
+        increment_item(STATS_KIND, _day_name(arrow.utcnow().date()), **counts)
+    except Exception:
+        logger.exception("Updating site statistics failed")
+
+
+def compact_site_stats():
+    """
+        Rebuilds the summary of site statistics from the trait and
+        user kinds. The summary covers the days before today.
+
+        Returns:
+            the summary
+    """
+    today = arrow.utcnow().date()
+    traits = {}
+    first_day = {}
+    # Projected timestamps are returned as microseconds
+    for trait in query_item_iter('trait', ['report_slug', 'created_on']):
+        day = arrow.get(int(trait['created_on'])/1e6).date()
+        if day >= today:
+            continue
+        day = day.isoformat()
+        traits[day] = traits.get(day, 0) + 1
+        # Reports are counted on the day they were first submitted
+        report_slug = trait['report_slug']
+        first_day[report_slug] = min(day, first_day.get(report_slug, day))
+    reports = {}
+    for day in first_day.values():
+        reports[day] = reports.get(day, 0) + 1
+
+    # Users created today are counted by today's counter
+    today_counts = get_item(STATS_KIND, _day_name(today)) or {}
+    n_users = len(distinct_items('user', ['user_email'])) - today_counts.get('users', 0)
+
+    dates = sorted(traits)
+    summary = {'as_of': today.isoformat(),
+               'n_users': n_users,
+               'series': {'date': dates,
+                          'traits': [traits[x] for x in dates],
+                          'reports': [reports.get(x, 0) for x in dates]},
+               'updated_on': arrow.utcnow().datetime}
+    store_item(STATS_KIND, 'summary', exclude_from_indexes=['series'], **summary)
+    logger.info(f"Compacted site statistics: {len(dates)} days, {n_users} users")
+    return summary
+
+
+@stale_while_revalidate(timeout=60*10, stale_timeout=60*60*24, key_prefix='site_stats')
+def get_site_stats():
+    """
+        Returns site statistics:
+            mappings - DataFrame of the cumulative number of reports and
+                       traits by date (created_on, reports, traits)
+            n_users - the number of mapping users
+    """
+    summary = get_item(STATS_KIND, 'summary')
+    if summary is None:
+        # Compaction scans whole kinds and is left to cron and the CLI
+        logger.warning("Site statistics have not been compacted; returning today's counters")
+        summary = {'as_of': arrow.utcnow().date().isoformat()}
+    series = summary.get('series', {})
+    counts = {day: [reports, traits] for day, traits, reports in zip(series.get('date', []),
+                                                                     series.get('traits', []),
+                                                                     series.get('reports', []))}
+    n_users = summary.get('n_users', 0)
+
+    # Counters of the days since the summary
+    as_of = arrow.get(summary['as_of']).date()
+    today = arrow.utcnow().date()
+    days = [as_of.fromordinal(n) for n in range(as_of.toordinal(), today.toordinal() + 1)]
+    counters = get_items(STATS_KIND, [_day_name(x) for x in days])
+    for day in days:
+        counter = counters.get(_day_name(day)) or {}
+        n_users += counter.get('users', 0)
+        if counter.get('traits'):
+            counts[day.isoformat()] = [counter.get('reports', 0), counter.get('traits', 0)]
+
+    df = pd.DataFrame([[day] + x for day, x in sorted(counts.items())],
+                      columns=['created_on', 'reports', 'traits'])
+    df.reports = df.reports.cumsum()
+    df.traits = df.traits.cumsum()
+    return {'mappings': df,
+            'n_users': n_users}
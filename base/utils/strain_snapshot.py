@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+An in-memory snapshot of the strain table.
+
+The strain table only changes when the SQLite database is rebuilt,
+so it is read once per worker and served from memory. Row filters
+are boolean column arrays; reference strains, alias maps, strain sets,
+per-release counts and collection time series are precomputed.
+
+The snapshot is rebuilt when the database file changes (see db_version).
+
+"""
+import numpy as np
+import pandas as pd
+
+from base.models import db, db_version, Strain, StrainAlias
+from base.utils.bitmap import BitmapIndex
+from base.utils.geo_cluster import GridClusters
+from base.utils.search import LazyIndex
+
+
+# Facets of the strain filter API
+BOOLEAN_FACETS = ['sequenced', 'issues', 'isotype_ref_strain']
+VALUE_FACETS = ['strain_set', 'landscape', 'substrate']
+
+
+class StrainSnapshot(object):
+    """
+        Immutable snapshot of the strain and strain_alias tables.
+
+        Strains are detached Strain objects in table order; each has a
+        reference_strain attribute set to the reference strain of its
+        isotype. Selections return new lists of the shared objects,
+        which must not be modified.
+    """
+
+    def __init__(self):
+        strains = Strain.query.all()
+        for strain in strains:
+            db.session.expunge(strain)
+        self.strains = tuple(strains)
+        self.df = pd.DataFrame([x.as_dict() for x in strains],
+                               columns=[x.name for x in Strain.__table__.columns])
+        self.df['sampling_date'] = pd.to_datetime(self.df['sampling_date'])
+
+        # Columns
+        self.release = np.array([x.release for x in strains], dtype=np.int64)
+        self.no_issues = np.array([x.issues is False for x in strains], dtype=bool)
+        self.has_isotype = np.array([x.isotype is not None for x in strains], dtype=bool)
+        self.located = np.array([x.latitude is not None for x in strains], dtype=bool)
+        self.sequenced = np.array([x.sequenced is True for x in strains], dtype=bool)
+        self.isotype_ref = np.array([x.isotype_ref_strain is True for x in strains], dtype=bool)
+        self.latitude = np.array([x.latitude for x in strains], dtype=np.float64)
+        self.longitude = np.array([x.longitude for x in strains], dtype=np.float64)
+        for array in (self.release, self.no_issues, self.has_isotype, self.located,
+                      self.sequenced, self.isotype_ref, self.latitude, self.longitude):
+            array.flags.writeable = False
+
+        # Reference strains
+        self.ref_strains = {x.isotype: x.strain for x in strains if x.isotype_ref_strain}
+        for strain in strains:
+            strain.reference_strain = self.ref_strains.get(strain.isotype, None)
+        # Reference strains ordered by isotype (NULL first, as in SQLite)
+        self.isotype_order = sorted(np.flatnonzero(self.isotype_ref),
+                                    key=lambda n: strains[n].isotype or "")
+
+        # Rows by isotype
+        self.isotype_rows = {}
+        for n, strain in enumerate(strains):
+            self.isotype_rows.setdefault(strain.isotype, []).append(n)
+
+        # Rows by strain name and previous names, and the isotypes
+        # they resolve to (current names take precedence)
+        strain_rows = {x.strain: n for n, x in enumerate(strains)}
+        self.alias_rows = {}
+        self.alias_isotypes = {}
+        aliases = StrainAlias.query.with_entities(StrainAlias.alias,
+                                                  StrainAlias.strain,
+                                                  StrainAlias.previous_name) \
+                                   .all()
+        for alias, strain, previous_name in sorted(aliases, key=lambda x: not x.previous_name):
+            n = strain_rows.get(strain)
+            if n is None:
+                continue
+            self.alias_rows.setdefault(alias, []).append(n)
+            if self.no_issues[n] and self.has_isotype[n]:
+                self.alias_isotypes[alias] = strains[n].isotype
+        for rows in self.alias_rows.values():
+            rows.sort()
+
+        self.bitmaps = self._bitmaps()
+        # Map clusters of located strains (as in get_strains(known_origin=True))
+        located = self.located & self.has_isotype & self.no_issues
+        self.map_rows = np.flatnonzero(located & ~np.isnan(self.longitude))
+        self.map_clusters = GridClusters(self.latitude[self.map_rows],
+                                         self.longitude[self.map_rows])
+        self.strain_sets = self._strain_sets()
+        self.release_counts = self._release_counts()
+        self.cumulative_isotype, self.cumulative_strain = self._collection_series()
+
+    def select(self, mask):
+        return [self.strains[n] for n in np.flatnonzero(mask)]
+
+    def rows(self, rows, mask):
+        return [self.strains[n] for n in rows if mask[n]]
+
+    def _bitmaps(self):
+        """
+            Bitsets of facet values. The release facet selects
+            strains released up to (and including) a release.
+        """
+        bitmaps = BitmapIndex(len(self.strains))
+        for release in np.unique(self.release):
+            bitmaps.add_bitmap('release', str(release), self.release <= release)
+        for facet in BOOLEAN_FACETS:
+            column = np.array([getattr(x, facet) is True for x in self.strains], dtype=bool)
+            bitmaps.add_bitmap(facet, 'true', column)
+            bitmaps.add_bitmap(facet, 'false', ~column)
+        for facet in VALUE_FACETS:
+            bitmaps.add_column(facet, [getattr(x, facet) for x in self.strains])
+        return bitmaps
+
+    def in_bounds(self, min_lon, min_lat, max_lon, max_lat):
+        """
+            Returns the bitset of strains located within a bounding box.
+            Boxes crossing the antimeridian have min_lon > max_lon.
+        """
+        with np.errstate(invalid='ignore'):
+            mask = (self.latitude >= min_lat) & (self.latitude <= max_lat)
+            if min_lon <= max_lon:
+                mask &= (self.longitude >= min_lon) & (self.longitude <= max_lon)
+            else:
+                mask &= (self.longitude >= min_lon) | (self.longitude <= max_lon)
+        return self.bitmaps.pack(mask)
+
+    def _strain_sets(self):
+        result = self.df[['strain', 'isotype', 'strain_set']].dropna(how='any') \
+                                                             .groupby('strain_set') \
+                                                             .agg(list) \
+                                                             .to_dict()
+        return result['strain']
+
+    def _release_counts(self):
+        """
+            Strain, sequenced strain and isotype counts of
+            strains released up to each release.
+        """
+        releases = np.unique(self.release)
+        counts = []
+        for release in releases:
+            mask = (self.release <= release) & self.no_issues
+            isotypes = {x.isotype for x in self.select(mask & self.has_isotype)}
+            counts.append({'strain_count': int(mask.sum()),
+                           'strain_count_sequenced': int((mask & self.sequenced).sum()),
+                           'isotype_count': len(isotypes)})
+        return releases, counts
+
+    def release_summary(self, release):
+        releases, counts = self.release_counts
+        n = np.searchsorted(releases, int(release), side='right') - 1
+        if n < 0:
+            return {'strain_count': 0, 'strain_count_sequenced': 0, 'isotype_count': 0}
+        return dict(counts[n])
+
+    def _collection_series(self):
+        """
+            Cumulative isotype and strain counts by sampling date
+        """
+        df = self.df[self.df["issues"].eq(False)]
+        cumulative_isotype = df[['isotype', 'sampling_date']].sort_values(['sampling_date'], axis=0) \
+                                                             .drop_duplicates(['isotype']) \
+                                                             .groupby(['sampling_date'], as_index=True) \
+                                                             .count() \
+                                                             .cumsum() \
+                                                             .reset_index()
+        cumulative_strain = df[['strain', 'sampling_date']].sort_values(['sampling_date'], axis=0) \
+                                                           .drop_duplicates(['strain']) \
+                                                           .dropna(how='any') \
+                                                           .groupby(['sampling_date']) \
+                                                           .count() \
+                                                           .cumsum() \
+                                                           .reset_index()
+        return ((cumulative_isotype, len(df['isotype'].unique())),
+                (cumulative_strain, len(df['strain'].unique())))
+
+
+strain_snapshot = LazyIndex(StrainSnapshot, version_fn=db_version)
+
+
+def get_strain_snapshot():
+    """
+        Returns the strain snapshot of the current database
+    """
+    return strain_snapshot.get()
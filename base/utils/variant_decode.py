@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Decoding of variant records for the variant API.
+
+Genotype summaries are computed with numpy on the gt_types array.
+ANN fields are parsed once per distinct ANN string and cached for
+the life of the worker process; the same annotations are requested
+repeatedly as users browse the same genes.
+
+"""
+import sys
+import numpy as np
+from functools import lru_cache
+
+
+def gt_summary(gt_types):
+    """
+        Counts genotypes by type.
+
+        Args:
+            gt_types - numpy array of cyvcf2 gt_types (gts012=True)
+
+        Returns:
+            dict of {gt_type: count} for genotypes that are present
+    """
+    counts = np.bincount(gt_types, minlength=4)
+    return {n: int(count) for n, count in enumerate(counts.tolist()) if count}
+
+
+class AnnotationDecoder(object):
+    """
+        Parses and caches ANN fields.
+
+        Annotations are returned as dictionaries keyed by the ANN header
+        with gene_name filled in from gene_names. Cached annotations are
+        shared between requests and must not be modified.
+
+        Args:
+            header - ANN field names
+            gene_names - dict of gene_id --> gene name
+            maxsize - number of distinct ANN strings to cache
+    """
+
+    def __init__(self, header, gene_names, maxsize=20000):
+        self.header = header
+        self.gene_names = gene_names
+        self._decode = lru_cache(maxsize=maxsize)(self._parse)
+
+    def _parse(self, ANN):
+        annotations = []
+        for ANN_rec in ANN.split(","):
+            # Interning shares repeated values (effects, impacts, biotypes)
+            # between cached annotations.
+            annotation_dict = dict(zip(self.header, map(sys.intern, ANN_rec.split("|"))))
+            # Fill in locus id for gene name
+            annotation_dict["gene_name"] = self.gene_names.get(annotation_dict.get("gene_id"))
+            annotations.append(annotation_dict)
+        return tuple(annotations)
+
+    def decode(self, ANN, variant_impact=('ALL',)):
+        """
+            Returns the annotations of an ANN string matching variant_impact
+        """
+        if not ANN:
+            return []
+        annotations = self._decode(ANN)
+        if 'ALL' in variant_impact:
+            return list(annotations)
+        return [x for x in annotations if x.get('impact') in variant_impact]
+
+    def cache_info(self):
+        return self._decode.cache_info()
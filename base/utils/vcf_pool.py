@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Keeps release VCFs open between requests.
+
+Opening a remote VCF fetches and parses its header (and index
+on the first region query). The pool opens each release VCF once
+per worker process, caches its sample list and header, and hands
+out readers that are used by one thread at a time.
+
+"""
+import threading
+from queue import LifoQueue, Empty, Full
+from contextlib import contextmanager
+from cyvcf2 import VCF
+from logzero import logger
+
+
+class VCFReaderPool(object):
+    """
+        A pool of cyvcf2 readers keyed by (release, filter_type).
+
+        cyvcf2 readers are not thread-safe so each reader is checked out
+        by a single thread and returned to the pool when the region
+        query completes. Idle readers are reused; a new reader is only
+        opened when all existing readers are in use.
+
+        Args:
+            url_fn - function returning the VCF url for (release, filter_type)
+            max_idle - maximum number of idle readers kept per key
+            gts012 - passed to cyvcf2 (HOM_REF=0, HET=1, HOM_ALT=2, UNKNOWN=3)
+    """
+
+    def __init__(self, url_fn, max_idle=4, gts012=True):
+        self.url_fn = url_fn
+        self.max_idle = max_idle
+        self.gts012 = gts012
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._meta = {}
+        self._counts = {}
+
+    @staticmethod
+    def _key(release, filter_type):
+        return (str(release), filter_type)
+
+    def _count(self, key, field):
+        with self._lock:
+            counts = self._counts.setdefault(key, {'hits': 0, 'misses': 0, 'errors': 0})
+            counts[field] += 1
+
+    def _idle_queue(self, key):
+        with self._lock:
+            if key not in self._idle:
+                self._idle[key] = LifoQueue(maxsize=self.max_idle)
+            return self._idle[key]
+
+    def _open(self, key):
+        release, filter_type = key
+        url = self.url_fn(release=release, filter_type=filter_type)
+        logger.info(f"Opening VCF reader: {url}")
+        vcf = VCF(url, gts012=self.gts012)
+        if key not in self._meta:
+            with self._lock:
+                self._meta.setdefault(key, {'samples': list(vcf.samples),
+                                            'raw_header': vcf.raw_header,
+                                            'seqnames': list(vcf.seqnames)})
+        return vcf
+
+    def _metadata(self, key):
+        if key not in self._meta:
+            # Opening a reader populates the metadata; keep the reader for reuse.
+            with self.reader(*key):
+                pass
+        return self._meta[key]
+
+    def samples(self, release, filter_type="hard"):
+        """
+            Returns the sample list of a release VCF
+        """
+        return self._metadata(self._key(release, filter_type))['samples']
+
+    def header(self, release, filter_type="hard"):
+        """
+            Returns the raw header of a release VCF
+        """
+        return self._metadata(self._key(release, filter_type))['raw_header']
+
+    @contextmanager
+    def reader(self, release, filter_type="hard"):
+        """
+            Checks out a reader for the duration of a with block.
+
+            Readers that raise an error are closed rather than
+            being returned to the pool.
+
+            Usage:
+                with vcf_pool.reader(release) as vcf:
+                    for record in vcf("I:1-1000"):
+                        ...
+        """
+        key = self._key(release, filter_type)
+        idle = self._idle_queue(key)
+        try:
+            vcf = idle.get_nowait()
+            self._count(key, 'hits')
+        except Empty:
+            vcf = self._open(key)
+            self._count(key, 'misses')
+        failed = False
+        try:
+            yield vcf
+        except Exception:
+            failed = True
+            self._count(key, 'errors')
+            vcf.close()
+            raise
+        finally:
+            # Readers are also returned when a consumer stops iterating early.
+            if not failed:
+                try:
+                    idle.put_nowait(vcf)
+                except Full:
+                    vcf.close()
+
+    def stats(self):
+        """
+            Returns reader hit/miss counters for each release VCF
+        """
+        with self._lock:
+            result = {}
+            for key, counts in self._counts.items():
+                result[':'.join(key)] = dict(counts, idle=self._idle[key].qsize())
+            return result
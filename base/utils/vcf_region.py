@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Region queries against indexed release VCFs.
+
+Two interchangeable backends yield the same RegionRecord tuples:
+
+    iter_region_native - streams records from a pooled cyvcf2 reader
+                         and subsets samples in-process.
+    iter_spans_native - as iter_region_native, reading only the
+                        spans of a chromosome given by an impact index.
+    iter_region_bcftools - runs `bcftools view` and parses its output
+                           from a temporary file (legacy path).
+
+"""
+import numpy as np
+from collections import namedtuple
+from tempfile import NamedTemporaryFile
+from subprocess import Popen, PIPE
+from cyvcf2 import VCF
+from logzero import logger
+
+
+RegionRecord = namedtuple('RegionRecord', ['CHROM',
+                                           'POS',
+                                           'REF',
+                                           'ALT',
+                                           'FILTER',
+                                           'AF',
+                                           'ANN',
+                                           'gt_types',
+                                           'gt_bases',
+                                           'FT'])
+
+
+class RegionQueryError(Exception):
+    pass
+
+
+def _region_record(record, sample_idx=None):
+    """
+        Extracts the fields used by the variant API from a cyvcf2 record,
+        optionally subsetting the per-sample arrays.
+    """
+    gt_types = record.gt_types
+    gt_bases = record.gt_bases
+    try:
+        FT = record.format("FT")
+    except KeyError:
+        FT = None
+    if sample_idx is not None:
+        gt_types = gt_types[sample_idx]
+        gt_bases = gt_bases[sample_idx]
+        if FT is not None:
+            FT = FT[sample_idx]
+    else:
+        # gt_types is a view of the reader's buffer, which is
+        # reused when the reader advances to the next record.
+        gt_types = gt_types.copy()
+    if FT is not None:
+        FT = FT.ravel()
+    AF = record.INFO.get('AF')
+    if isinstance(AF, tuple):
+        AF = AF[0]
+    return RegionRecord(CHROM=record.CHROM,
+                        POS=record.POS,
+                        REF=record.REF,
+                        ALT=record.ALT,
+                        FILTER=record.FILTER or 'PASS',  # record.FILTER is 'None' for PASS
+                        AF=AF,
+                        ANN=record.INFO.get('ANN'),
+                        gt_types=gt_types,
+                        gt_bases=gt_bases,
+                        FT=FT)
+
+
+def sample_index(available_samples, samples):
+    """
+        Returns the column indices of samples within a VCF.
+
+        Args:
+            available_samples - the VCF sample list
+            samples - list of samples; None selects all samples
+    """
+    if samples is None:
+        return None
+    lookup = {sample: n for n, sample in enumerate(available_samples)}
+    return np.array([lookup[x] for x in samples], dtype=np.intp)
+
+
+def iter_region_native(vcf_pool, release, region, samples=None, filter_type="hard"):
+    """
+        Streams records in a region directly from the indexed release VCF.
+
+        Args:
+            vcf_pool - a VCFReaderPool
+            release - the dataset release
+            region - CHROM:START-END
+            samples - list of samples to return; None returns all samples
+    """
+    sample_idx = sample_index(vcf_pool.samples(release, filter_type), samples)
+    with vcf_pool.reader(release, filter_type) as vcf:
+        for record in vcf(region):
+            yield _region_record(record, sample_idx)
+
+
+def iter_spans_native(vcf_pool, release, chrom, spans, samples=None, filter_type="hard"):
+    """
+        Streams records from a list of spans on one chromosome
+        using a single pooled reader.
+
+        Records are returned once, in position order; records starting
+        before a span (already returned or not selected) are skipped.
+
+        Args:
+            vcf_pool - a VCFReaderPool
+            release - the dataset release
+            chrom - chromosome
+            spans - sorted, non-overlapping list of (start, end)
+            samples - list of samples to return; None returns all samples
+    """
+    sample_idx = sample_index(vcf_pool.samples(release, filter_type), samples)
+    with vcf_pool.reader(release, filter_type) as vcf:
+        for start, end in spans:
+            for record in vcf(f"{chrom}:{start}-{end}"):
+                if record.POS < start:
+                    continue
+                yield _region_record(record, sample_idx)
+
+
+def iter_region_bcftools(vcf_url, region, samples=None):
+    """
+        Runs bcftools view over a region and parses the result.
+
+        Args:
+            vcf_url - path or url of the VCF
+            region - CHROM:START-END
+            samples - list of samples to return; None returns all samples
+    """
+    comm = ["bcftools", "view", vcf_url, region]
+    if samples is not None:
+        comm = comm[0:2] + ['--force-samples', '--samples', ','.join(samples)] + comm[2:]
+    logger.debug(comm)
+    out, err = Popen(comm, stdout=PIPE, stderr=PIPE).communicate()
+    if not out and err:
+        logger.error(err)
+        raise RegionQueryError(err)
+    with NamedTemporaryFile(mode='w+b') as f:
+        f.write(out)
+        f.flush()
+        v = VCF(f.name, gts012=True)
+        if samples is not None:
+            incorrect_samples = [x for x in samples if x not in v.samples]
+            if incorrect_samples:
+                raise RegionQueryError("Incorrectly specified sample(s): " + ','.join(incorrect_samples))
+        for record in v:
+            yield _region_record(record)
@@ -10,9 +10,11 @@ from io import StringIO
 import pandas as pd
 import requests
 from flask import Blueprint
-from flask import render_template, url_for, request, redirect, session
-from base.utils.query import get_mappings_summary, get_weekly_visits, get_unique_users
+from flask import render_template, url_for, request, redirect, session, abort
+from base.utils.query import get_weekly_visits
+from base.utils.site_stats import get_site_stats, compact_site_stats
 from base.config import config
+from base.utils.cache import warm_cache
 from base.models import Strain
 from base.forms import donation_form
 from base.views.api.api_strain import get_isotypes
@@ -132,10 +134,14 @@ def statistics():
     n_strains = max(df.strain)
     n_isotypes = max(df.isotype)
 
+    # Fetch cached summaries with one cache lookup
+    site_stats, visits_df = warm_cache([get_site_stats, get_weekly_visits])
+    n_users = site_stats['n_users']
+
     #
     # Reports plot
     #
-    df = get_mappings_summary()
+    df = site_stats['mappings']
     report_summary_plot = time_series_plot(df,
                                            x_title='Date',
                                            y_title='Count',
@@ -144,13 +150,14 @@ def statistics():
                                            colors=['rgb(149, 150, 255)', 'rgb(81, 151, 35)']
                                            )
 
-    n_reports = int(max(df.reports))
-    n_traits = int(max(df.traits))
+    # The series is empty until site statistics are first compacted
+    n_reports = int(df.reports.max()) if len(df) else 0
+    n_traits = int(df.traits.max()) if len(df) else 0
 
     #
     # Weekly visits plot
     #
-    df = get_weekly_visits()
+    df = visits_df
     weekly_visits_plot = time_series_plot(df,
                                           x_title='Date',
                                           y_title='Count',
@@ -159,11 +166,6 @@ def statistics():
                                           colors=['rgb(255, 204, 102)'])
 
 
-    #
-    # Unique users
-    #
-    n_users = get_unique_users()
-
     VARS = {'title': title,
             'strain_collection_plot': strain_collection_plot,
             'report_summary_plot': report_summary_plot,
@@ -177,6 +179,18 @@ def statistics():
     return render_template('about/statistics.html', **VARS)
 
 
+@about_bp.route('/statistics/compact')
+def statistics_compact():
+    """
+        Rebuilds the site statistics summary; run daily by cron
+        (App Engine sets X-Appengine-Cron on cron requests only)
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        abort(403)
+    summary = compact_site_stats()
+    return f"Compacted site statistics as of {summary['as_of']}"
+
+
 @about_bp.route('/publications')
 def publications():
     """
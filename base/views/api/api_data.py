@@ -1,6 +1,7 @@
 import requests
 from base.extensions import cache
 from flask import Response, Blueprint
+from base.utils.decorators import jsonify_request
 
 api_data_bp = Blueprint('api_data',
                      __name__,
@@ -12,3 +13,12 @@ def wormbase_api(r):
     r = requests.get('http://www.wormbase.org/rest/' + r, headers = {'Content-Type': 'application/json; charset=utf-8'}
 )
     return Response(r.text, mimetype="text/json")
+
+
+@api_data_bp.route('/cache/stats')
+@jsonify_request
+def cache_stats():
+    """
+        Returns hit/miss counters of each cache tier for this worker
+    """
+    return cache.cache.stats()
@@ -1,7 +1,9 @@
+import re
 from flask import request
-from base.models import Homologs, WormbaseGeneSummary
+from base.models import Homologs, WormbaseGene, WormbaseGeneSummary, db_version
 from base.utils.decorators import jsonify_request
-from sqlalchemy import or_, func
+from base.utils.interval_index import GeneModels
+from base.utils.search import PrefixIndex, LazyIndex, search_record
 from base.views.api.api_variant import variant_query
 from logzero import logger
 
@@ -12,6 +14,104 @@ api_gene_bp = Blueprint('api_gene',
                      template_folder='api')
 
 
+def _columns(model):
+    return [getattr(model, x.key) for x in model.__mapper__.column_attrs]
+
+
+def gene_records():
+    """
+        Returns the rows of the gene summary table as records
+    """
+    columns = _columns(WormbaseGeneSummary)
+    keys = [x.key for x in columns]
+    return [search_record(**dict(zip(keys, row)))
+            for row in WormbaseGeneSummary.query.with_entities(*columns)]
+
+
+def build_gene_index():
+    """
+        Indexes genes by locus, sequence name and gene ID
+    """
+    genes = gene_records()
+    names = []
+    for n, gene in enumerate(genes):
+        names += [(gene.locus, n), (gene.sequence_name, n), (gene.gene_id, n)]
+    return PrefixIndex(genes, names)
+
+
+def build_homolog_index():
+    """
+        Indexes homologs by homolog gene name. Records are
+        unnested with their C. elegans gene (see Homologs.unnest).
+    """
+    homolog_columns = _columns(Homologs)
+    gene_columns = _columns(WormbaseGeneSummary)
+    homolog_keys = [x.key for x in homolog_columns]
+    gene_keys = [x.key for x in gene_columns]
+    rows = Homologs.query.outerjoin(Homologs.gene_summary) \
+                         .with_entities(*homolog_columns, *gene_columns)
+    homologs = []
+    names = []
+    n_homolog = len(homolog_columns)
+    for row in rows:
+        fields = dict(zip(homolog_keys, row[:n_homolog]))
+        if row[n_homolog] is not None:
+            fields.update(zip(gene_keys, row[n_homolog:]))
+        fields['gene_summary'] = None
+        names.append((fields['homolog_gene'], len(homologs)))
+        homologs.append(search_record(**fields))
+    return PrefixIndex(homologs, names)
+
+
+def build_gene_models():
+    """
+        Builds transcript models (exons and CDS) from the gene table
+        and interval indexes over genes and transcripts.
+    """
+    transcripts = {}
+    rows = WormbaseGene.query.filter(WormbaseGene.feature == 'transcript') \
+                             .with_entities(WormbaseGene.transcript_id,
+                                            WormbaseGene.gene_id,
+                                            WormbaseGene.locus,
+                                            WormbaseGene.chrom,
+                                            WormbaseGene.start,
+                                            WormbaseGene.end,
+                                            WormbaseGene.strand,
+                                            WormbaseGene.transcript_biotype)
+    for transcript_id, gene_id, locus, chrom, start, end, strand, biotype in rows:
+        transcripts[transcript_id] = {'transcript_id': transcript_id,
+                                      'gene_id': gene_id,
+                                      'locus': locus,
+                                      'chrom': chrom,
+                                      'start': start,
+                                      'end': end,
+                                      'strand': strand,
+                                      'biotype': biotype,
+                                      'exons': [],
+                                      'cds': []}
+    rows = WormbaseGene.query.filter(WormbaseGene.feature.in_(['exon', 'CDS'])) \
+                             .with_entities(WormbaseGene.transcript_id,
+                                            WormbaseGene.feature,
+                                            WormbaseGene.start,
+                                            WormbaseGene.end)
+    for transcript_id, feature, start, end in rows:
+        transcript = transcripts.get(transcript_id)
+        if transcript:
+            transcript['exons' if feature == 'exon' else 'cds'].append([start, end])
+    for transcript in transcripts.values():
+        transcript['exons'].sort()
+        transcript['cds'].sort()
+    return GeneModels(gene_records(), list(transcripts.values()))
+
+
+gene_index = LazyIndex(build_gene_index, version_fn=db_version)
+homolog_index = LazyIndex(build_homolog_index, version_fn=db_version)
+gene_models = LazyIndex(build_gene_models, version_fn=db_version)
+
+# Maximum region size of gene model queries
+MAX_REGION_SIZE = int(5e6)
+
+
 @api_gene_bp.route('/gene/homolog/<string:query>')
 @jsonify_request
 def query_homolog(query=""):
@@ -27,12 +127,7 @@ def query_homolog(query=""):
 
     """
     query = request.args.get('query') or query
-    query = query.lower()
-    results = Homologs.query.filter(func.lower(Homologs.homolog_gene)==query) \
-                              .limit(10) \
-                              .all()
-    results = [x.unnest() for x in results]
-    return results
+    return homolog_index.get().search(query, limit=10, prefix=False)
 
 
 @api_gene_bp.route('/gene/lookup/<string:query>')
@@ -50,17 +145,8 @@ def lookup_gene(query=""):
 
     """
     query = request.args.get('query') or query
-    # First identify exact match
-    result = WormbaseGeneSummary.query.filter(or_(WormbaseGeneSummary.locus == query,
-                                                  WormbaseGeneSummary.sequence_name == query,
-                                                  WormbaseGeneSummary.gene_id == query)) \
-                                           .first()
-    if not result:
-        result = WormbaseGeneSummary.query.filter(or_(WormbaseGeneSummary.locus.startswith(query),
-                                                          WormbaseGeneSummary.sequence_name.startswith(query),
-                                                          WormbaseGeneSummary.gene_id.startswith(query))) \
-                                               .first()
-    return result
+    # Exact matches are ranked before prefix matches
+    return gene_index.get().first(query)
 
 
 @api_gene_bp.route('/gene/search/<string:query>')
@@ -79,12 +165,7 @@ def query_gene(query=""):
 
     """
     query = request.args.get('query') or query
-    results = WormbaseGeneSummary.query.filter(or_(WormbaseGeneSummary.locus.startswith(query),
-                                                       WormbaseGeneSummary.sequence_name.startswith(query),
-                                                       WormbaseGeneSummary.gene_id.startswith(query))) \
-                                           .limit(10) \
-                                           .all()
-    return results
+    return gene_index.get().search(query, limit=10)
 
 
 @api_gene_bp.route('/gene/browser-search/<string:query>')
@@ -103,6 +184,33 @@ def combined_search(query=""):
 
 
 
+@api_gene_bp.route('/gene/region/<string:region>')
+@jsonify_request
+def gene_region(region):
+    """Genes and transcript models in a region
+
+    Args:
+        region (str): CHROM:START-END
+
+    Returns:
+        result (dict): genes and transcripts overlapping the region;
+                       transcripts list their exons and CDS as [start, end].
+
+    """
+    try:
+        chrom, start, end = re.split(':|-', region.replace(",", ""))
+        start, end = int(start), int(end)
+    except ValueError:
+        return {"error": "Region must be CHROM:START-END"}, 400
+    if end < start:
+        return {"error": "Invalid start and end region values"}, 400
+    if end - start > MAX_REGION_SIZE:
+        return {"error": f"Regions are limited to {MAX_REGION_SIZE:,} bp"}, 400
+    models = gene_models.get()
+    return {"genes": models.region_genes(chrom, start, end),
+            "transcripts": models.region_transcripts(chrom, start, end)}
+
+
 @api_gene_bp.route('/gene/variants/<string:query>')
 @jsonify_request
 def gene_variants(query):
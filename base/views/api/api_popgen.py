@@ -1,15 +1,53 @@
-from flask import jsonify
-from base.application import app
-from subprocess import Popen, PIPE
-from base.constants import DATASET_RELEASE
-from base.views.api.api_variant import variant_query
-from base.views.api.api_strain import get_isotypes
+import requests
+import numpy as np
+from flask import request
+from functools import lru_cache
+from base.config import DATASET_RELEASE
+from base.views.api.api_variant import (vcf_pool,
+                                        get_genotype_store,
+                                        ann_decoder,
+                                        record_output)
+from base.models import db_version
 from base.utils.decorators import jsonify_request
+from base.utils.block_cache import cached_url
+from base.utils.strain_snapshot import get_strain_snapshot
+from base.utils.popgen import (TajimaTrack,
+                               allele_counts,
+                               windowed_diversity,
+                               windowed_hudson_fst)
+from base.utils.vcf_region import sample_index, iter_spans_native
 from logzero import logger
 
+from flask import Blueprint
 
-@app.route('/api/popgen/tajima/<string:chrom>/<int:start>/<int:end>')
-@app.route('/api/popgen/tajima/<string:chrom>/<int:start>/<int:end>/<int:release>')
+api_popgen_bp = Blueprint('api_popgen',
+                          __name__,
+                          template_folder='api')
+
+
+@lru_cache(maxsize=None)
+def get_tajima_track(release):
+    """
+        Loads the Tajima's D track of a release (once per worker process)
+    """
+    url = f"http://storage.googleapis.com/elegansvariation.org/releases/{release}/popgen/WI.{release}.tajima.bed.gz"
+    response = requests.get(cached_url(url), timeout=60)
+    response.raise_for_status()
+    return TajimaTrack(response.content)
+
+
+def get_release_samples(release):
+    """
+        Returns the isotypes of a release
+    """
+    genotype_store = get_genotype_store(str(release))
+    if genotype_store:
+        return genotype_store.samples
+    return vcf_pool.samples(release)
+
+
+@api_popgen_bp.route('/popgen/tajima/<string:chrom>/<int:start>/<int:end>')
+@api_popgen_bp.route('/popgen/tajima/<string:chrom>/<int:start>/<int:end>/<int:release>')
 @jsonify_request
 def tajima(chrom, start, end, release = DATASET_RELEASE):
     """
@@ -17,6 +55,8 @@ def tajima(chrom, start, end, release = DATASET_RELEASE):
             chrom
             start
             end
+            points (query parameter) - maximum number of points returned;
+                                       windows are averaged to fit
 
         Output:
             JSON dict of x (position) and y (Tajima's scores) for
@@ -28,45 +68,298 @@ def tajima(chrom, start, end, release = DATASET_RELEASE):
 
     """
     # No tajima bedfile exists for 20160408 - so use next version.
-    if release < 20170531:
+    if int(release) < 20170531:
         release = 20170531
-    url = f"http://storage.googleapis.com/elegansvariation.org/releases/{release}/popgen/WI.{release}.tajima.bed.gz"
-    comm = ['tabix', url, "{chrom}:{start}-{end}".format(**locals())]
-    out, err = Popen(comm, stdout=PIPE, stderr=PIPE).communicate()
-
-    if not out and err:
-        return jsonify(error=str(err, encoding='utf-8')), 404
-    out = [x.split("\t") for x in str(out, encoding='ascii').splitlines()]
-    data = [(int(x[2]) + 50000, float(x[5])) for x in out]
-    response = {"x": [x[0] for x in data],
-                "y": [x[1] for x in data]}
+    try:
+        track = get_tajima_track(int(release))
+    except requests.RequestException as e:
+        return {"error": str(e)}, 404
+    x, y = track.query(chrom, start, end, points=request.args.get('points', type=int))
+    response = {"x": x.tolist(),
+                "y": y.tolist()}
     return response
 
 
-@app.route('/api/popgen/gt/<string:chrom>/<int:pos>')
-@app.route('/api/popgen/gt/<string:chrom>/<int:pos>/<int:release>')
+@lru_cache(maxsize=8)
+def isotype_locations(release, version=None):
+    """
+        Returns the sampling locations of isotypes as arrays aligned
+        to the sample order of a release.
+
+        Args:
+            release - the dataset release
+            version - the database version (see db_version); cached
+                      locations are not reused across databases
+
+        Returns:
+            dict of located (bool), latitude, longitude, elevation
+            (NaN where unknown)
+    """
+    samples = get_release_samples(release)
+    sample_idx = {sample: n for n, sample in enumerate(samples)}
+    locations = {'located': np.zeros(len(samples), dtype=bool),
+                 'latitude': np.full(len(samples), np.nan),
+                 'longitude': np.full(len(samples), np.nan),
+                 'elevation': np.full(len(samples), np.nan)}
+    snapshot = get_strain_snapshot()
+    for strain in snapshot.select(snapshot.isotype_ref & snapshot.located):
+        n = sample_idx.get(strain.isotype)
+        if n is not None:
+            locations['located'][n] = True
+            locations['latitude'][n] = strain.latitude
+            locations['longitude'][n] = strain.longitude
+            locations['elevation'][n] = np.nan if strain.elevation is None else strain.elevation
+    return locations
+
+
+def variant_geo(variant, locations):
+    """
+        Adds isotype locations to the genotypes of a variant
+        (see record_output, for all strains) and removes
+        isotypes without a known location.
+    """
+    located = np.flatnonzero(locations['located']).tolist()
+    latitude = locations['latitude'].tolist()
+    longitude = locations['longitude'].tolist()
+    elevation = locations['elevation'].tolist()
+    GT = variant['GT']
+    variant['GT'] = [dict(GT[n],
+                          latitude=latitude[n],
+                          longitude=longitude[n],
+                          elevation=None if np.isnan(elevation[n]) else elevation[n]) for n in located]
+    return variant
+
+
+# Maximum number of positions per request
+MAX_GT_POSITIONS = 100
+
+
+@api_popgen_bp.route('/popgen/gt/<string:chrom>/<string:positions>')
+@api_popgen_bp.route('/popgen/gt/<string:chrom>/<string:positions>/<int:release>')
 @jsonify_request
-def get_allele_geo(chrom, pos, isotypes=None, release = DATASET_RELEASE):
+def get_allele_geo(chrom, positions, isotypes=None, release = DATASET_RELEASE):
     """
+        Returns the genotypes and locations of isotypes at one or more positions.
+
         Args:
             chrom
-            pos
+            positions - a position, or comma-delimited positions
             isotypes
+
+        Output:
+            For a single position, the variant starting at the position
+            (see variant_query) with latitude, longitude and elevation
+            added to each genotype; only isotypes with a known location
+            are included.
+
+            For multiple positions, a list of variants in the order of
+            positions (null where there is no variant).
+    """
+    try:
+        positions = [int(x) for x in str(positions).split(",")]
+    except ValueError:
+        return {"error": "Invalid position"}, 400
+    if len(positions) > MAX_GT_POSITIONS:
+        return {"error": f"A maximum of {MAX_GT_POSITIONS} positions can be queried at once"}, 400
+
+    locations = isotype_locations(str(release), db_version())
+    # Positions are read in order with one reader (or one slice of the
+    # genotype store) and records are mapped back to the positions.
+    sorted_positions = sorted(set(positions))
+    genotype_store = get_genotype_store(str(release))
+    if genotype_store:
+        sample_names = genotype_store.samples
+        records = genotype_store.iter_positions(chrom, sorted_positions)
+    else:
+        sample_names = vcf_pool.samples(release)
+        records = iter_spans_native(vcf_pool, release, chrom, [(pos, pos) for pos in sorted_positions])
+    by_position = {}
+    for record in records:
+        # Multi-allelic sites may be split into several records; keep the first
+        if record.POS not in by_position:
+            variant = record_output(record, ann_decoder.decode(record.ANN, ['ALL']), sample_names)
+            by_position[record.POS] = variant_geo(variant, locations)
+    variants = [by_position.get(pos) for pos in positions]
+
+    if len(positions) == 1:
+        return variants[0] or []
+    return variants
+
+
+# Maximum number of windows computed per request
+MAX_WINDOWS = 10000
+
+# Variants whose genotypes are unpacked at a time
+COUNT_CHUNK_SIZE = 16384
+
+
+def group_allele_counts(release, chrom, start, end, groups):
+    """
+        Counts called and alternative alleles of groups of isotypes
+        for each variant in a region.
+
+        Genotypes are read from the genotype store of the release
+        when one has been built, and from the release VCF otherwise.
+
+        Args:
+            release - the dataset release
+            chrom, start, end - the region
+            groups - list of lists of isotypes
+
+        Returns:
+            (pos, [(n, k) for each group])
+    """
+    genotype_store = get_genotype_store(str(release))
+    if genotype_store:
+        sample_idx = [genotype_store.sample_index(group) for group in groups]
+        if chrom not in genotype_store.chroms:
+            pos = np.zeros(0, dtype=np.int32)
+            return pos, [(pos, pos) for group in groups]
+        region = genotype_store.region(chrom, start, end)
+        pos = np.asarray(genotype_store.arrays(chrom)['pos'][region])
+        chunks = []
+        for chunk_start in range(region.start, region.stop, COUNT_CHUNK_SIZE):
+            chunk = slice(chunk_start, min(chunk_start + COUNT_CHUNK_SIZE, region.stop))
+            gt_types = genotype_store.genotypes(chrom, chunk)
+            chunks.append([allele_counts(gt_types[:, idx]) for idx in sample_idx])
+    else:
+        sample_idx = [sample_index(vcf_pool.samples(release), group) for group in groups]
+        pos = []
+        chunks = []
+        gt_rows = []
+        with vcf_pool.reader(release) as vcf:
+            for record in vcf(f"{chrom}:{start}-{end}"):
+                if record.POS < start:
+                    continue
+                pos.append(record.POS)
+                gt_rows.append(record.gt_types.copy())
+                if len(gt_rows) == COUNT_CHUNK_SIZE:
+                    gt_types = np.vstack(gt_rows)
+                    chunks.append([allele_counts(gt_types[:, idx]) for idx in sample_idx])
+                    gt_rows = []
+        if gt_rows:
+            gt_types = np.vstack(gt_rows)
+            chunks.append([allele_counts(gt_types[:, idx]) for idx in sample_idx])
+        pos = np.array(pos, dtype=np.int32)
+    counts = []
+    for group in range(len(groups)):
+        n = np.concatenate([chunk[group][0] for chunk in chunks] or [np.zeros(0, dtype=np.int64)])
+        k = np.concatenate([chunk[group][1] for chunk in chunks] or [np.zeros(0, dtype=np.int64)])
+        counts.append((n, k))
+    return pos, counts
+
+
+def window_args(start, end):
+    """
+        Reads window and step (bp) from the query string.
+
+        Returns:
+            (window, step) or raises ValueError
+    """
+    window = request.args.get('window', 10000, type=int)
+    step = request.args.get('step', window, type=int)
+    if window < 1 or step < 1:
+        raise ValueError("window and step must be positive")
+    if end < start:
+        raise ValueError("Invalid start and end region values")
+    if (end - start) // step + 1 > MAX_WINDOWS:
+        raise ValueError(f"A maximum of {MAX_WINDOWS} windows can be computed at once")
+    return window, step
+
+
+def isotype_arg(name, release, default=None):
+    """
+        Reads a comma-delimited list of isotypes from the query string.
+
+        Raises ValueError for isotypes that are not in the release.
+    """
+    available_samples = get_release_samples(release)
+    value = request.args.get(name)
+    if not value:
+        if default is None:
+            raise ValueError(f"{name} is required")
+        return default
+    isotypes = value.split(",")
+    unknown = [x for x in isotypes if x not in available_samples]
+    if unknown:
+        raise ValueError("Unknown isotype(s): " + ",".join(unknown))
+    return isotypes
+
+
+def json_array(values):
+    """
+        Converts an array to a list with NaN as null
+    """
+    if values.dtype.kind == 'f':
+        return [None if np.isnan(x) else x for x in values.tolist()]
+    return values.tolist()
+
+
+@api_popgen_bp.route('/popgen/diversity/<string:chrom>/<int:start>/<int:end>')
+@api_popgen_bp.route('/popgen/diversity/<string:chrom>/<int:start>/<int:end>/<int:release>')
+@jsonify_request
+def popgen_diversity(chrom, start, end, release=DATASET_RELEASE):
+    """
+        Computes windowed nucleotide diversity (pi), Watterson's theta
+        and Tajima's D.
+
+        Args:
+            chrom
+            start
+            end
+            isotypes (query parameter) - comma-delimited isotypes (default all)
+            window (query parameter) - window size in bp (default 10,000)
+            step (query parameter) - window step in bp (default window)
+
+        Output:
+            {
+                "start": [<window start>],
+                "end": [<window end>],
+                "n_variants": [<variants in window>],
+                "pi": [<pi per bp>],
+                "theta_w": [<Watterson's theta per bp>],
+                "tajima_d": [<Tajima's D or null>]
+            }
+    """
+    try:
+        window, step = window_args(start, end)
+        isotypes = isotype_arg('isotypes', release, default=get_release_samples(release))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    pos, [(n, k)] = group_allele_counts(release, chrom, start, end, [isotypes])
+    result = windowed_diversity(pos, n, k, start, end, window, step)
+    return {key: json_array(value) for key, value in result.items()}
+
+
+@api_popgen_bp.route('/popgen/fst/<string:chrom>/<int:start>/<int:end>')
+@api_popgen_bp.route('/popgen/fst/<string:chrom>/<int:start>/<int:end>/<int:release>')
+@jsonify_request
+def popgen_fst(chrom, start, end, release=DATASET_RELEASE):
+    """
+        Computes windowed Hudson Fst between two groups of isotypes.
+
+        Args:
+            chrom
+            start
+            end
+            pop1, pop2 (query parameters) - comma-delimited isotypes
+            window (query parameter) - window size in bp (default 10,000)
+            step (query parameter) - window step in bp (default window)
+
+        Output:
+            {
+                "start": [<window start>],
+                "end": [<window end>],
+                "n_variants": [<variants in window>],
+                "fst": [<Hudson Fst or null>]
+            }
     """
     try:
-        variant = variant_query(f"{chrom}:{pos}-{pos+1}", list_all_strains=True, release=release)[0]
-    except IndexError:
-        return []
-
-    isotypes = get_isotypes(known_origin=True)
-    isotypes = {x._asdict()['isotype']: x for x in isotypes}
-    for gt in variant['GT']:
-        try:
-            isotype_loc = {'latitude': isotypes[gt['SAMPLE']].latitude,
-                           'longitude': isotypes[gt['SAMPLE']].longitude,
-                           'elevation': isotypes[gt['SAMPLE']].elevation}
-            gt.update(isotype_loc)
-        except KeyError:
-            pass
-    variant['GT'] = [x for x in variant['GT'] if x.get('latitude')]
-    return variant
\ No newline at end of file
+        window, step = window_args(start, end)
+        pop1 = isotype_arg('pop1', release)
+        pop2 = isotype_arg('pop2', release)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    pos, [(n1, k1), (n2, k2)] = group_allele_counts(release, chrom, start, end, [pop1, pop2])
+    result = windowed_hudson_fst(pos, n1, k1, n2, k2, start, end, window, step)
+    return {key: json_array(value) for key, value in result.items()}
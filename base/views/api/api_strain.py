@@ -1,6 +1,8 @@
-from base.models import Strain
+import numpy as np
+from base.models import db_version
 from base.utils.decorators import jsonify_request
-from sqlalchemy import or_
+from base.utils.search import PrefixIndex, LazyIndex
+from base.utils.strain_snapshot import get_strain_snapshot, BOOLEAN_FACETS, VALUE_FACETS
 from flask import request
 from logzero import logger
 
@@ -11,20 +13,182 @@ api_strain_bp = Blueprint('api_strain',
                           template_folder='api')
 
 
+def build_strain_index():
+    """
+        Indexes strains by isotype and strain name, with
+        previous strain names as aliases
+    """
+    snapshot = get_strain_snapshot()
+    strains = [x.to_json() for x in snapshot.select(snapshot.has_isotype)]
+    names = []
+    aliases = []
+    for n, strain in enumerate(strains):
+        names += [(strain['isotype'], n), (strain['strain'], n)]
+        if strain['previous_names']:
+            aliases += [(x.strip(), n) for x in strain['previous_names'].split(",")]
+    return PrefixIndex(strains, names, aliases)
+
+
+strain_index = LazyIndex(build_strain_index, version_fn=db_version)
+
+
+def resolve_isotypes(strain_names):
+    """
+        Resolves strain names (current or previous) to isotypes.
+
+        Args:
+            strain_names - list of strain names
+
+        Returns:
+            list of isotypes; None for unknown strains
+    """
+    aliases = get_strain_snapshot().alias_isotypes
+    return [aliases.get(x) for x in strain_names]
+
+
 @api_strain_bp.route('/strain/query/<string:query>')
 @jsonify_request
 def search_strains(query):
-    base_query = Strain.query.filter(Strain.isotype != None)
-    query = query.upper()
-    results = base_query.filter(or_(Strain.isotype == query,
-                                    Strain.isotype.like(f"{query}%"),
-                                    Strain.strain == query,
-                                    Strain.strain.like(f"{query}%"),
-                                    Strain.previous_names.like(f"%{query},%"),
-                                    Strain.previous_names.like(f"%,{query},"),
-                                    Strain.previous_names.like(f"%{query}"),
-                                    Strain.previous_names == query))
-    return list([x.to_json() for x in results])
+    return strain_index.get().search(query, limit=None)
+
+
+def bbox_arg(args):
+    """
+        Reads a bounding box (min_lon,min_lat,max_lon,max_lat) from
+        the query string. Longitudes are wrapped to [-180, 180].
+
+        Returns:
+            list of four floats, None if absent, or raises ValueError
+    """
+    bbox = args.get('bbox')
+    if not bbox:
+        return None
+    try:
+        bbox = [float(x) for x in bbox.split(",")]
+    except ValueError:
+        bbox = None
+    if not bbox or len(bbox) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if max_lon - min_lon >= 360:
+        return [-180, min_lat, 180, max_lat]
+    min_lon, max_lon = [x if -180 <= x <= 180 else (x + 180) % 360 - 180 for x in (min_lon, max_lon)]
+    return [min_lon, min_lat, max_lon, max_lat]
+
+
+def filter_args(args):
+    """
+        Reads facet selections and the bounding box of a strain filter.
+
+        Facet values are comma-delimited; boolean facets take true or false.
+        The bounding box is min_lon,min_lat,max_lon,max_lat.
+
+        Returns:
+            (selections, bbox) or raises ValueError
+    """
+    selections = {}
+    for facet in ['release'] + BOOLEAN_FACETS + VALUE_FACETS:
+        value = args.get(facet)
+        if value:
+            selections[facet] = value.split(",")
+    for facet in BOOLEAN_FACETS:
+        if not set(selections.get(facet, [])) <= {'true', 'false'}:
+            raise ValueError(f"{facet} must be true or false")
+    for value in selections.get('release', []):
+        if not value.isdigit():
+            raise ValueError(f"Invalid release: {value}")
+    return selections, bbox_arg(args)
+
+
+@api_strain_bp.route('/strain/filter')
+@jsonify_request
+def filter_strains():
+    """
+        Filters strains by any combination of facets.
+
+        Query parameters:
+            release - strains released up to a release
+            strain_set, landscape, substrate - comma-delimited values
+            sequenced, issues, isotype_ref_strain - true or false
+            bbox - min_lon,min_lat,max_lon,max_lat of strain locations
+            offset, limit - the page of strains returned
+
+        Values within a facet are combined with OR, facets with AND.
+
+        Returns:
+            count - number of matching strains
+            strains - the requested page of matching strains
+            facets - for each facet, the number of strains matching each
+                     of its values together with the other facets
+    """
+    try:
+        selections, bbox = filter_args(request.args)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+
+    snapshot = get_strain_snapshot()
+    bitmaps = snapshot.bitmaps
+    bbox_bits = snapshot.in_bounds(*bbox) if bbox else None
+    rows = bitmaps.rows(bitmaps.query(selections, bbox_bits))
+    page = rows[offset:] if limit is None else rows[offset:offset + max(limit, 0)]
+    return {"count": len(rows),
+            "strains": [snapshot.strains[n] for n in page],
+            "facets": bitmaps.counts(selections, bbox_bits)}
+
+
+@api_strain_bp.route('/strain/map/<int:zoom>')
+@jsonify_request
+def strain_map_clusters(zoom):
+    """
+        Returns clusters of strains with a known origin for a map view.
+
+        Strains are grouped in grid cells for each zoom level.
+
+        Args:
+            zoom - map zoom level
+            bbox (query parameter) - min_lon,min_lat,max_lon,max_lat of the view
+
+        Returns:
+            clusters - list of cell, count and centroid latitude/longitude;
+                       clusters of one strain include the strain
+            max_zoom - zoom level from which clusters no longer split
+    """
+    try:
+        bbox = bbox_arg(request.args)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    snapshot = get_strain_snapshot()
+    clusters = snapshot.map_clusters.clusters(zoom, bbox)
+    result = []
+    for key, count, latitude, longitude in zip(clusters['key'].tolist(),
+                                               clusters['count'].tolist(),
+                                               clusters['latitude'].tolist(),
+                                               clusters['longitude'].tolist()):
+        cluster = {"cell": key, "count": count, "latitude": latitude, "longitude": longitude}
+        if count == 1:
+            member = snapshot.map_clusters.members(zoom, key)[0]
+            cluster["strain"] = snapshot.strains[snapshot.map_rows[member]]
+        result.append(cluster)
+    return {"clusters": result, "max_zoom": snapshot.map_clusters.max_zoom}
+
+
+@api_strain_bp.route('/strain/map/<int:zoom>/<int:cell>')
+@jsonify_request
+def strain_map_cell(zoom, cell):
+    """
+        Expands a map cluster (see strain_map_clusters).
+
+        Returns:
+            isotypes - isotypes in the cluster
+            strains - strains in the cluster
+    """
+    snapshot = get_strain_snapshot()
+    members = snapshot.map_clusters.members(zoom, cell)
+    strains = [snapshot.strains[n] for n in snapshot.map_rows[members]]
+    return {"isotypes": sorted({x.isotype for x in strains}),
+            "strains": strains}
 
 
 @api_strain_bp.route('/strain/')
@@ -41,36 +205,26 @@ def query_strains(strain_name=None, isotype_name=None, release=None, all_strain_
         all_strain_names - Return list of all possible strain names (internal use).
         resolve_isotype - Use to search for strains and return their isotype
     """
-    query = Strain.query
-    if release:
-        query = query.filter(Strain.release <= release)
-    if strain_name or resolve_isotype:
-        query = query.filter(or_(Strain.previous_names.like(f"%{strain_name},%"),
-                                        Strain.previous_names.like(f"%,{strain_name},"),
-                                        Strain.previous_names.like(f"%{strain_name}"),
-                                        Strain.previous_names == strain_name,
-                                        Strain.strain == strain_name)).first()
+    if resolve_isotype:
+        return resolve_isotypes([strain_name])[0]
+    snapshot = get_strain_snapshot()
+    if strain_name:
+        rows = snapshot.alias_rows.get(strain_name, [])
     elif isotype_name:
-        query = query.filter(Strain.isotype == isotype_name)
+        rows = snapshot.isotype_rows.get(isotype_name, [])
     else:
-        query = query
+        rows = range(len(snapshot.strains))
 
+    mask = np.ones(len(snapshot.strains), dtype=bool)
+    if release:
+        mask &= snapshot.release <= int(release)
     if issues is False:
-        query = query.filter(Strain.issues == False)
-        query = query.filter(Strain.isotype != None)
-        query = query.all()
-    else:
-        query = query.all()
+        mask &= snapshot.no_issues & snapshot.has_isotype
+    query = snapshot.rows(rows, mask)
 
     if all_strain_names:
         previous_strain_names = sum([x.previous_names.split(",") for x in query if x.previous_names], [])
         results = [x.strain for x in query] + previous_strain_names
-    if resolve_isotype:
-        if query:
-            # LSJ1/LSJ2 prev. N2; So N2 needs to be specific.
-            if strain_name == 'N2':
-                return 'N2'
-            return query.isotype
     return query
 
 
@@ -84,21 +238,17 @@ def get_strains(known_origin=False, issues=False):
             known_origin: Returns only strains with a known origin
             issues: Return only strains without issues
     """
-    ref_strain_list = Strain.query.filter(Strain.isotype_ref_strain == True).all()
-    ref_strain_list = {x.isotype: x.strain for x in ref_strain_list}
-    result = Strain.query
+    # Strains carry a reference_strain attribute set to
+    # the reference strain of their isotype
+    snapshot = get_strain_snapshot()
+    mask = np.ones(len(snapshot.strains), dtype=bool)
     if known_origin or 'origin' in request.path:
-        result = result.filter(Strain.latitude != None)
+        mask &= snapshot.located
 
     if issues is False:
-        result = result.filter(Strain.isotype != None)
-        result = result.filter(Strain.issues == False)
+        mask &= snapshot.has_isotype & snapshot.no_issues
 
-    result = result.all()
-    for strain in result:
-        # Set an attribute for the reference strain of every strain
-        strain.reference_strain = ref_strain_list.get(strain.isotype, None)
-    return result
+    return snapshot.select(mask)
 
 
 @api_strain_bp.route('/isotype')
@@ -114,11 +264,11 @@ def get_isotypes(known_origin=False, list_only=False):
             known_origin: Returns only strains with a known origin
             list_only: Returns a list of isotypes (internal use)
     """
-    result = Strain.query.filter(Strain.isotype_ref_strain == True) \
-                           .order_by(Strain.isotype)
+    snapshot = get_strain_snapshot()
+    mask = snapshot.isotype_ref
     if known_origin or 'origin' in request.path:
-        result = result.filter(Strain.latitude != None)
-    result = result.all()
+        mask = mask & snapshot.located
+    result = snapshot.rows(snapshot.isotype_order, mask)
     if list_only:
         result = [x.isotype for x in result]
     return result
@@ -4,15 +4,30 @@
 Author: Daniel E. Cook
 """
 import re
+import json
+import base64
 import pickle
-from cyvcf2 import VCF
-from flask import request, Response
-from tempfile import NamedTemporaryFile
-from subprocess import Popen, PIPE
-from collections import OrderedDict
+import hashlib
+import binascii
+import numpy as np
+from flask import request, Response, stream_with_context
+from itertools import chain
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import or_
+from base.extensions import csrf
+from base.models import WormbaseGeneSummary
 from base.utils.decorators import jsonify_request
+from base.utils.vcf_pool import VCFReaderPool
+from base.utils.block_cache import cached_url
+from base.utils.variant_decode import AnnotationDecoder, gt_summary
+from base.utils.impact_index import ImpactIndex, query_mask
+from base.utils.genotype_store import GenotypeStore
+from base.utils.vcf_region import (iter_region_native,
+                                   iter_spans_native,
+                                   iter_region_bcftools,
+                                   RegionQueryError)
 from base.config import config
-from collections import Counter
 from logzero import logger
 
 from flask import Blueprint
@@ -45,6 +60,36 @@ def get_vcf(release=config["DATASET_RELEASE"], filter_type="hard"):
     return "http://storage.googleapis.com/elegansvariation.org/releases/{release}/variation/WI.{release}.{filter_type}-filter.isotype.vcf.gz".format(release=release, filter_type=filter_type)
 
 
+def get_cached_vcf(release=config["DATASET_RELEASE"], filter_type="hard"):
+    """
+        Returns the url of a release VCF read through the block cache
+    """
+    return cached_url(get_vcf(release=release, filter_type=filter_type))
+
+
+# Parsed ANN fields are cached per worker process
+ann_decoder = AnnotationDecoder(ANN_header, gene_id_dict, maxsize=config["ANN_CACHE_SIZE"])
+
+# Release VCFs are opened once per worker process
+vcf_pool = VCFReaderPool(get_cached_vcf, max_idle=config["VCF_READER_POOL_SIZE"])
+
+
+@lru_cache(maxsize=None)
+def get_impact_index(release):
+    """
+        Returns the impact index of a release (None if it has not been built)
+    """
+    return ImpactIndex.load(config["IMPACT_INDEX_PATH"].format(release=release))
+
+
+@lru_cache(maxsize=None)
+def get_genotype_store(release):
+    """
+        Returns the genotype store of a release (None if it has not been built)
+    """
+    return GenotypeStore.load(config["GENOTYPE_STORE_PATH"].format(release=release))
+
+
 gt_set_keys = ["SAMPLE", "GT", "FT", "TGT"]
 
 ann_cols = ['allele',
@@ -62,14 +107,175 @@ ann_cols = ['allele',
             'distance_to_feature']
 
 
+# Maximum number of variants returned per request
+MAX_PAGE_SIZE = 1000
+
+# Maximum number of regions in a batch request
+MAX_BATCH_REGIONS = 500
+
+# Maximum size of a region queried without pagination (bp)
+MAX_REGION_SIZE = int(1e5)
+
+# Batch region queries share a bounded thread pool
+batch_executor = ThreadPoolExecutor(max_workers=config["VARIANT_BATCH_WORKERS"])
+
+tsv_cols = ['CHROM', 'POS', "REF", "ALT", "FILTER", "phastcons", "phylop", "AF"]
+
+
 def truncate(s, max_len = 20):
     if len(s) >= max_len:
         return s[:max_len] + " …"
     return s
 
+
+def sample_set_id(samples):
+    """
+        Returns a short identifier for a list of samples (None = all samples)
+    """
+    if samples is None:
+        return "ALL"
+    return hashlib.sha1(','.join(samples).encode('utf-8')).hexdigest()[0:10]
+
+
+def encode_cursor(**kwargs):
+    """
+        Returns an opaque cursor for resuming a paginated variant query.
+
+        Args:
+            release, chrom, samples - identify the query being paginated
+            pos - position of the last record read
+            n - number of records read at pos
+    """
+    return base64.urlsafe_b64encode(json.dumps(kwargs).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+        Decodes a cursor created by encode_cursor; raises ValueError if it is malformed
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        cursor['pos'], cursor['n'] = int(cursor['pos']), int(cursor['n'])
+        return cursor
+    except (TypeError, KeyError, binascii.Error, UnicodeError) as e:
+        raise ValueError(e)
+
+
+def record_output(record, ANN, sample_names):
+    """
+        Formats a RegionRecord and its annotations for the JSON response.
+    """
+    # Extract FT (genotype filter status)
+    if record.FT is not None:
+        FT = record.FT.tolist()
+    else:
+        FT = ["PASS"] * len(sample_names)
+
+    gt_set = zip(sample_names, record.gt_types.tolist(), FT, record.gt_bases.tolist())
+    gt_set = [dict(zip(gt_set_keys, x)) for x in gt_set]
+    return {
+        "CHROM": record.CHROM,
+        "POS": record.POS,
+        "REF": truncate(record.REF),
+        "ALT": [truncate(x) for x in record.ALT],
+        "FILTER": record.FILTER,
+        "GT": gt_set,
+        "AF": '{:0.3f}'.format(record.AF),
+        "ANN": ANN,
+        "GT_Summary": gt_summary(record.gt_types)
+    }
+
+
+def columnar_output(selected, sample_names):
+    """
+        Formats records and their annotations as columns.
+
+        Samples are listed once; genotype fields are arrays
+        aligned to the sample list. FT values are dictionary-encoded.
+
+        {"samples": [<sample>],
+         "CHROM": [...], "POS": [...], "REF": [...], "ALT": [...],
+         "FILTER": [...], "AF": [...], "ANN": [...], "GT_Summary": [...],
+         "GT": [[<GT code by sample>] by variant],
+         "TGT": [[<TGT by sample>] by variant],
+         "FT": {"values": [<FT value>],
+                "codes": [[<index into values by sample>] by variant]}}
+    """
+    columns = {k: [] for k in ["CHROM", "POS", "REF", "ALT", "FILTER", "AF", "ANN", "GT_Summary", "GT", "TGT"]}
+    ft_values = {}
+    ft_codes = []
+    for record, ANN in selected:
+        columns["CHROM"].append(record.CHROM)
+        columns["POS"].append(record.POS)
+        columns["REF"].append(truncate(record.REF))
+        columns["ALT"].append([truncate(x) for x in record.ALT])
+        columns["FILTER"].append(record.FILTER)
+        columns["AF"].append('{:0.3f}'.format(record.AF))
+        columns["ANN"].append(ANN)
+        gt_types = record.gt_types.tolist()
+        columns["GT_Summary"].append(gt_summary(record.gt_types))
+        columns["GT"].append(gt_types)
+        columns["TGT"].append(record.gt_bases.tolist())
+        if record.FT is None:
+            ft_codes.append([ft_values.setdefault("PASS", len(ft_values))] * len(sample_names))
+        else:
+            values, inverse = np.unique(record.FT, return_inverse=True)
+            lookup = np.array([ft_values.setdefault(x, len(ft_values)) for x in values.tolist()])
+            ft_codes.append(lookup[inverse].tolist())
+    columns.update({"samples": list(sample_names),
+                    "FT": {"values": list(ft_values),
+                           "codes": ft_codes}})
+    return columns
+
+
+def tsv_output(records, sample_names, variant_impact):
+    """
+        Generates TSV lines as records are read.
+
+        One line is written for each annotation of a record
+        (or a single line with empty annotation fields). Only
+        the current record is held in memory.
+    """
+    header = tsv_cols + ann_cols
+    for sample in sample_names:
+        header += [sample + '_GT', sample + '_FT']
+    yield '\t'.join(header) + '\n'
+    for record in records:
+        ANN = ann_decoder.decode(record.ANN, variant_impact)
+        if not ANN and 'ALL' not in variant_impact:
+            continue
+        variant = [record.CHROM,
+                   record.POS,
+                   truncate(record.REF),
+                   ','.join(truncate(x) for x in record.ALT),
+                   record.FILTER,
+                   "NA",
+                   "NA",
+                   '{:0.3f}'.format(record.AF)]
+        if record.FT is not None:
+            FT = record.FT.tolist()
+        else:
+            FT = ["PASS"] * len(sample_names)
+        genotypes = []
+        for gt, ft in zip(record.gt_types.tolist(), FT):
+            genotypes += [gt, ft]
+        annotations = [[ann.get(k) or "NA" for k in ann_cols] for ann in ANN] or [[""] * len(ann_cols)]
+        for ann in annotations:
+            yield '\t'.join(map(str, variant + ann + genotypes)) + '\n'
+
+
+@api_variant_bp.route('/variant/pool')
+@jsonify_request
+def variant_pool_stats():
+    """
+        Returns hit/miss counters for the VCF reader pool of this worker
+    """
+    return vcf_pool.stats()
+
+
 @api_variant_bp.route('/api/variant', methods=["GET", "POST"])
 @jsonify_request
-def variant_query(query=None, samples=None, list_all_strains=False, release=config["DATASET_RELEASE"]):
+def variant_query(query=None, samples=None, list_all_strains=False, release=config["DATASET_RELEASE"], variant_impact=None):
     """
     Used to query a VCF and return results in a dictionary.
     """
@@ -80,11 +286,14 @@ def variant_query(query=None, samples=None, list_all_strains=False, release=conf
                  'start': int(start),
                  'end': int(end),
                  'release': release,
-                 'variant_impact': ['ALL'],
+                 'variant_impact': variant_impact or ['ALL'],
                  'sample_list': samples,
                  'output': "",
                  'list-all-strains': list_all_strains,
-                 'variant-annotation': 'bcsq'}
+                 'variant-annotation': 'bcsq',
+                 'cursor': None,
+                 'page_size': None,
+                 'format': 'row'}
     else:
         # Query from Browser
         query = request.args
@@ -96,7 +305,10 @@ def variant_query(query=None, samples=None, list_all_strains=False, release=conf
                  'sample_list': query['sample_tracks'].split("_"),
                  'output': query['output'],
                  'list-all-strains': list_all_strains or query['list-all-strains'] == 'true',
-                 'variant-annotation': query.get('variant-annotation', 'bcsq')}
+                 'variant-annotation': query.get('variant-annotation', 'bcsq'),
+                 'cursor': query.get('cursor'),
+                 'page_size': query.get('page_size', type=int),
+                 'format': query.get('format', 'row')}
 
     logger.debug(query)
 
@@ -105,125 +317,234 @@ def variant_query(query=None, samples=None, list_all_strains=False, release=conf
     # (2) Variant query of the hard-filter VCF - querying the BCSQ annotations
 
     # Determine which VCF is going to be queried
-    vcf = get_vcf(release=query['release'], filter_type='hard')
-    available_samples = VCF(vcf).samples
+    engine = config["VARIANT_QUERY_ENGINE"]
+    genotype_store = None
+    if engine == "store":
+        genotype_store = get_genotype_store(str(query['release']))
+        engine = "store" if genotype_store else "native"
+    if genotype_store:
+        available_samples = genotype_store.samples
+    else:
+        available_samples = vcf_pool.samples(query['release'], filter_type='hard')
 
-    # Limit queries to 100kb
-    if query['end'] - query['start'] > 1e5:
-        query['end'] = query['start'] + 1e5
+    # Paginated queries return a cursor with each page
+    paginate = query['cursor'] is not None or query['page_size'] is not None
 
-    samples = query['sample_list']
+    # Limit queries to 100kb; TSV exports are streamed and
+    # paginated queries are limited by the page size.
+    if query['end'] - query['start'] > MAX_REGION_SIZE and query['output'] != 'tsv' and not paginate:
+        query['end'] = query['start'] + MAX_REGION_SIZE
+
+    samples = [x for x in query['sample_list'] or [] if x in available_samples]
     if query['list-all-strains']:
-        samples = "ALL"
+        samples = None
     elif not samples:
-        samples = "N2" if "N2" in available_samples else available_samples[0]
-    else:
-        samples = ','.join([x for x in samples if x in available_samples])
+        samples = ["N2" if "N2" in available_samples else available_samples[0]]
 
     chrom = query['chrom']
     start = query['start']
     end = query['end']
 
+    # Resume from the last record of the previous page
+    sample_set = sample_set_id(samples)
+    resume_pos, resume_n = 0, 0
+    if query['cursor']:
+        try:
+            cursor = decode_cursor(query['cursor'])
+        except ValueError:
+            return "Invalid cursor", 400
+        if cursor['release'] != str(query['release']) or \
+           cursor['samples'] != sample_set or \
+           cursor['chrom'] != chrom:
+            return "Cursor does not match query", 400
+        start = resume_pos = cursor['pos']
+        resume_n = cursor['n']
+
     if start >= end:
         return "Invalid start and end region values", 400
 
     region = "{chrom}:{start}-{end}".format(**locals())
-    comm = ["bcftools", "view", vcf, region]
-    logger.debug(comm)
-
-    # Query samples
-    if samples != 'ALL':
-        comm = comm[0:2] + ['--force-samples', '--samples', samples] + comm[2:]
-    out, err = Popen(comm, stdout=PIPE, stderr=PIPE).communicate()
-    if not out and err:
-        logger.error(err)
-        return err, 400
-    tfile = NamedTemporaryFile(mode='w+b')
-    with tfile as f:
-        f.write(out)
-        f.flush()
-        output_data = []
-
-        v = VCF(f.name, gts012=True)
-
-        if samples and samples != "ALL":
-            samples = samples.split(",")
-            incorrect_samples = [x for x in samples if x not in v.samples]
-            if incorrect_samples:
-                return "Incorrectly specified sample(s): " + ','.join(incorrect_samples), 400
-
-        for i, record in enumerate(v):
-            INFO = dict(record.INFO)
-
-            ANN = []
-            if "ANN" in INFO.keys():
-                ANN_set = INFO['ANN'].split(",")
-                for ANN_rec in ANN_set:
-                    annotation_dict = dict(zip(ANN_header, ANN_rec.split("|")))
-                    # Fill in locus id for gene name
-                    annotation_dict["gene_name"] = gene_id_dict.get(annotation_dict["gene_id"])
-                    ANN.append(annotation_dict)
-                del INFO['ANN']
-
-            # Extract FT (genotype filter status)
-            try:
-                FT = record.format("FT")
-                if FT is not None:
-                    FT = FT.tolist()
-                else:
-                    FT = ["PASS" for x in v.samples]
-            except KeyError:
-                FT = ["PASS"] * len(v.samples)
-
-            gt_set = zip(v.samples, record.gt_types.tolist(), FT, record.gt_bases.tolist())
-            gt_set = [dict(zip(gt_set_keys, x)) for x in gt_set]
-            ANN = [x for x in ANN if x['impact'] in query['variant_impact'] or 'ALL' in query['variant_impact']]
-            if type(INFO['AF']) == tuple:
-                AF = INFO['AF'][0]
-            else:
-                AF = INFO['AF']
-            rec_out = {
-                "CHROM": record.CHROM,
-                "POS": record.POS,
-                "REF": truncate(record.REF),
-                "ALT": [truncate(x) for x in record.ALT],
-                "FILTER": record.FILTER or 'PASS',  # record.FILTER is 'None' for PASS
-                "GT": gt_set,
-                "AF": '{:0.3f}'.format(AF),
-                "ANN": ANN,
-                "GT_Summary": Counter(record.gt_types.tolist())
-            }
-
-            if len(rec_out['ANN']) > 0 or 'ALL' in query['variant_impact']:
-                output_data.append(rec_out)
-            if i == 1000 and query['output'] != "tsv":
-                return output_data
-        if query['output'] == 'tsv':
-            filename = f"{query['chrom']}-{query['start']}-{query['end']}.tsv"
-            build_output = OrderedDict()
-            output = []
-            header = False
-            for rec in output_data:
-                for k in ['CHROM', 'POS', "REF", "ALT", "FILTER", "phastcons", "phylop", "AF"]:
-                    if k == 'ALT':
-                        build_output[k] = ','.join(rec[k])
-                    else:
-                        build_output[k] = rec.get(k) or "NA"
-                if rec['ANN']:
-                    for ann in rec['ANN']:
-                        for k in ann_cols:
-                            build_output[k] = ann.get(k) or "NA"
-                else:
-                    for k in ann_cols:
-                        build_output[k] = ""
-
-                for gt in rec['GT']:
-                    sample = gt['SAMPLE']
-                    build_output[sample + '_GT'] = gt['GT']
-                    build_output[sample + '_FT'] = gt['FT']
-                if header is False:
-                    output.append('\t'.join(build_output.keys()))
-                    header = True
-                output.append('\t'.join(map(str, build_output.values())))
-            return Response('\n'.join(output), mimetype="text/csv", headers={"Content-disposition": "attachment; filename=%s" % filename})
+    # Queries filtered by impact only read the spans of the region
+    # containing a matching record when an impact index is available.
+    impact_mask = query_mask(query['variant_impact'])
+    impact_index = None
+    if impact_mask is not None and engine == "native":
+        impact_index = get_impact_index(str(query['release']))
+    if engine == "store":
+        region_records = genotype_store.iter_region(chrom, start, end, samples, impact_mask=impact_mask)
+    elif engine == "bcftools":
+        region_records = iter_region_bcftools(get_cached_vcf(release=query['release'], filter_type='hard'), region, samples)
+    elif impact_index:
+        spans = impact_index.spans(chrom, start, end, impact_mask, max_gap=config["IMPACT_INDEX_MAX_GAP"])
+        region_records = iter_spans_native(vcf_pool, query['release'], chrom, spans, samples)
+    else:
+        region_records = iter_region_native(vcf_pool, query['release'], region, samples)
+    sample_names = samples or available_samples
+
+    # Read the first record so that query errors are
+    # returned before a response is started.
+    try:
+        first_record = next(region_records, None)
+    except RegionQueryError as e:
+        return str(e), 400
+    records = chain([first_record] if first_record else [], region_records)
+
+    if query['output'] == 'tsv':
+        filename = f"{query['chrom']}-{query['start']}-{query['end']}.tsv"
+        return Response(stream_with_context(tsv_output(records, sample_names, query['variant_impact'])),
+                        mimetype="text/csv",
+                        headers={"Content-disposition": "attachment; filename=%s" % filename})
+
+    page_size = min(query['page_size'] or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+    selected = []
+    next_cursor = None
+    # Track the number of records read at the current position;
+    # multiple records can share a position.
+    last_pos, n_at_pos = None, 0
+    cursor_pos, cursor_n = None, 0
+    for i, record in enumerate(records):
+        if record.POS == last_pos:
+            n_at_pos += 1
+        else:
+            last_pos, n_at_pos = record.POS, 1
+        # Skip records returned on previous pages
+        if record.POS < resume_pos or (record.POS == resume_pos and n_at_pos <= resume_n):
+            continue
+        ANN = ann_decoder.decode(record.ANN, query['variant_impact'])
+        if ANN or 'ALL' in query['variant_impact']:
+            # A cursor is only returned when a further record is selected
+            if paginate and len(selected) == page_size:
+                next_cursor = encode_cursor(release=str(query['release']),
+                                            chrom=chrom,
+                                            pos=cursor_pos,
+                                            n=cursor_n,
+                                            samples=sample_set)
+                break
+            selected.append((record, ANN))
+            cursor_pos, cursor_n = last_pos, n_at_pos
+        if not paginate and i == 1000:
+            break
+    # Return the pooled reader
+    region_records.close()
+
+    if query['format'] == 'columnar':
+        output_data = columnar_output(selected, sample_names)
+        if paginate:
+            output_data['cursor'] = next_cursor
         return output_data
+
+    output_data = [record_output(record, ANN, sample_names) for record, ANN in selected]
+    if paginate:
+        return {"variants": output_data,
+                "cursor": next_cursor}
+    return output_data
+
+
+def list_arg(args, name):
+    """
+        Reads a list argument of a batch query given as a list
+        of strings or a comma-delimited string.
+
+        Raises ValueError for other types.
+    """
+    value = args.get(name)
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [x for x in value.split(",") if x]
+    if isinstance(value, list) and all(isinstance(x, str) for x in value):
+        return value
+    raise ValueError(f"{name} must be a list of strings or a comma-delimited string")
+
+
+@api_variant_bp.route('/variant/batch', methods=["GET", "POST"])
+@csrf.exempt
+@jsonify_request
+def variant_batch_query():
+    """
+        Query variants in many regions with a single request.
+
+        Regions are queried concurrently on a bounded thread pool.
+
+        Args (JSON body for POST, comma-delimited query parameters for GET):
+            regions - list of CHROM:START-END
+            genes - list of gene names or IDs; queried over the gene interval
+            samples - list of samples or ALL (default N2)
+            release - dataset release
+            variant_impact - list of impacts (default ALL)
+
+            Lists may also be given as comma-delimited strings.
+
+        Returns:
+            {"release": <release>,
+             "results": {<region or gene>: [<variant>] or {"error": <message>}}}
+
+            Regions (and gene intervals) larger than 100 kb are
+            not queried and return an error.
+    """
+    if request.method == 'POST':
+        args = request.get_json(force=True, silent=True) or {}
+        if not isinstance(args, dict):
+            return "Expected a JSON object", 400
+    else:
+        args = dict(request.args.items())
+    try:
+        regions = list_arg(args, 'regions')
+        genes = list_arg(args, 'genes')
+        samples = list_arg(args, 'samples') or None
+        variant_impact = list_arg(args, 'variant_impact') or ['ALL']
+    except ValueError as e:
+        return str(e), 400
+    list_all_strains = samples == ["ALL"]
+    release = args.get('release') or config["DATASET_RELEASE"]
+
+    if len(regions) + len(genes) > MAX_BATCH_REGIONS:
+        return f"A maximum of {MAX_BATCH_REGIONS} regions and genes can be queried at once", 400
+
+    # Resolve genes to their intervals
+    queries = {region: region for region in regions}
+    results = {}
+    if genes:
+        gene_records = WormbaseGeneSummary.query.filter(or_(WormbaseGeneSummary.locus.in_(genes),
+                                                            WormbaseGeneSummary.sequence_name.in_(genes),
+                                                            WormbaseGeneSummary.gene_id.in_(genes))).all()
+        for gene_record in gene_records:
+            for name in (gene_record.locus, gene_record.sequence_name, gene_record.gene_id):
+                if name in genes:
+                    queries[name] = gene_record.interval
+        results.update({gene: {"error": "Gene not found"} for gene in genes if gene not in queries})
+
+    # Larger regions would be truncated by variant_query
+    for key, region in list(queries.items()):
+        try:
+            chrom, start, end = re.split(':|-', region)
+            size = int(end) - int(start)
+        except ValueError:
+            results[key] = {"error": "Invalid region"}
+            del queries[key]
+            continue
+        if size > MAX_REGION_SIZE:
+            results[key] = {"error": f"Region {region} is larger than {MAX_REGION_SIZE} bp; "
+                                     "query it with /api/variant and a page_size"}
+            del queries[key]
+
+    def run_query(region):
+        try:
+            return variant_query(region,
+                                 samples=samples,
+                                 list_all_strains=list_all_strains,
+                                 release=release,
+                                 variant_impact=variant_impact)
+        except Exception as e:
+            # A failing region does not fail the batch
+            logger.exception(f"Batch variant query failed: {region}")
+            return str(e), 500
+
+    futures = {key: batch_executor.submit(run_query, region) for key, region in queries.items()}
+    for key, future in futures.items():
+        result = future.result()
+        if isinstance(result, tuple):
+            result = {"error": str(result[0])}
+        results[key] = result
+    return {"release": release,
+            "results": results}
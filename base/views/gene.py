@@ -1,4 +1,5 @@
-from base.views.api.api_gene import lookup_gene, gene_variants
+from base.views.api.api_gene import lookup_gene
+from base.models import GeneVariantSummary
 from collections import OrderedDict
 from flask import render_template, Blueprint, redirect, url_for
 from base.constants import BIOTYPES, TABLE_COLORS
@@ -22,12 +23,13 @@ def gene(gene_name=""):
     if gene_record is None:
         return render_template('404.html'), 404
 
-    # Gene Variants
-    variants = gene_variants(gene_record.gene_id)
+    # Precomputed variant summary; the full list
+    # of variants is fetched by the page.
+    variant_summary = GeneVariantSummary.get(gene_record.gene_id)
 
     VARS = {'title': gene_record.gene_symbol,
             'gene_record': gene_record,
-            'variants': variants,
+            'variant_summary': variant_summary.to_json() if variant_summary else None,
             'TABLE_COLORS': TABLE_COLORS}
     return render_template('gene/gene.html', **VARS)
 
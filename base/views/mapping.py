@@ -16,7 +16,8 @@ from flask import session, flash, Blueprint, g
 from base.utils.data_utils import unique_id
 from base.config import config
 
-from base.utils.gcloud import query_item, delete_item
+from base.utils.gcloud import query_item, query_item_iter, delete_item
+from base.utils.site_stats import record_site_stats
 
 from base.utils.plots import pxg_plot, plotly_distplot
 
@@ -53,6 +54,11 @@ def mapping():
         # Now generate and run trait tasks
         report_name = form.report_name.data
         report_slug = slugify(report_name)
+        # Resubmitting a report adds traits to it, not a new report
+        new_report = not any(query_item_iter('trait',
+                                             ['__key__'],
+                                             filters=[('report_slug', '=', report_slug)],
+                                             limit=1))
         trait_list = list(form.trait_data.processed_data.columns[2:])
         now = arrow.utcnow().datetime
         trait_set = []
@@ -88,6 +94,7 @@ def mapping():
         # Update the report to contain the set of the
         # latest task runs
         transaction.commit()
+        record_site_stats(reports=int(new_report), traits=len(trait_list))
 
         flash("Successfully submitted mapping!", 'success')
         return redirect(url_for('mapping.report_view',
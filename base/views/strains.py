@@ -1,5 +1,6 @@
 import yaml
 from base.extensions import cache
+from base.utils.cache import stale_while_revalidate
 from flask import (render_template,
                    request,
                    url_for,
@@ -39,10 +40,10 @@ def strain():
 def map_page():
     """
         Global strain map shows the locations of all wild isolates
-        within the SQLite database.
+        within the SQLite database. Strain clusters are fetched for
+        the visible area (see strain_map_clusters).
     """
-    VARS = {'title': "Global Strain Map",
-            'strain_listing': dump_json(get_strains(known_origin=True))}
+    VARS = {'title': "Global Strain Map"}
     return render_template('strain/global_strain_map.html', **VARS)
 
 
@@ -107,14 +108,24 @@ def isotype_page(isotype_name, release=config['DATASET_RELEASE']):
 # Strain Catalog
 #
 
+@stale_while_revalidate(timeout=50, stale_timeout=60*60)
+def strain_catalog_data():
+    """
+        Returns the strain listing and strain sets of the catalog
+    """
+    return get_strains(), Strain.strain_sets()
+
+
 @strain_bp.route('/catalog', methods=['GET', 'POST'])
-@cache.memoize(50)
 def strain_catalog():
+    # The page is rendered per request: its order form carries
+    # the CSRF token of the user's session.
     flash(Markup("Strain mapping sets 7 and 8 will not be available until later this year."), category="warning")
+    strain_listing, strain_sets = strain_catalog_data()
     VARS = {"title": "Strain Catalog",
             "warning": request.args.get('warning'),
-            "strain_listing": get_strains(),
-            "strain_sets": Strain.strain_sets() }
+            "strain_listing": strain_listing,
+            "strain_sets": strain_sets}
     return render_template('strain/strain_catalog.html', **VARS)
 
 #
@@ -21,6 +21,7 @@ from wtforms.validators import Required, ValidationError
 from base.config import config
 from base.utils.gcloud import check_blob, upload_file
 from base.utils.data_utils import hash_it
+from base.utils.block_cache import cached_url
 from base.constants import CHROM_NUMERIC
 from threading import Thread
 
@@ -125,7 +126,7 @@ def pairwise_indel_finder_query():
         results = []
         strain_cmp = [data["strain_1"],
                       data["strain_2"]]
-        tb = tabix.open(SV_BED_URL)
+        tb = tabix.open(cached_url(SV_BED_URL))
         query = tb.query(data["chromosome"], data["start"], data["stop"])
         results = []
         for row in query:
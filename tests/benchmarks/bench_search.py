@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark of autocomplete searches: the SQL filters previously used
+by the gene and strain search endpoints against the in-memory prefix
+indices in base.utils.search.
+
+Queries are issued one keystroke at a time (p, po, pot, pot-, pot-2).
+Uses a synthetic SQLite database unless --db points at a CeNDR database.
+
+Usage:
+    python -m tests.benchmarks.bench_search [--db base/cendr.20200815.WS276.db] [--genes 47000]
+
+"""
+import random
+import argparse
+from time import perf_counter
+
+from flask import Flask
+from sqlalchemy import or_, func
+from base.models import db, WormbaseGeneSummary, Homologs, Strain
+from base.views.api.api_gene import build_gene_index, build_homolog_index
+from base.views.api.api_strain import build_strain_index
+
+
+def make_database(n_genes, seed=1):
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    genes = []
+    for n in range(n_genes):
+        locus = f"{''.join(rng.choice(letters) for x in range(3))}-{rng.randint(1, 200)}" if rng.random() < 0.4 else None
+        genes.append(WormbaseGeneSummary(chrom=rng.choice(["I", "II", "III", "IV", "V", "X"]),
+                                         start=n * 100,
+                                         end=n * 100 + 50,
+                                         locus=locus,
+                                         gene_id=f"WBGene{n:08d}",
+                                         sequence_name=f"Y{n // 100}A{n % 100}.{rng.randint(1, 9)}"))
+    db.session.add_all(genes)
+    db.session.add_all([Homologs(gene_id=f"WBGene{rng.randrange(n_genes):08d}",
+                                 gene_name="gene",
+                                 homolog_species="Homo sapiens",
+                                 homolog_gene=''.join(rng.choice(letters) for x in range(4)).upper(),
+                                 homolog_source="Homologene") for x in range(n_genes)])
+    db.session.add_all([Strain(strain=f"ECA{n}",
+                               isotype=f"ECA{n - n % 3}",
+                               isotype_ref_strain=n % 3 == 0,
+                               release=20200815,
+                               previous_names=f"QX{n},JU{n}",
+                               issues=False) for n in range(1500)])
+    db.session.commit()
+
+
+def sql_gene_search(query):
+    WormbaseGeneSummary.query.filter(or_(WormbaseGeneSummary.locus.startswith(query),
+                                         WormbaseGeneSummary.sequence_name.startswith(query),
+                                         WormbaseGeneSummary.gene_id.startswith(query))) \
+                             .limit(10) \
+                             .all()
+    Homologs.query.filter(func.lower(Homologs.homolog_gene) == query.lower()).limit(10).all()
+
+
+def sql_strain_search(query):
+    query = query.upper()
+    Strain.query.filter(Strain.isotype != None) \
+                .filter(or_(Strain.isotype == query,
+                            Strain.isotype.like(f"{query}%"),
+                            Strain.strain == query,
+                            Strain.strain.like(f"{query}%"),
+                            Strain.previous_names.like(f"%{query},%"),
+                            Strain.previous_names.like(f"%,{query},"),
+                            Strain.previous_names.like(f"%{query}"),
+                            Strain.previous_names == query)).all()
+
+
+def keystrokes(words):
+    return [word[:n] for word in words for n in range(1, len(word) + 1)]
+
+
+def run(label, fn, queries):
+    start = perf_counter()
+    for query in queries:
+        fn(query)
+    elapsed = perf_counter() - start
+    print(f"{label:>24}: {elapsed / len(queries) * 1e6:10.1f} µs/keystroke")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=None, help="CeNDR SQLite database")
+    parser.add_argument("--genes", type=int, default=47000, help="genes in the synthetic database")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{args.db}" if args.db else "sqlite://"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        if not args.db:
+            db.create_all()
+            make_database(args.genes)
+
+        start = perf_counter()
+        gene_index, homolog_index, strain_index = build_gene_index(), build_homolog_index(), build_strain_index()
+        print(f"Built indices in {perf_counter() - start:.2f} s "
+              f"({len(gene_index)} genes, {len(homolog_index)} homologs, {len(strain_index)} strains)")
+
+        gene_queries = keystrokes(["pot-2", "WBGene00010195", "Y10A5.1", "BRCA"])
+        strain_queries = keystrokes(["ECA396", "CB4856", "QX1211", "N2"])
+        run("genes (SQL)", sql_gene_search, gene_queries)
+        run("genes (index)", lambda q: (gene_index.search(q), homolog_index.search(q, prefix=False)), gene_queries)
+        run("strains (SQL)", sql_strain_search, strain_queries)
+        run("strains (index)", lambda q: strain_index.search(q, limit=None), strain_queries)
+
+
+if __name__ == '__main__':
+    main()
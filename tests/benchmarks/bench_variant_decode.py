@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Micro-benchmark of per-record decoding in the variant API:
+genotype summaries and ANN parsing before and after the
+numpy/cached decoder in base.utils.variant_decode.
+
+Usage:
+    python -m tests.benchmarks.bench_variant_decode [--records 20000] [--samples 540]
+
+"""
+import random
+import argparse
+import numpy as np
+from time import perf_counter
+from collections import Counter
+
+from base.utils.variant_decode import AnnotationDecoder, gt_summary
+
+ANN_HEADER = ["allele", "effect", "impact", "gene_name", "gene_id", "feature_type",
+              "feature_id", "transcript_biotype", "exon_intron_rank", "nt_change",
+              "aa_change", "cDNA_position/cDNA_len", "protein_position",
+              "distance_to_feature", "error"]
+
+
+def make_records(n_records, n_samples, n_distinct_ann, seed=1):
+    rng = random.Random(seed)
+    np_rng = np.random.RandomState(seed)
+    impacts = ["HIGH", "MODERATE", "LOW", "MODIFIER"]
+    ann_pool = []
+    for x in range(n_distinct_ann):
+        ann_pool.append(",".join(f"T|missense_variant|{rng.choice(impacts)}|gene|WBGene{x:08d}|transcript|"
+                                 f"T{x}.{n}|protein_coding|1/2|c.1A>T|p.K1N|1/10|1|0|" for n in range(rng.randint(1, 4))))
+    gene_names = {f"WBGene{x:08d}": f"gene-{x}" for x in range(n_distinct_ann)}
+    records = [(np_rng.choice([0, 0, 0, 2, 3], n_samples).astype(np.int32), rng.choice(ann_pool))
+               for x in range(n_records)]
+    return records, gene_names
+
+
+def decode_before(records, gene_names, variant_impact):
+    for gt_types, ANN in records:
+        Counter(gt_types.tolist())
+        annotations = []
+        for ANN_rec in ANN.split(","):
+            annotation_dict = dict(zip(ANN_HEADER, ANN_rec.split("|")))
+            annotation_dict["gene_name"] = gene_names.get(annotation_dict["gene_id"])
+            annotations.append(annotation_dict)
+        [x for x in annotations if x['impact'] in variant_impact or 'ALL' in variant_impact]
+
+
+def decode_after(records, decoder, variant_impact):
+    for gt_types, ANN in records:
+        gt_summary(gt_types)
+        decoder.decode(ANN, variant_impact)
+
+
+def report(label, elapsed, n_records):
+    print(f"{label:>16}: {elapsed / n_records * 1e6:8.2f} µs/record")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--samples", type=int, default=540)
+    parser.add_argument("--distinct-ann", type=int, default=2000)
+    args = parser.parse_args()
+
+    records, gene_names = make_records(args.records, args.samples, args.distinct_ann)
+    variant_impact = ["HIGH", "MODERATE"]
+
+    start = perf_counter()
+    decode_before(records, gene_names, variant_impact)
+    before = perf_counter() - start
+    report("before", before, len(records))
+
+    decoder = AnnotationDecoder(ANN_HEADER, gene_names)
+    start = perf_counter()
+    decode_after(records, decoder, variant_impact)
+    cold = perf_counter() - start
+    report("after (cold)", cold, len(records))
+
+    start = perf_counter()
+    decode_after(records, decoder, variant_impact)
+    warm = perf_counter() - start
+    report("after (warm)", warm, len(records))
+    print(f"speedup (warm): {before / warm:0.1f}x; {decoder.cache_info()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+Benchmarks the native (cyvcf2) and bcftools region query paths
+used by /api/variant against a local fixture VCF.
+
+Usage:
+    python -m tests.benchmarks.bench_variant_region [--vcf fixture.vcf.gz] [--queries 200]
+
+Without --vcf a synthetic fixture is written with bcftools (which
+is also required for the bcftools path).
+
+"""
+import os
+import random
+import argparse
+import tempfile
+from time import perf_counter
+from subprocess import check_call
+
+from base.utils.vcf_pool import VCFReaderPool
+from base.utils.vcf_region import iter_region_native, iter_region_bcftools
+
+CHROM_LEN = 1000000
+
+
+def write_fixture(path, n_samples=500, n_variants=20000, seed=1):
+    """
+        Writes a bgzipped, indexed VCF with GT/FT fields and ANN annotations
+    """
+    rng = random.Random(seed)
+    samples = [f"S{x}" for x in range(n_samples)]
+    vcf_txt = path.replace(".vcf.gz", ".vcf")
+    with open(vcf_txt, 'w') as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write(f"##contig=<ID=I,length={CHROM_LEN}>\n")
+        f.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n')
+        f.write('##INFO=<ID=ANN,Number=.,Type=String,Description="Annotation">\n')
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write('##FORMAT=<ID=FT,Number=1,Type=String,Description="Genotype filter">\n')
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n")
+        positions = sorted(rng.sample(range(1, CHROM_LEN), n_variants))
+        for pos in positions:
+            ann = f"T|missense_variant|MODERATE|gene|WBGene{pos % 20000:08d}|transcript|T{pos}.1|protein_coding|1/2|c.1A>T|p.K1N|1/10|1|0|"
+            gts = '\t'.join(rng.choice(["0/0:PASS", "1/1:PASS", "./.:lowdepth"]) for x in samples)
+            f.write(f"I\t{pos}\t.\tA\tT\t50\tPASS\tAF=0.5;ANN={ann}\tGT:FT\t{gts}\n")
+    check_call(["bcftools", "view", "-Oz", "-o", path, vcf_txt])
+    check_call(["bcftools", "index", "-t", path])
+    return path
+
+
+def time_path(label, fn, regions):
+    start = perf_counter()
+    n_records = 0
+    for region in regions:
+        for record in fn(region):
+            n_records += 1
+    elapsed = perf_counter() - start
+    print(f"{label:>10}: {elapsed / len(regions) * 1000:8.2f} ms/query  ({n_records} records)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vcf", default=None)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--width", type=int, default=20000)
+    parser.add_argument("--samples", type=int, default=10)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    vcf = args.vcf or write_fixture(os.path.join(tmpdir, "fixture.vcf.gz"))
+    pool = VCFReaderPool(lambda release, filter_type: vcf)
+    samples = pool.samples("fixture")[:args.samples]
+
+    rng = random.Random(2)
+    regions = []
+    for x in range(args.queries):
+        start = rng.randint(1, CHROM_LEN - args.width)
+        regions.append(f"I:{start}-{start + args.width}")
+
+    native = time_path("native", lambda r: iter_region_native(pool, "fixture", r, samples), regions)
+    bcftools = time_path("bcftools", lambda r: iter_region_bcftools(vcf, r, samples), regions)
+    print(f"speedup: {bcftools / native:0.1f}x")
+
+
+if __name__ == '__main__':
+    main()
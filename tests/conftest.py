@@ -0,0 +1,33 @@
+import pytest
+from flask import Flask
+
+from base.models import db, Strain, StrainAlias
+from base.utils.strain_snapshot import strain_snapshot
+
+
+STRAINS = [{'strain': 'N2', 'isotype': 'N2', 'isotype_ref_strain': True, 'previous_names': None,
+            'issues': False, 'release': 20170531, 'latitude': 51.5, 'longitude': -0.1, 'sequenced': True},
+           {'strain': 'LSJ1', 'isotype': 'LSJ1', 'isotype_ref_strain': True, 'previous_names': 'N2,LSJ1',
+            'issues': False, 'release': 20200815, 'sequenced': False},
+           {'strain': 'CB4856', 'isotype': 'CB4856', 'isotype_ref_strain': True, 'previous_names': 'HA,HW',
+            'issues': False, 'release': 20170531, 'latitude': 20.8, 'longitude': -156.3, 'sequenced': True},
+           {'strain': 'ECA1', 'isotype': 'ECA1', 'isotype_ref_strain': True, 'previous_names': 'QX1',
+            'issues': True, 'release': 20170531}]
+
+
+@pytest.fixture
+def strain_app():
+    """
+        An app with an in-memory database of STRAINS and their aliases
+    """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(Strain, STRAINS)
+        db.session.bulk_insert_mappings(StrainAlias, list(StrainAlias.from_strains(STRAINS)))
+        db.session.commit()
+        strain_snapshot.reset()
+        yield app
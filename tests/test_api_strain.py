@@ -0,0 +1,33 @@
+import pytest
+
+from base.utils.data_utils import json_encoder
+from base.views.api.api_strain import api_strain_bp
+
+
+@pytest.fixture
+def client(strain_app):
+    strain_app.json_encoder = json_encoder
+    strain_app.register_blueprint(api_strain_bp, url_prefix='/api')
+    return strain_app.test_client()
+
+
+def test_filter_strains(client):
+    result = client.get('/api/strain/filter?release=20170531&issues=false').get_json()
+    assert result['count'] == 2
+    assert [x['strain'] for x in result['strains']] == ['N2', 'CB4856']
+    assert result['facets']['release'] == {'20170531': 2, '20200815': 3}
+    assert result['facets']['issues'] == {'true': 1, 'false': 2}
+    result = client.get('/api/strain/filter?bbox=-10,40,10,60&limit=1').get_json()
+    assert result['count'] == 1 and result['strains'][0]['strain'] == 'N2'
+    assert client.get('/api/strain/filter?sequenced=yes').status_code == 400
+
+
+def test_strain_map_clusters(client):
+    clusters = client.get('/api/strain/map/2').get_json()['clusters']
+    assert sorted(x['count'] for x in clusters) == [1, 1]
+    assert {x['strain']['strain'] for x in clusters} == {'N2', 'CB4856'}
+    # Europe only
+    clusters = client.get('/api/strain/map/0?bbox=-20,30,40,70').get_json()['clusters']
+    assert [x['strain']['strain'] for x in clusters] == ['N2']
+    cell = client.get(f"/api/strain/map/0/{clusters[0]['cell']}").get_json()
+    assert cell['isotypes'] == ['N2']
@@ -0,0 +1,103 @@
+import os
+
+import pytest
+from flask import Flask
+
+from base.utils.data_utils import json_encoder
+from base.utils.vcf_pool import VCFReaderPool
+from base.views.api import api_variant
+from base.views.api.api_variant import api_variant_bp
+
+
+VCF_FIXTURE = os.path.join(os.path.dirname(__file__), "data", "WI.test.vcf.gz")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """
+        Batch queries with variant_query replaced by a stand-in
+        recording its arguments
+    """
+    calls = []
+
+    def variant_query(region, samples=None, list_all_strains=False, release=None, variant_impact=None):
+        calls.append((region, samples, list_all_strains, variant_impact))
+        if region.startswith("II"):
+            raise OSError("Failed to read VCF")
+        return [{'CHROM': region.split(":")[0]}]
+
+    monkeypatch.setattr(api_variant, 'variant_query', variant_query)
+    app = Flask(__name__)
+    app.json_encoder = json_encoder
+    app.register_blueprint(api_variant_bp, url_prefix='/api')
+    client = app.test_client()
+    client.calls = calls
+    return client
+
+
+def test_batch_arguments(client):
+    result = client.get('/api/variant/batch?regions=I:1-100,X:1-100&samples=N2,CB4856').get_json()
+    assert result['results'] == {'I:1-100': [{'CHROM': 'I'}], 'X:1-100': [{'CHROM': 'X'}]}
+    assert sorted(client.calls) == [('I:1-100', ['N2', 'CB4856'], False, ['ALL']),
+                                    ('X:1-100', ['N2', 'CB4856'], False, ['ALL'])]
+
+    # Comma-delimited strings in a JSON body
+    del client.calls[:]
+    client.post('/api/variant/batch', json={'regions': 'I:1-100', 'samples': 'ALL', 'variant_impact': 'HIGH,LOW'})
+    assert client.calls == [('I:1-100', ['ALL'], True, ['HIGH', 'LOW'])]
+
+    for body in [{'regions': ['I:1-100'], 'samples': {'N2': True}},
+                 {'regions': ['I:1-100'], 'samples': 1},
+                 {'regions': 'I:1-100', 'samples': ['N2', 3]},
+                 {'regions': 5}]:
+        assert client.post('/api/variant/batch', json=body).status_code == 400, body
+    assert client.post('/api/variant/batch', json=['I:1-100']).status_code == 400
+
+
+def test_batch_region_errors(client):
+    regions = ['I:1-100', 'II:1-100', 'III:1-200001', 'IV:1']
+    result = client.post('/api/variant/batch', json={'regions': regions}).get_json()['results']
+    assert result['I:1-100'] == [{'CHROM': 'I'}]
+    assert result['II:1-100'] == {'error': 'Failed to read VCF'}
+    assert 'larger than' in result['III:1-200001']['error']
+    assert result['IV:1'] == {'error': 'Invalid region'}
+    # Only valid regions of at most 100 kb are queried
+    assert sorted(x[0] for x in client.calls) == ['I:1-100', 'II:1-100']
+
+
+@pytest.fixture
+def vcf_client(monkeypatch):
+    """
+        Variant queries of the test VCF
+    """
+    monkeypatch.setattr(api_variant, 'vcf_pool', VCFReaderPool(lambda release, filter_type: VCF_FIXTURE))
+    monkeypatch.setitem(api_variant.config, 'VARIANT_QUERY_ENGINE', 'native')
+    app = Flask(__name__)
+    app.json_encoder = json_encoder
+    app.register_blueprint(api_variant_bp, url_prefix='/api')
+    return app.test_client()
+
+
+def query_pages(client, variant_impact, page_size):
+    args = {'chrom': 'I', 'start': 1, 'end': 20000, 'release': 20200815, 'variant_impact': variant_impact,
+            'sample_tracks': 'S1', 'output': '', 'list-all-strains': 'false', 'page_size': page_size}
+    pages = []
+    cursor = None
+    while True:
+        page = client.get('/api/api/variant', query_string=dict(args, cursor=cursor or '')).get_json()
+        pages.append([x['POS'] for x in page['variants']])
+        cursor = page['cursor']
+        if cursor is None:
+            return pages
+
+
+def test_pagination(vcf_client):
+    positions = query_pages(vcf_client, 'ALL', 1000)[0]
+    pages = query_pages(vcf_client, 'ALL', 10)
+    assert sum(pages, []) == positions
+    assert [len(x) for x in pages] == [10, 10, 10, 10]
+
+    # No cursor is returned when the records after a full page are filtered out
+    low = query_pages(vcf_client, 'LOW', 1000)[0]
+    pages = query_pages(vcf_client, 'LOW', len(low))
+    assert pages == [low]
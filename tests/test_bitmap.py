@@ -0,0 +1,26 @@
+import numpy as np
+
+from base.utils.bitmap import BitmapIndex, popcount
+
+
+def test_bitmap_index():
+    landscape = ['urban', 'forest', None, 'urban', 'garden'] * 3
+    sequenced = np.array([True, False, True] * 5)
+    bitmaps = BitmapIndex(len(landscape))
+    bitmaps.add_column('landscape', landscape)
+    bitmaps.add_bitmap('sequenced', 'true', sequenced)
+    bitmaps.add_bitmap('sequenced', 'false', ~sequenced)
+
+    selections = {'landscape': ['urban', 'garden'], 'sequenced': ['true']}
+    rows = bitmaps.rows(bitmaps.query(selections))
+    expected = [n for n, x in enumerate(landscape) if x in ('urban', 'garden') and sequenced[n]]
+    assert rows.tolist() == expected
+    assert popcount(bitmaps.everything) == 15
+
+    counts = bitmaps.counts(selections)
+    # A facet's own selection does not restrict its counts
+    assert counts['landscape'] == {value: sum(1 for n, x in enumerate(landscape) if x == value and sequenced[n])
+                                   for value in ('forest', 'garden', 'urban')}
+    assert counts['sequenced'] == {'true': len(expected),
+                                   'false': sum(1 for n, x in enumerate(landscape)
+                                                if x in ('urban', 'garden') and not sequenced[n])}
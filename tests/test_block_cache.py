@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import threading
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from base.utils.block_cache import BlockCache, BlockCacheProxy, BlockCacheError, HEALTH_PATH, SERVICE_NAME
+
+
+class RemoteFiles(BaseHTTPRequestHandler):
+    """
+        Stand-in for storage.googleapis.com serving files with
+        range requests and ETags; records the requests it receives.
+    """
+    files = {}
+    requests = []
+    # Serve whole files, ignoring Range headers
+    ignore_ranges = False
+
+    def _respond(self, send_body):
+        self.requests.append((self.command, self.path, self.headers.get('Range')))
+        if self.path not in self.files:
+            self.send_error(404)
+            return
+        data, etag = self.files[self.path]
+        status = 200
+        byte_range = re.match(r"bytes=(\d+)-(\d+)$", self.headers.get('Range', ''))
+        if byte_range and not self.ignore_ranges:
+            start, end = map(int, byte_range.groups())
+            data = data[start:end + 1]
+            status = 206
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def remote():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RemoteFiles)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    RemoteFiles.files = {"/data.bin": (os.urandom(10000), '"v1"')}
+    RemoteFiles.requests = []
+    RemoteFiles.ignore_ranges = False
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def range_requests():
+    return [x for x in RemoteFiles.requests if x[0] == 'GET']
+
+
+def test_read_is_cached(remote, tmp_path):
+    cache = BlockCache(str(tmp_path), max_bytes=100000, block_size=1024)
+    data = RemoteFiles.files["/data.bin"][0]
+    assert cache.read(remote + "/data.bin", 1000, 3000) == data[1000:4000]
+    assert len(range_requests()) == 4
+    assert cache.read(remote + "/data.bin", 1500, 2000) == data[1500:3500]
+    assert len(range_requests()) == 4
+    assert cache.read(remote + "/data.bin", 9000, 5000) == data[9000:]
+    assert cache.stats()['hits'] == 3
+
+
+def test_byte_budget(remote, tmp_path):
+    cache = BlockCache(str(tmp_path), max_bytes=4096, block_size=1024)
+    cache.read(remote + "/data.bin", 0, 10000)
+    assert cache.stats()['bytes'] <= 4096
+    assert sum(os.path.getsize(tmp_path / x) for x in os.listdir(tmp_path)) <= 4096
+    # The most recently read blocks are kept
+    n_requests = len(range_requests())
+    cache.read(remote + "/data.bin", 9000, 1000)
+    assert len(range_requests()) == n_requests
+
+
+def test_etag_change(remote, tmp_path):
+    cache = BlockCache(str(tmp_path), max_bytes=100000, block_size=1024, validate_seconds=0)
+    url = remote + "/data.bin"
+    cache.read(url, 0, 1000)
+    RemoteFiles.files["/data.bin"] = (os.urandom(10000), '"v2"')
+    assert cache.read(url, 0, 1000) == RemoteFiles.files["/data.bin"][0][0:1000]
+    assert cache.stats()['invalidations'] == 1
+    assert cache.stats()['blocks'] == 1
+
+
+def test_server_without_ranges(remote, tmp_path):
+    RemoteFiles.ignore_ranges = True
+    cache = BlockCache(str(tmp_path), max_bytes=100000, block_size=1024)
+    data = RemoteFiles.files["/data.bin"][0]
+    assert cache.read(remote + "/data.bin", 1000, 3000) == data[1000:4000]
+    assert cache.read(remote + "/data.bin", 5000, 5000) == data[5000:]
+    # The whole file is downloaded once
+    assert len(range_requests()) == 1
+    assert cache.stats()['whole_file_reads'] == 1
+
+
+def test_missing_file(remote, tmp_path):
+    cache = BlockCache(str(tmp_path), max_bytes=100000)
+    with pytest.raises(BlockCacheError) as e:
+        cache.read(remote + "/missing.bin", 0, 10)
+    assert e.value.status == 404
+
+
+def test_proxy(remote, tmp_path):
+    cache = BlockCache(str(tmp_path), max_bytes=100000, block_size=1024)
+    proxy = BlockCacheProxy(cache, allowed_hosts=["127.0.0.1"]).start()
+    data = RemoteFiles.files["/data.bin"][0]
+    try:
+        url = proxy.url(remote + "/data.bin")
+        assert urllib.request.urlopen(url).read() == data
+        request = urllib.request.Request(url, headers={'Range': 'bytes=5000-'})
+        response = urllib.request.urlopen(request)
+        assert response.status == 206
+        assert response.read() == data[5000:]
+        n_requests = len(range_requests())
+        request = urllib.request.Request(url, headers={'Range': 'bytes=100-199'})
+        assert urllib.request.urlopen(request).read() == data[100:200]
+        assert len(range_requests()) == n_requests
+        request = urllib.request.Request(url, headers={'Range': 'bytes=-100'})
+        assert urllib.request.urlopen(request).read() == data[-100:]
+        # Unsatisfiable ranges
+        for byte_range in ['bytes=100-50', 'bytes=10000-', 'bytes=-0']:
+            request = urllib.request.Request(url, headers={'Range': byte_range})
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(request)
+            assert e.value.code == 416, byte_range
+            assert e.value.headers['Content-Range'] == "bytes */10000"
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(proxy.url(remote + "/data.bin.tbi"))
+        assert e.value.code == 404
+    finally:
+        proxy.stop()
+
+
+def test_proxy_allowed_hosts(remote, tmp_path):
+    cache = BlockCache(str(tmp_path), max_bytes=100000, block_size=1024)
+    proxy = BlockCacheProxy(cache).start()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(proxy.url(remote + "/data.bin"))
+        assert e.value.code == 403
+        assert RemoteFiles.requests == []
+        health = urllib.request.urlopen(f"http://127.0.0.1:{proxy.port}{HEALTH_PATH}")
+        assert json.loads(health.read())['service'] == SERVICE_NAME
+    finally:
+        proxy.stop()
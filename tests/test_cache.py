@@ -0,0 +1,200 @@
+import time
+import inspect
+import threading
+
+import pytest
+from flask import Flask
+
+from base.extensions import cache
+from base.utils import cache as cache_module
+from base.utils.cache import LRUCache, TieredCache, warm_cache, stale_while_revalidate
+
+
+class Entities(dict):
+    pass
+
+
+@pytest.fixture
+def datastore(monkeypatch):
+    """
+        Cache entities kept in a dict in place of Google Datastore
+    """
+    entities = Entities()
+    requests = []
+
+    def store_item(kind, name, **kwargs):
+        kwargs.pop('exclude_from_indexes', None)
+        entities[(kind, name)] = kwargs
+
+    def get_item(kind, name):
+        item = entities.get((kind, name))
+        if item is None:
+            return None
+        # As in gcloud.get_item, falsy properties are dropped
+        return dict({k: v for k, v in item.items() if v}, _exists=True)
+
+    def get_items(kind, names):
+        requests.append(('get', len(names)))
+        items = {name: get_item(kind, name) for name in names}
+        return {k: v for k, v in items.items() if v is not None}
+
+    def store_items(kind, items, exclude_from_indexes=None):
+        requests.append(('store', len(items)))
+        for name, properties in items.items():
+            entities[(kind, name)] = properties
+
+    def delete_key(kind, name):
+        entities.pop((kind, name), None)
+
+    monkeypatch.setattr(cache_module, 'store_item', store_item)
+    monkeypatch.setattr(cache_module, 'delete_key', delete_key)
+    monkeypatch.setattr(cache_module, 'get_item', get_item)
+    monkeypatch.setattr(cache_module, 'get_items', get_items)
+    monkeypatch.setattr(cache_module, 'store_items', store_items)
+    monkeypatch.setattr(cache_module, 'acquire_lease', lambda name, seconds, owner: True)
+    monkeypatch.setattr(cache_module, 'release_lease', lambda name, owner: None)
+    entities.requests = requests
+    return entities
+
+
+def test_lru_evicts_least_recently_used():
+    lru = LRUCache(max_bytes=300, max_ttl=0)
+    lru.set('a', 'a' * 100)
+    lru.set('b', 'b' * 100)
+    assert lru.get('a') == 'a' * 100
+    lru.set('c', 'c' * 100)
+    assert lru.get('b') is None
+    assert lru.get('a') == 'a' * 100
+    assert lru.stats()['evictions'] == 1
+
+
+def test_lru_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module, 'time', lambda: now[0])
+    lru = LRUCache(max_ttl=60)
+    lru.set('short', 1, timeout=10)
+    lru.set('long', 2, timeout=0)
+    now[0] += 30
+    assert lru.get('short') is None
+    assert lru.get('long') == 2
+    now[0] += 31
+    assert lru.get('long') is None
+
+
+def test_tiered_cache_promotes_l2_hits(datastore):
+    tiered = TieredCache()
+    assert tiered.set('page', {'html': '<p>'})
+    assert ('cache', tiered.l2.key_prefix + '/page') in datastore
+
+    # Another worker: empty L1
+    tiered.l1.clear()
+    assert tiered.get('page') == {'html': '<p>'}
+    assert tiered.get('page') == {'html': '<p>'}
+    stats = tiered.stats()
+    assert stats['l1']['hits'] == 1
+    assert stats['l1']['misses'] == 1
+    assert stats['l2']['hits'] == 1
+
+
+def test_tiered_cache_many(datastore):
+    tiered = TieredCache()
+    assert tiered.set_many({'a': 1, 'b': None}, timeout=0)
+    tiered.l1.clear()
+    assert tiered.get_many('a', 'b', 'c') == [1, None, None]
+    assert tiered.has('a')
+    tiered.delete_many('a')
+    assert tiered.get('a') is None
+    assert datastore.requests == [('store', 2), ('get', 3)]
+
+
+def test_warm_cache(datastore, monkeypatch):
+    # Removed in Python 3.11; used by cache.cached to build cache keys
+    monkeypatch.setattr(inspect, 'getargspec', inspect.getfullargspec, raising=False)
+    app = Flask(__name__)
+    cache.init_app(app, config={'CACHE_TYPE': 'base.utils.cache.tiered_cache'})
+    calls = []
+
+    @cache.memoize(50)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    @cache.cached(timeout=50, key_prefix='answer')
+    def answer():
+        calls.append('answer')
+        return 42
+
+    with app.app_context():
+        assert warm_cache([answer, (square, (2,), {}), (square, (3,), {})]) == [42, 4, 9]
+        assert square(3) == 9
+        cache.cache.l1.clear()
+        del datastore.requests[:]
+        assert warm_cache([answer, (square, (2,), {})]) == [42, 4]
+    assert calls == ['answer', 2, 3]
+    # Memoize version key, then the results
+    assert datastore.requests == [('get', 1), ('get', 2)]
+
+
+def test_stale_while_revalidate(datastore, monkeypatch):
+    app = Flask(__name__)
+    cache.init_app(app, config={'CACHE_TYPE': 'base.utils.cache.tiered_cache'})
+    now = [1000.0]
+    monkeypatch.setattr(cache_module, 'time', lambda: now[0])
+    release = threading.Event()
+    calls = []
+
+    @stale_while_revalidate(timeout=10, stale_timeout=100)
+    def summary():
+        calls.append(threading.current_thread())
+        release.wait(5)
+        return len(calls)
+
+    with app.app_context():
+        # Concurrent misses are computed once
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(summary())) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert results == [1, 1, 1, 1]
+
+        # Stale values are served while a background thread refreshes them
+        now[0] += 20
+        release.clear()
+        assert summary() == 1
+        assert summary() == 1
+        release.set()
+        for n in range(50):
+            if summary() == 2:
+                break
+            time.sleep(0.1)
+        assert summary() == 2
+    assert len(calls) == 2
+
+
+def test_stale_while_revalidate_leases(datastore, monkeypatch):
+    app = Flask(__name__)
+    cache.init_app(app, config={'CACHE_TYPE': 'base.utils.cache.tiered_cache'})
+    lease = [None]
+    monkeypatch.setattr(cache_module, 'acquire_lease', lambda name, seconds, owner: lease[0])
+    calls = []
+
+    @stale_while_revalidate(timeout=10, wait_timeout=1)
+    def value(x):
+        calls.append(x)
+        return x
+
+    with app.app_context():
+        # Lease errors do not delay the computation
+        started = time.time()
+        assert value(1) == 1
+        assert time.time() - started < 0.5
+
+        # Another instance holds the lease but never caches the result
+        lease[0] = False
+        started = time.time()
+        assert value(2) == 2
+        assert 1 <= time.time() - started < 2
+    assert calls == [1, 2]
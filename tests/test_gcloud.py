@@ -0,0 +1,86 @@
+import pytest
+
+from base.utils import gcloud
+from base.utils.gcloud import query_item_iter, count_items, count_items_by
+
+
+class FakeQuery(object):
+    """
+        Stand-in for a Datastore query over a list of entities;
+        records the size of each page requested.
+    """
+    def __init__(self, entities, pages, batch_size):
+        self.entities = entities
+        self.pages = pages
+        self.batch_size = batch_size
+        self.filters = []
+
+    def add_filter(self, var, op, val):
+        assert op == '='
+        self.filters.append((var, val))
+
+    def fetch(self, limit=None, start_cursor=None):
+        self.limit = limit
+        self.start = start_cursor or 0
+        return self
+
+    def next_page(self):
+        self.pages.append(self.limit)
+        items = [x for x in self.entities if all(x.get(k) == v for k, v in self.filters)]
+        page = items[self.start:self.start + min(self.limit, self.batch_size)]
+        end = self.start + len(page)
+        # Results after a full page are reported as finished by gcloud
+        more = end < len(items) and len(page) < self.limit
+        return page, more, end if page else None
+
+
+class Pages(list):
+    pass
+
+
+@pytest.fixture
+def datastore(monkeypatch):
+    entities = [{'report_slug': f"report-{n % 3}", 'created_on': n} for n in range(10)]
+    pages = Pages()
+
+    class FakeClient(object):
+        batch_size = 1000
+
+        def query(self, kind, projection):
+            assert projection
+            return FakeQuery(entities, pages, self.batch_size)
+
+    client = FakeClient()
+    monkeypatch.setattr(gcloud, 'google_datastore', lambda: client)
+    pages.client = client
+    return pages
+
+
+def test_query_item_iter_pages(datastore):
+    items = list(query_item_iter('trait', ['created_on'], page_size=4))
+    assert [x['created_on'] for x in items] == list(range(10))
+    assert datastore == [4, 4, 4]
+
+    del datastore[:]
+    assert len(list(query_item_iter('trait', ['created_on'], limit=5, page_size=4))) == 5
+    assert datastore == [4, 1]
+
+
+def test_query_item_iter_short_batches(datastore):
+    # Batches end before the page size with more results after them
+    datastore.client.batch_size = 3
+    items = list(query_item_iter('trait', ['created_on'], page_size=4))
+    assert [x['created_on'] for x in items] == list(range(10))
+    assert datastore == [4, 4, 4, 4]
+    assert count_items('trait') == 10
+
+
+def test_query_item_iter_requires_projection(datastore):
+    with pytest.raises(ValueError):
+        list(query_item_iter('trait', []))
+
+
+def test_aggregations(datastore):
+    assert count_items('trait') == 10
+    assert count_items('trait', filters=[('report_slug', '=', 'report-0')]) == 4
+    assert count_items_by('trait', 'report_slug') == {'report-0': 4, 'report-1': 3, 'report-2': 3}
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pytest
+
+from base.utils.genotype_store import pack_genotypes, unpack_genotypes, build_genotype_store, GenotypeStore
+from base.utils.impact_index import impact_mask, query_mask
+from base.utils.vcf_pool import VCFReaderPool
+from base.utils.vcf_region import iter_region_native
+
+
+VCF_FIXTURE = os.path.join(os.path.dirname(__file__), "data", "WI.test.vcf.gz")
+
+
+def test_pack_genotypes():
+    gt_types = np.random.randint(0, 4, size=(20, 51))
+    packed = np.array([pack_genotypes(x) for x in gt_types])
+    assert packed.shape == (20, 13)
+    assert (unpack_genotypes(packed, 51) == gt_types).all()
+
+
+@pytest.fixture
+def store(tmp_path):
+    build_genotype_store(VCF_FIXTURE, str(tmp_path / "store"), 20200815)
+    return GenotypeStore.load(str(tmp_path / "store"))
+
+
+def assert_same_records(store_records, vcf_records):
+    assert len(store_records) == len(vcf_records)
+    for a, b in zip(store_records, vcf_records):
+        assert (a.CHROM, a.POS, a.REF, a.ALT, a.FILTER, a.ANN) == (b.CHROM, b.POS, b.REF, b.ALT, b.FILTER, b.ANN)
+        assert a.AF == pytest.approx(b.AF, abs=1e-6)
+        assert a.gt_types.tolist() == b.gt_types.tolist()
+        assert a.gt_bases.tolist() == b.gt_bases.tolist()
+        assert a.FT.tolist() == b.FT.tolist()
+
+
+@pytest.mark.parametrize("region", ["I:1-20000",
+                                    "I:2200-2250",
+                                    # Overlaps the deletion at I:6383-6403
+                                    "I:6390-8000",
+                                    "I:6404-8000",
+                                    "II:1-1000",
+                                    "II:20000-30000",
+                                    "X:1-1000"])
+@pytest.mark.parametrize("samples", [None, ["S3", "S1", "S8"]])
+def test_iter_region(store, region, samples):
+    vcf_pool = VCFReaderPool(lambda release, filter_type: VCF_FIXTURE)
+    chrom, interval = region.split(":")
+    start, end = map(int, interval.split("-"))
+    vcf_records = list(iter_region_native(vcf_pool, 20200815, region, samples))
+    store_records = list(store.iter_region(chrom, start, end, samples))
+    assert_same_records(store_records, vcf_records)
+
+    # region() selects the records starting in the region
+    selected = store.region(chrom, start, end)
+    if chrom in store.chroms:
+        assert store.arrays(chrom)['pos'][selected].tolist() == [x.POS for x in vcf_records if x.POS >= start]
+    else:
+        assert selected == slice(0, 0)
+
+
+def test_iter_region_impact(store):
+    vcf_pool = VCFReaderPool(lambda release, filter_type: VCF_FIXTURE)
+    mask = query_mask(['HIGH'])
+    vcf_records = [x for x in iter_region_native(vcf_pool, 20200815, "I:6390-20000")
+                   if impact_mask(x.ANN) & mask]
+    assert vcf_records
+    assert_same_records(list(store.iter_region("I", 6390, 20000, impact_mask=mask)), vcf_records)
@@ -0,0 +1,22 @@
+import numpy as np
+
+from base.utils.geo_cluster import GridClusters
+
+
+def test_grid_clusters():
+    rng = np.random.RandomState(1)
+    latitude = rng.uniform(-60, 70, 500)
+    longitude = rng.uniform(-180, 180, 500)
+    grid = GridClusters(latitude, longitude, max_zoom=8)
+    for zoom in (0, 4, 8, 12):
+        clusters = grid.clusters(zoom)
+        assert clusters['count'].sum() == 500
+        members = np.concatenate([grid.members(zoom, x) for x in clusters['key']])
+        assert sorted(members.tolist()) == list(range(500))
+    # Zooming in never merges clusters
+    assert len(grid.clusters(0)['key']) <= len(grid.clusters(4)['key']) <= len(grid.clusters(8)['key'])
+    # Bounding boxes keep the clusters of the locations they contain
+    bbox = (-30, -10, 60, 50)
+    inside = ((latitude >= -10) & (latitude <= 50) & (longitude >= -30) & (longitude <= 60)).sum()
+    assert grid.clusters(8, bbox)['count'].sum() >= inside
+    assert grid.clusters(8, bbox)['count'].sum() < 500
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from base.utils.impact_index import build_impact_index, ImpactIndex, impact_mask, query_mask
+from base.utils.vcf_pool import VCFReaderPool
+from base.utils.vcf_region import iter_region_native, iter_spans_native
+
+
+VCF_FIXTURE = os.path.join(os.path.dirname(__file__), "data", "WI.test.vcf.gz")
+
+
+@pytest.fixture
+def index(tmp_path):
+    build_impact_index(VCF_FIXTURE, str(tmp_path / "impact_index.npz"))
+    return ImpactIndex.load(str(tmp_path / "impact_index.npz"))
+
+
+@pytest.mark.parametrize("region", ["I:1-20000",
+                                    # Overlaps the deletion at I:6383-6403
+                                    "I:6390-8000",
+                                    "I:6404-8000",
+                                    "II:1-1000",
+                                    "X:1-1000"])
+@pytest.mark.parametrize("variant_impact", [["HIGH"], ["LOW"], ["HIGH", "MODERATE"]])
+def test_spans(index, region, variant_impact):
+    vcf_pool = VCFReaderPool(lambda release, filter_type: VCF_FIXTURE)
+    mask = query_mask(variant_impact)
+    chrom, interval = region.split(":")
+    start, end = map(int, interval.split("-"))
+    expected = [x.POS for x in iter_region_native(vcf_pool, 20200815, region) if impact_mask(x.ANN) & mask]
+    spans = index.spans(chrom, start, end, mask, max_gap=100)
+    records = [x for x in iter_spans_native(vcf_pool, 20200815, chrom, spans) if impact_mask(x.ANN) & mask]
+    assert [x.POS for x in records] == expected
+
+
+def test_spans_overlap(index):
+    # The deletion starts before the region
+    assert index.spans("I", 6390, 7000, query_mask(["LOW"])) == [(6383, 6383)]
+    assert index.spans("I", 6404, 7000, query_mask(["LOW"])) == []
@@ -0,0 +1,14 @@
+import numpy as np
+
+from base.utils.interval_index import IntervalIndex
+
+
+def test_interval_index():
+    rng = np.random.RandomState(1)
+    chrom = rng.choice(['I', 'II', 'X'], 2000)
+    start = rng.randint(1, 1000000, 2000)
+    end = start + rng.randint(0, 50000, 2000)
+    index = IntervalIndex(chrom, start, end)
+    for query_chrom, query_start, query_end in [('I', 5000, 9000), ('X', 1, 1), ('II', 400000, 600000), ('V', 1, 100)]:
+        expected = np.flatnonzero((chrom == query_chrom) & (start <= query_end) & (end >= query_start))
+        assert sorted(index.overlapping(query_chrom, query_start, query_end).tolist()) == expected.tolist()
@@ -0,0 +1,304 @@
+import os
+import gzip
+
+import numpy as np
+import pytest
+from cyvcf2 import VCF
+from flask import Flask
+
+from base.utils.data_utils import json_encoder
+from base.utils.genotype_store import build_genotype_store, GenotypeStore
+from base.utils.popgen import TajimaTrack, allele_counts, windows, windowed_diversity, windowed_hudson_fst
+from base.utils.vcf_pool import VCFReaderPool
+from base.views.api import api_popgen
+from base.views.api.api_popgen import api_popgen_bp, group_allele_counts
+
+
+VCF_FIXTURE = os.path.join(os.path.dirname(__file__), "data", "WI.test.vcf.gz")
+
+
+def brute_force_window(bed, chrom, start, end):
+    """
+        Returns the rows of BED windows overlapping a 1-based region
+    """
+    return [row for row in bed if row[0] == chrom and row[1] < end and row[2] >= start]
+
+
+@pytest.fixture
+def tajima_bed():
+    rng = np.random.RandomState(7)
+    bed = []
+    for chrom in ["I", "II", "X"]:
+        # Sliding windows, and longer windows overlapping them
+        for start in range(0, 100000, 5000):
+            bed.append((chrom, start, start + 10000, round(rng.normal(), 6)))
+        for start in rng.choice(100000, 10):
+            bed.append((chrom, int(start), int(start + rng.randint(1, 40000)), round(rng.normal(), 6)))
+    lines = [f"{chrom}\t{start}\t{end}\t.\t.\t{D}" for chrom, start, end, D in bed]
+    return bed, gzip.compress("\n".join(["#chrom\tstart\tend\t.\t.\tD"] + lines).encode())
+
+
+def test_tajima_track_window(tajima_bed):
+    bed, data = tajima_bed
+    track = TajimaTrack(data)
+    rng = np.random.RandomState(8)
+    regions = [("I", 1, 100000), ("X", 5000, 5000), ("X", 5001, 5001), ("II", 99999, 200000)]
+    regions += [("I", int(x), int(x + y)) for x, y in zip(rng.choice(100000, 50), rng.choice(20000, 50))]
+    for chrom, start, end in regions:
+        expected = brute_force_window(bed, chrom, start, end)
+        region = track.window(chrom, start, end)
+        assert sorted(zip(track.start[region], track.end[region], track.D[region])) == \
+            sorted((s, e, D) for c, s, e, D in expected), (chrom, start, end)
+    assert len(track.window("MtDNA", 1, 100000)) == 0
+    x, y = track.query("MtDNA", 1, 100000)
+    assert len(x) == 0 and len(y) == 0
+
+
+def test_tajima_track_points(tajima_bed):
+    bed, data = tajima_bed
+    track = TajimaTrack(data)
+    x, y = track.query("II", 1, 100000)
+    assert len(x) == len(brute_force_window(bed, "II", 1, 100000))
+    assert (track.query("II", 1, 100000, points=len(x))[1] == y).all()
+    # Windows are averaged in consecutive groups of near-equal size
+    points_x, points_y = track.query("II", 1, 100000, points=7)
+    groups = np.split(np.arange(len(x)), [len(x) * n // 7 for n in range(1, 7)])
+    assert {len(group) for group in groups} <= {len(x) // 7, len(x) // 7 + 1}
+    assert points_x.tolist() == [int(x[group].mean()) for group in groups]
+    np.testing.assert_allclose(points_y, [y[group].mean() for group in groups])
+
+
+def brute_force_diversity(pos, gt_types, window_start, window_end):
+    """
+        Computes pi, theta and Tajima's D one window at a time
+    """
+    result = {'n_variants': [], 'pi': [], 'theta_w': [], 'tajima_d': []}
+    for start, end in zip(window_start, window_end):
+        rows = [gt for p, gt in zip(pos, gt_types) if start <= p <= end]
+        pi, S, n_total = 0, 0, 0
+        for gt in rows:
+            n = sum(1 for x in gt if x in (0, 2))
+            k = sum(1 for x in gt if x == 2)
+            n_total += n
+            if n > 1:
+                pi += 2 * k * (n - k) / (n * (n - 1))
+            S += 0 < k < n
+        nn = int(round(n_total / len(rows))) if rows else 0
+        a1 = sum(1 / i for i in range(1, nn))
+        a2 = sum(1 / i ** 2 for i in range(1, nn))
+        theta = S / a1 if a1 else 0
+        if S < 3 or nn < 4:
+            D = np.nan
+        else:
+            b1 = (nn + 1) / (3 * (nn - 1))
+            b2 = 2 * (nn ** 2 + nn + 3) / (9 * nn * (nn - 1))
+            c1 = b1 - 1 / a1
+            c2 = b2 - (nn + 2) / (a1 * nn) + a2 / a1 ** 2
+            e1, e2 = c1 / a1, c2 / (a1 ** 2 + a2)
+            D = (pi - theta) / np.sqrt(e1 * S + e2 * S * (S - 1))
+        length = end - start + 1
+        result['n_variants'].append(len(rows))
+        result['pi'].append(pi / length)
+        result['theta_w'].append(theta / length)
+        result['tajima_d'].append(D)
+    return result
+
+
+def brute_force_fst(pos, gt1, gt2, window_start, window_end):
+    fst = []
+    for start, end in zip(window_start, window_end):
+        num, den = 0, 0
+        for p, a, b in zip(pos, gt1, gt2):
+            if not start <= p <= end:
+                continue
+            n1, k1 = sum(1 for x in a if x in (0, 2)), sum(1 for x in a if x == 2)
+            n2, k2 = sum(1 for x in b if x in (0, 2)), sum(1 for x in b if x == 2)
+            if n1 < 2 or n2 < 2:
+                continue
+            p1, p2 = k1 / n1, k2 / n2
+            num += (p1 - p2) ** 2 - p1 * (1 - p1) / (n1 - 1) - p2 * (1 - p2) / (n2 - 1)
+            den += p1 * (1 - p2) + p2 * (1 - p1)
+        fst.append(num / den if den > 0 else np.nan)
+    return fst
+
+
+@pytest.fixture
+def genotypes():
+    rng = np.random.RandomState(12)
+    pos = np.sort(rng.choice(np.arange(1, 50000), 300, replace=False))
+    gt_types = rng.choice([0, 1, 2, 3], size=(300, 12), p=[0.5, 0.05, 0.35, 0.1])
+    # Monomorphic and sparsely called variants
+    gt_types[::17] = 0
+    gt_types[::23, 3:] = 3
+    return pos, gt_types
+
+
+def test_windows():
+    window_start, window_end = windows(1, 10, 4, 2)
+    # The window 9-10 is contained in 7-10 and is dropped
+    assert window_start.tolist() == [1, 3, 5, 7]
+    assert window_end.tolist() == [4, 6, 8, 10]
+    window_start, window_end = windows(100, 150, 1000, 1000)
+    assert window_start.tolist() == [100] and window_end.tolist() == [150]
+
+
+def test_windowed_diversity(genotypes):
+    pos, gt_types = genotypes
+    n, k = allele_counts(gt_types)
+    result = windowed_diversity(pos, n, k, 1, 50000, 5000, 2500)
+    expected = brute_force_diversity(pos, gt_types, result['start'], result['end'])
+    assert result['n_variants'].tolist() == expected['n_variants']
+    for key in ['pi', 'theta_w', 'tajima_d']:
+        np.testing.assert_allclose(result[key], expected[key], equal_nan=True)
+    assert not np.isnan(result['tajima_d']).all()
+
+
+def test_windowed_fst(genotypes):
+    pos, gt_types = genotypes
+    n1, k1 = allele_counts(gt_types[:, :5])
+    n2, k2 = allele_counts(gt_types[:, 5:])
+    result = windowed_hudson_fst(pos, n1, k1, n2, k2, 1, 50000, 5000, 2500)
+    expected = brute_force_fst(pos, gt_types[:, :5], gt_types[:, 5:], result['start'], result['end'])
+    np.testing.assert_allclose(result['fst'], expected, equal_nan=True)
+
+
+def test_tajima_constants():
+    # Three segregating sites called in ten isotypes
+    pos = np.array([10, 20, 30])
+    n = np.array([10, 10, 10])
+    k = np.array([1, 5, 9])
+    result = windowed_diversity(pos, n, k, 1, 1000, 1000, 1000)
+    a1 = 2.8289682539682537
+    np.testing.assert_allclose(result['theta_w'], [3 / a1 / 1000])
+    np.testing.assert_allclose(result['pi'], [(0.2 + 50 / 90 + 0.2) / 1000])
+    np.testing.assert_allclose(result['tajima_d'], [-0.3559056], rtol=1e-6)
+
+    # D is masked with fewer than three segregating sites or four called alleles
+    assert np.isnan(windowed_diversity(pos[:2], n[:2], k[:2], 1, 1000, 1000, 1000)['tajima_d']).all()
+    n = np.array([3, 3, 3])
+    k = np.array([1, 1, 2])
+    assert np.isnan(windowed_diversity(pos, n, k, 1, 1000, 1000, 1000)['tajima_d']).all()
+
+
+def test_no_variants():
+    pos = np.zeros(0, dtype=np.int32)
+    counts = np.zeros(0, dtype=np.int64)
+    result = windowed_diversity(pos, counts, counts, 1, 10000, 5000, 5000)
+    assert result['n_variants'].tolist() == [0, 0]
+    assert result['pi'].tolist() == [0, 0]
+    assert result['theta_w'].tolist() == [0, 0]
+    assert np.isnan(result['tajima_d']).all()
+    result = windowed_hudson_fst(pos, counts, counts, counts, counts, 1, 10000, 5000, 5000)
+    assert np.isnan(result['fst']).all()
+
+
+def test_single_window(genotypes):
+    pos, gt_types = genotypes
+    n, k = allele_counts(gt_types)
+    result = windowed_diversity(pos, n, k, 1000, 9000, 100000, 100000)
+    assert result['start'].tolist() == [1000] and result['end'].tolist() == [9000]
+    expected = brute_force_diversity(pos, gt_types, [1000], [9000])
+    assert result['n_variants'].tolist() == expected['n_variants']
+    np.testing.assert_allclose(result['tajima_d'], expected['tajima_d'])
+
+
+@pytest.fixture
+def release(tmp_path, monkeypatch):
+    """
+        Serves the VCF fixture through a reader pool, and
+        its genotype store once built
+    """
+    stores = {}
+    monkeypatch.setattr(api_popgen, 'vcf_pool', VCFReaderPool(lambda release, filter_type: VCF_FIXTURE))
+    monkeypatch.setattr(api_popgen, 'get_genotype_store', lambda release: stores.get(release))
+
+    def build_store():
+        build_genotype_store(VCF_FIXTURE, str(tmp_path / "store"), 20200815)
+        stores['20200815'] = GenotypeStore.load(str(tmp_path / "store"))
+    stores['build'] = build_store
+    return stores
+
+
+@pytest.mark.parametrize("engine", ["vcf", "store"])
+def test_group_allele_counts(release, engine):
+    if engine == "store":
+        release['build']()
+    vcf = VCF(VCF_FIXTURE, gts012=True)
+    groups = [["S1", "S2", "S3"], ["S8", "S4", "S5", "S6"]]
+    idx = [[vcf.samples.index(x) for x in group] for group in groups]
+    # The deletion at 6383 overlaps the region but does not start in it
+    records = [x for x in vcf("I:6390-15000") if x.POS >= 6390]
+    pos, counts = group_allele_counts(20200815, "I", 6390, 15000, groups)
+    assert pos.tolist() == [x.POS for x in records]
+    for group, (n, k) in zip(idx, counts):
+        gt_types = np.array([x.gt_types[group] for x in records])
+        assert n.tolist() == ((gt_types == 0) | (gt_types == 2)).sum(axis=1).tolist()
+        assert k.tolist() == (gt_types == 2).sum(axis=1).tolist()
+
+    pos, counts = group_allele_counts(20200815, "X", 1, 15000, groups)
+    assert len(pos) == 0 and all(len(n) == 0 and len(k) == 0 for n, k in counts)
+
+
+def test_popgen_api(release):
+    app = Flask(__name__)
+    app.json_encoder = json_encoder
+    app.register_blueprint(api_popgen_bp, url_prefix='/api')
+    client = app.test_client()
+
+    response = client.get('/api/popgen/diversity/I/1/20000/20200815?window=1000')
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['start'] == list(range(1, 20000, 1000))
+    assert sum(result['n_variants']) == 40
+    # Windows with fewer than three segregating sites
+    assert None in result['tajima_d']
+
+    response = client.get('/api/popgen/fst/II/1/20000/20200815?pop1=S1,S2,S3&pop2=S4,S5,S6&window=20000')
+    assert response.status_code == 200
+    assert response.get_json()['n_variants'] == [10]
+
+    for url in ['/api/popgen/diversity/I/20000/1/20200815',
+                '/api/popgen/diversity/I/1/20000/20200815?window=0',
+                '/api/popgen/diversity/I/1/20000/20200815?window=1&step=1',
+                '/api/popgen/diversity/I/1/20000/20200815?isotypes=S1,XZ1',
+                '/api/popgen/fst/I/1/20000/20200815?pop1=S1,S2',
+                '/api/popgen/fst/I/1/20000/20200815?pop1=S1,S2&pop2=XZ1']:
+        response = client.get(url)
+        assert response.status_code == 400, url
+        assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize("engine", ["vcf", "store"])
+def test_allele_geo(release, engine, monkeypatch):
+    if engine == "store":
+        release['build']()
+    located = np.array([True, False, True, True, False, True, True, True])
+    locations = {'located': located,
+                 'latitude': np.arange(8.0),
+                 'longitude': -np.arange(8.0),
+                 'elevation': np.where(located, 100.0, np.nan)}
+    monkeypatch.setattr(api_popgen, 'isotype_locations', lambda release, version: locations)
+    monkeypatch.setattr(api_popgen, 'db_version', lambda: 1)
+    app = Flask(__name__)
+    app.json_encoder = json_encoder
+    app.register_blueprint(api_popgen_bp, url_prefix='/api')
+    client = app.test_client()
+
+    vcf = VCF(VCF_FIXTURE, gts012=True)
+    records = {x.POS: x for x in vcf("I:1-20000")}
+    # Unsorted and repeated positions, a position within the deletion at 6383 and no variant
+    positions = [7699, 531, 6390, 2247, 7699, 100]
+    result = client.get('/api/popgen/gt/I/' + ",".join(map(str, positions)) + '/20200815').get_json()
+    assert [x and x['POS'] for x in result] == [7699, 531, None, 2247, 7699, None]
+    for pos, variant in zip(positions, result):
+        if variant:
+            record = records[pos]
+            assert variant['ALT'] == record.ALT
+            assert [x['SAMPLE'] for x in variant['GT']] == [s for s, x in zip(vcf.samples, located) if x]
+            assert [x['GT'] for x in variant['GT']] == record.gt_types[located].tolist()
+            assert variant['GT'][1]['latitude'] == 2.0 and variant['GT'][1]['elevation'] == 100.0
+
+    assert client.get('/api/popgen/gt/I/2247/20200815').get_json()['POS'] == 2247
+    assert client.get('/api/popgen/gt/I/100/20200815').get_json() == []
+    assert client.get('/api/popgen/gt/X/100,200/20200815').get_json() == [None, None]
+    assert client.get('/api/popgen/gt/I/1,a/20200815').status_code == 400
@@ -0,0 +1,108 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+from base.models import db, WormbaseGeneSummary, Homologs
+from base.utils.data_utils import json_encoder, dump_json
+from base.utils.search import PrefixIndex, LazyIndex
+from base.views.api import api_gene
+from base.views.api.api_gene import lookup_gene, query_gene, query_homolog
+
+
+GENES = [{'chrom': 'I', 'start': 100, 'end': 900, 'locus': 'pot-2', 'gene_id': 'WBGene00010195',
+          'sequence_name': 'F52C9.8', 'biotype': 'protein_coding'},
+         {'chrom': 'I', 'start': 2000, 'end': 2900, 'locus': 'pot-1', 'gene_id': 'WBGene00010194',
+          'sequence_name': 'F52C9.7', 'biotype': 'protein_coding'},
+         {'chrom': 'X', 'start': 500, 'end': 800, 'locus': None, 'gene_id': 'WBGene00000001',
+          'sequence_name': 'pot', 'biotype': 'ncRNA'}]
+
+HOMOLOGS = [{'gene_id': 'WBGene00010195', 'gene_name': 'pot-2', 'homolog_species': 'Homo sapiens',
+             'homolog_taxon_id': 9606, 'homolog_gene': 'POT1', 'homolog_source': 'Homologene'},
+            {'gene_id': 'WBGene00010194', 'gene_name': 'pot-1', 'homolog_species': 'Homo sapiens',
+             'homolog_taxon_id': 9606, 'homolog_gene': 'POT1', 'homolog_source': 'Homologene'}]
+
+
+def test_prefix_index_ranking():
+    records = ['abc-1', 'abc', 'xyz', 'q', 'abcz', 'abc-2']
+    names = [('abc-1', 0), ('ABC', 1), ('xyz', 2), ('q', 3), ('abcz', 4), ('abc-2', 5)]
+    aliases = [('abc', 2), ('abcd', 3), ('abc', 5)]
+    index = PrefixIndex(records, names, aliases)
+    # exact name > name prefix (in name order) > alias exact > alias prefix
+    assert index.search('Abc') == ['abc', 'abc-1', 'abc-2', 'abcz', 'xyz', 'q']
+    assert index.search('abc', limit=3) == ['abc', 'abc-1', 'abc-2']
+    assert index.search('abc', prefix=False) == ['abc', 'xyz', 'abc-2']
+    assert index.search('abc', aliases=False, limit=None) == ['abc', 'abc-1', 'abc-2', 'abcz']
+    assert index.search('abcd') == ['q']
+    assert index.search('') == []
+    assert index.first('ABC-') == 'abc-1'
+    assert index.first('none') is None
+
+
+def test_lazy_index_version():
+    version = [1]
+    builds = []
+
+    def build():
+        builds.append(version[0])
+        return object()
+
+    lazy = LazyIndex(build, version_fn=lambda: version[0])
+    index = lazy.get()
+    assert lazy.get() is index
+    version[0] = 2
+    assert lazy.get() is not index
+    assert builds == [1, 2]
+    lazy.reset()
+    lazy.get()
+    assert builds == [1, 2, 2]
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.json_encoder = json_encoder
+    app.register_blueprint(api_gene.api_gene_bp, url_prefix='/api')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(WormbaseGeneSummary, GENES)
+        db.session.bulk_insert_mappings(Homologs, HOMOLOGS)
+        db.session.commit()
+        api_gene.gene_index.reset()
+        api_gene.homolog_index.reset()
+        yield app
+
+
+def as_json(record):
+    return json.loads(dump_json(record))
+
+
+def test_gene_records(app):
+    # Called internally, as by combined_search, the functions return records
+    with app.test_request_context('/api/gene/browser-search/pot'):
+        gene = lookup_gene('POT-2')
+        assert isinstance(gene, SimpleNamespace)
+        # Records serialize like the ORM objects they replace
+        orm_gene = WormbaseGeneSummary.query.filter_by(locus='pot-2').one()
+        assert as_json(gene) == as_json(orm_gene)
+        assert gene.interval == 'I:100-900' and gene.gene_symbol == 'pot-2'
+
+        # Exact sequence name before locus prefixes
+        assert [x.gene_id for x in query_gene('pot')] == ['WBGene00000001', 'WBGene00010194', 'WBGene00010195']
+        assert lookup_gene('missing') is None
+
+        homologs = query_homolog('pot1')
+        orm_homologs = [x.unnest() for x in Homologs.query.order_by(Homologs.id)]
+        assert [as_json(x) for x in homologs] == [as_json(x) for x in orm_homologs]
+        assert homologs[0].gene_summary is None and homologs[0].locus == 'pot-2'
+        assert query_homolog('pot') == []
+        genes = query_gene('pot')
+
+    client = app.test_client()
+    assert client.get('/api/gene/lookup/F52C9.8').get_json() == as_json(gene)
+    assert client.get('/api/gene/search/pot').get_json() == [as_json(x) for x in genes]
+    assert client.get('/api/gene/homolog/POT1').get_json() == [as_json(x) for x in homologs]
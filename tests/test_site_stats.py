@@ -0,0 +1,85 @@
+import arrow
+import pytest
+
+from base.utils import site_stats
+from base.utils.site_stats import record_site_stats, compact_site_stats, get_site_stats
+
+
+class Entities(dict):
+    pass
+
+
+@pytest.fixture
+def datastore(monkeypatch):
+    """
+        site_stats entities kept in a dict, and trait/user
+        projections served from lists
+    """
+    entities = Entities()
+    today = arrow.utcnow()
+    traits = [{'report_slug': 'a', 'created_on': today.shift(days=-2)},
+              {'report_slug': 'a', 'created_on': today.shift(days=-2)},
+              {'report_slug': 'b', 'created_on': today.shift(days=-1)},
+              # A trait added to report a on a later day
+              {'report_slug': 'a', 'created_on': today.shift(days=-1)},
+              {'report_slug': 'c', 'created_on': today}]
+    users = ['x@example.com', 'y@example.com', 'z@example.com']
+
+    def get_item(kind, name):
+        return entities.get((kind, name))
+
+    def get_items(kind, names):
+        return {name: entities[(kind, name)] for name in names if (kind, name) in entities}
+
+    def store_item(kind, name, exclude_from_indexes=None, **kwargs):
+        entities[(kind, name)] = kwargs
+        entities.stored.append(name)
+
+    def increment_item(kind, name, **counts):
+        item = entities.setdefault((kind, name), {})
+        for k, v in counts.items():
+            item[k] = item.get(k, 0) + v
+
+    def query_item_iter(kind, projection):
+        assert kind == 'trait'
+        for trait in traits:
+            yield {'report_slug': trait['report_slug'],
+                   'created_on': int(trait['created_on'].float_timestamp * 1e6)}
+
+    def distinct_items(kind, fields):
+        return [{'user_email': x} for x in users]
+
+    for name, fn in list(locals().items()):
+        if callable(fn) and hasattr(site_stats, name):
+            monkeypatch.setattr(site_stats, name, fn)
+    entities.stored = []
+    return entities
+
+
+def test_site_stats(datastore):
+    # Today's submission and the newest user were counted when made
+    record_site_stats(reports=1, traits=1)
+    record_site_stats(users=1)
+
+    # Before the first compaction only today's counters are read
+    stats = get_site_stats.uncached()
+    assert stats['n_users'] == 1
+    assert stats['mappings'].traits.tolist() == [1]
+    assert datastore.stored == []
+
+    summary = compact_site_stats()
+    assert summary['n_users'] == 2
+    assert summary['series']['traits'] == [2, 2]
+    # Reports are counted on the day they were first submitted
+    assert summary['series']['reports'] == [1, 1]
+
+    stats = get_site_stats.uncached()
+    assert stats['n_users'] == 3
+    assert stats['mappings'].traits.tolist() == [2, 4, 5]
+    assert stats['mappings'].reports.tolist() == [1, 2, 3]
+
+    # Counters added after compaction are included
+    record_site_stats(reports=0, traits=2)
+    stats = get_site_stats.uncached()
+    assert stats['mappings'].traits.tolist() == [2, 4, 7]
+    assert stats['mappings'].reports.tolist() == [1, 2, 3]
@@ -0,0 +1,6 @@
+from base.views.api.api_strain import resolve_isotypes
+
+
+def test_resolve_isotypes(strain_app):
+    assert resolve_isotypes(['N2', 'LSJ1', 'HW', 'CB4856', 'QX1', 'HA,HW', '56']) == \
+        ['N2', 'LSJ1', 'CB4856', 'CB4856', None, None, None]
@@ -0,0 +1,19 @@
+from base.models import Strain
+from base.utils.strain_snapshot import get_strain_snapshot
+from base.views.api.api_strain import query_strains
+
+
+def test_strain_snapshot(strain_app):
+    assert [x.strain for x in query_strains()] == ['N2', 'LSJ1', 'CB4856']
+    assert [x.strain for x in query_strains(release=20170531, issues=True)] == ['N2', 'CB4856', 'ECA1']
+    assert [x.strain for x in query_strains('N2')] == ['N2', 'LSJ1']
+    assert [x.strain for x in query_strains(isotype_name='CB4856')] == ['CB4856']
+    snapshot = get_strain_snapshot()
+    isotypes = snapshot.rows(snapshot.isotype_order, snapshot.isotype_ref & snapshot.located)
+    assert [x.isotype for x in isotypes] == ['CB4856', 'N2']
+    assert [x.reference_strain for x in query_strains(isotype_name='N2')] == ['N2']
+    assert Strain.release_summary('20170531') == {'strain_count': 2,
+                                                  'strain_count_sequenced': 2,
+                                                  'isotype_count': 2}
+    assert Strain.release_summary(20200815)['strain_count'] == 3
+    assert Strain.release_summary(20000101)['strain_count'] == 0